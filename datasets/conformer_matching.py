@@ -7,6 +7,8 @@ from rdkit import Geometry
 import networkx as nx
 from scipy.optimize import differential_evolution
 
+from utils.torsion import get_smallest_components
+
 RDLogger.DisableLog('rdApp.*')
 
 """
@@ -70,14 +72,12 @@ def get_torsion_angles(mol):
     for bond in mol.GetBonds():
         start, end = bond.GetBeginAtomIdx(), bond.GetEndAtomIdx()
         G.add_edge(start, end)
-    for e in G.edges():
-        G2 = copy.deepcopy(G)
-        G2.remove_edge(*e)
-        if nx.is_connected(G2): continue
-        l = list(sorted(nx.connected_components(G2), key=len)[0])
+    edges = list(G.edges())
+    for e, l in zip(edges, get_smallest_components(len(nodes), edges)):
+        if l is None: continue
         if len(l) < 2: continue
-        n0 = list(G2.neighbors(e[0]))
-        n1 = list(G2.neighbors(e[1]))
+        n0 = [n for n in G.neighbors(e[0]) if n != e[1]]
+        n1 = [n for n in G.neighbors(e[1]) if n != e[0]]
         torsions_list.append(
             (n0[0], e[0], e[1], n1[0])
         )
@@ -0,0 +1,98 @@
+import atexit
+import os
+import pickle
+import sqlite3
+import time
+
+import numpy as np
+import torch
+from rdkit import Chem
+
+# bump this when the conformer generation or the ligand featurization changes, older entries are then ignored
+LIGAND_CACHE_VERSION = 1
+
+
+def get_ligand_key(mol):
+    # canonical isomeric SMILES of the parsed molecule without hydrogens, the same compound gets the same key whether it
+    # is given as a SMILES or as a file, with or without hydrogens and independently of the atom order of the input.
+    # A hit returns the mol with the atom order of the input that was cached first
+    return Chem.MolToSmiles(Chem.RemoveHs(mol))
+
+
+def ligand_graph_to_entry(complex_graph):
+    # everything that get_inference_ligand_graph computes for the ligand, with the tensors as numpy arrays and the mol
+    # with its conformer in double precision
+    def to_numpy(store):
+        return {key: value.numpy() if torch.is_tensor(value) else value for key, value in store.items()}
+    mol = complex_graph.mol.ToBinary(Chem.PropertyPickleOptions.AllProps | Chem.PropertyPickleOptions.CoordsAsDouble)
+    return {'mol': mol, 'rmsd_matching': complex_graph.rmsd_matching,
+            'ligand': to_numpy(complex_graph['ligand']),
+            'lig_bond': to_numpy(complex_graph['ligand', 'lig_bond', 'ligand'])}
+
+
+def entry_to_ligand_graph(entry, complex_graph):
+    for key, value in entry['ligand'].items():
+        complex_graph['ligand'][key] = torch.from_numpy(value) if key != 'mask_rotate' and isinstance(value, np.ndarray) else value
+    for key, value in entry['lig_bond'].items():
+        complex_graph['ligand', 'lig_bond', 'ligand'][key] = torch.from_numpy(value)
+    complex_graph.rmsd_matching = entry['rmsd_matching']
+    complex_graph.mol = Chem.Mol(entry['mol'])
+    return complex_graph
+
+
+class LigandCache:
+    """ Persistent cache of the prepared ligands in an SQLite file that is shared between runs and jobs. The connection
+    is opened lazily in every process that uses the cache, so that it survives forks. New entries are buffered and
+    written in one short transaction at a time so that concurrent jobs do not wait on each other. """
+
+    def __init__(self, path, flush_every=64, flush_interval=30):
+        self.path = path
+        self.flush_every, self.flush_interval = flush_every, flush_interval
+        self.connection, self.pid = None, None
+        self.pending, self.last_flush = {}, time.time()
+
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # the connection of a parent process is not usable after a fork, its buffered entries are the parent's
+            self.connection, self.pid, self.pending = sqlite3.connect(self.path, timeout=600), os.getpid(), {}
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS ligands (smiles TEXT, remove_hs INTEGER, '
+                                        'version INTEGER, entry BLOB, PRIMARY KEY (smiles, remove_hs, version))')
+            atexit.register(self.flush)
+        return self.connection
+
+    def get(self, smiles, remove_hs):
+        connection = self.connect()
+        if (smiles, remove_hs) in self.pending:
+            return pickle.loads(self.pending[(smiles, remove_hs)])
+        row = connection.execute('SELECT entry FROM ligands WHERE smiles = ? AND remove_hs = ? AND version = ?',
+                                 (smiles, int(remove_hs), LIGAND_CACHE_VERSION)).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self, smiles, remove_hs, entry):
+        self.connect()
+        self.pending[(smiles, remove_hs)] = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(self.pending) >= self.flush_every or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.pid != os.getpid() or not self.pending:
+            return
+        # another job might have added the same ligand in the meantime, the first entry is kept
+        with self.connection:
+            self.connection.executemany('INSERT OR IGNORE INTO ligands VALUES (?, ?, ?, ?)',
+                                        [(smiles, int(remove_hs), LIGAND_CACHE_VERSION, entry)
+                                         for (smiles, remove_hs), entry in self.pending.items()])
+        self.pending, self.last_flush = {}, time.time()
+
+
+ligand_caches = {}
+
+
+def get_ligand_cache(path):
+    # one cache per file and process, the tasks of the worker processes only carry the path
+    if path not in ligand_caches:
+        ligand_caches[path] = LigandCache(path)
+    return ligand_caches[path]
@@ -59,18 +59,36 @@ def batch_compute_dihedral_angles(sidechains):
     return dihedral_angles
 
 
+# (residue type, atom name) -> slot in the (N, 14, 3) coordinate array
+atom_slots = {(aa, name): j for aa, names in atom_order.items() for j, name in enumerate(names)}
+
+
 def get_coords(prody_pdb):
-    resindices = sorted(set(prody_pdb.ca.getResindices()))
+    resindices = np.unique(prody_pdb.ca.getResindices())
     coords = np.full((len(resindices), 14, 3), np.nan)
-    for i, resind in enumerate(resindices):
-        sel = prody_pdb.select(f'resindex {resind}')
-        resname = sel.getResnames()[0]
-        for j, name in enumerate(atom_order[aa_long2short[resname] if resname in aa_long2short else 'X']):
-            sel_resnum_name = sel.select(f'name {name}')
-            if sel_resnum_name is not None:
-                coords[i, j, :] = sel_resnum_name.getCoords()[0]
-            else:
-                coords[i, j, :] = [np.nan, np.nan, np.nan]
+
+    atom_resindices = prody_pdb.getResindices()
+    atom_names = prody_pdb.getNames()
+    atom_coords = prody_pdb.getCoords()
+
+    # the residue type is taken from the first atom of every residue
+    unique_resindices, first_atoms = np.unique(atom_resindices, return_index=True)
+    resnames = prody_pdb.getResnames()[first_atoms[np.searchsorted(unique_resindices, resindices)]]
+    res_types = np.array([aa_long2short[resname] if resname in aa_long2short else 'X' for resname in resnames])
+
+    # only the atoms of residues with a C-alpha are placed in the array
+    rows = np.searchsorted(resindices, atom_resindices)
+    in_residue = resindices[np.clip(rows, 0, len(resindices) - 1)] == atom_resindices
+    atom_types = np.full(len(atom_names), 'X')
+    atom_types[in_residue] = res_types[rows[in_residue]]
+    slots = np.array([atom_slots.get((t, name), -1) if valid else -1
+                      for t, name, valid in zip(atom_types, atom_names, in_residue)], dtype=int)
+
+    # if an atom name occurs more than once in a residue, the first atom is used
+    atoms = np.where(slots >= 0)[0]
+    _, first = np.unique(rows[atoms] * 14 + slots[atoms], return_index=True)
+    atoms = atoms[first]
+    coords[rows[atoms], slots[atoms]] = atom_coords[atoms]
     return coords
 
 
@@ -140,7 +158,40 @@ def test_get_chi_angles(print_chi_angles=False):
     return True
 
 
+def _get_coords_with_selections(prody_pdb):
+    # reference implementation of get_coords with one ProDy selection per residue and atom
+    resindices = sorted(set(prody_pdb.ca.getResindices()))
+    coords = np.full((len(resindices), 14, 3), np.nan)
+    for i, resind in enumerate(resindices):
+        sel = prody_pdb.select(f'resindex {resind}')
+        resname = sel.getResnames()[0]
+        for j, name in enumerate(atom_order[aa_long2short[resname] if resname in aa_long2short else 'X']):
+            sel_resnum_name = sel.select(f'name {name}')
+            if sel_resnum_name is not None:
+                coords[i, j, :] = sel_resnum_name.getCoords()[0]
+    return coords
+
+
+def test_get_coords(pdb_files=('data/1a0q/1a0q_protein_processed.pdb', 'examples/*.pdb')):
+    # compares get_coords with the selection based implementation and reports the timings
+    import glob
+    import time
+    for pdb_file in [f for pattern in pdb_files for f in sorted(glob.glob(pattern))]:
+        pdb = pr.parsePDB(pdb_file)
+        start = time.time()
+        reference = _get_coords_with_selections(pdb)
+        reference_time = time.time() - start
+        start = time.time()
+        coords = get_coords(pdb)
+        coords_time = time.time() - start
+        assert np.array_equal(coords, reference, equal_nan=True), pdb_file
+        print(f'{pdb_file}: {len(coords)} residues, selections {reference_time:.3f}s, vectorized {coords_time:.4f}s')
+    print('test_get_coords passed')
+    return True
+
+
 if __name__ == '__main__':
+    test_get_coords()
     test_get_chi_angles(print_chi_angles=True)
 
 
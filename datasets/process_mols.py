@@ -7,7 +7,7 @@ from rdkit import Chem
 from rdkit.Chem.rdchem import BondType as BT
 from rdkit.Chem import AllChem, GetPeriodicTable, RemoveHs
 from rdkit.Geometry import Point3D
-from torch import cdist
+from scipy.spatial import cKDTree
 from torch_cluster import knn_graph
 import prody as pr
 
@@ -89,34 +89,69 @@ rec_residue_feature_dims = (list(map(len, [
 ])), 0)
 
 
+def get_index_table(l):
+    """ Return a dictionary from the elements of list l to their index, lookups in it are equivalent to l.index """
+    table = {}
+    for i, e in enumerate(l):
+        table.setdefault(e, i)
+    return table
+
+
+lig_feature_tables = {name: get_index_table(l) for name, l in allowable_features.items()}
+lig_chirality_index, lig_hybridization_index = {}, {}  # indices of the rdkit enum values, filled on first use
+
+
+def get_lig_chirality_index(chiral_tag):
+    if chiral_tag not in lig_chirality_index:
+        name = str(chiral_tag)
+        if name in ['CHI_SQUAREPLANAR', 'CHI_TRIGONALBIPYRAMIDAL', 'CHI_OCTAHEDRAL']:
+            name = 'CHI_OTHER'
+        lig_chirality_index[chiral_tag] = allowable_features['possible_chirality_list'].index(name)
+    return lig_chirality_index[chiral_tag]
+
+
+def get_lig_hybridization_index(hybridization):
+    if hybridization not in lig_hybridization_index:
+        lig_hybridization_index[hybridization] = safe_index(allowable_features['possible_hybridization_list'], str(hybridization))
+    return lig_hybridization_index[hybridization]
+
+
 def lig_atom_featurizer(mol):
+    # the features are looked up in the tables above, the ring features are computed once per ring instead of per atom
     ringinfo = mol.GetRingInfo()
+    num_rings, in_ring_of_size = [0] * mol.GetNumAtoms(), [[0] * 6 for _ in range(mol.GetNumAtoms())]  # rings of size 3 to 8
+    for ring in ringinfo.AtomRings():
+        for idx in ring:
+            num_rings[idx] += 1
+            if 3 <= len(ring) <= 8:
+                in_ring_of_size[idx][len(ring) - 3] = 1
+
+    # the last index of a list is returned for values that are not in it, as in safe_index
+    (atomic_num, atomic_num_misc), (degree, degree_misc), (formal_charge, formal_charge_misc), \
+        (implicit_valence, implicit_valence_misc), (num_h, num_h_misc), (radical_e, radical_e_misc), (numring, numring_misc) = \
+        [(lig_feature_tables[name], len(allowable_features[name]) - 1) for name in [
+            'possible_atomic_num_list', 'possible_degree_list', 'possible_formal_charge_list', 'possible_implicit_valence_list',
+            'possible_numH_list', 'possible_number_radical_e_list', 'possible_numring_list']]
     atom_features_list = []
-    for idx, atom in enumerate(mol.GetAtoms()):
-        chiral_tag = str(atom.GetChiralTag())
-        if chiral_tag  in ['CHI_SQUAREPLANAR', 'CHI_TRIGONALBIPYRAMIDAL', 'CHI_OCTAHEDRAL']:
-            chiral_tag = 'CHI_OTHER'
-
+    for idx in range(mol.GetNumAtoms()):
+        atom = mol.GetAtomWithIdx(idx)
         atom_features_list.append([
-            safe_index(allowable_features['possible_atomic_num_list'], atom.GetAtomicNum()),
-            allowable_features['possible_chirality_list'].index(str(chiral_tag)),
-            safe_index(allowable_features['possible_degree_list'], atom.GetTotalDegree()),
-            safe_index(allowable_features['possible_formal_charge_list'], atom.GetFormalCharge()),
-            safe_index(allowable_features['possible_implicit_valence_list'], atom.GetImplicitValence()),
-            safe_index(allowable_features['possible_numH_list'], atom.GetTotalNumHs()),
-            safe_index(allowable_features['possible_number_radical_e_list'], atom.GetNumRadicalElectrons()),
-            safe_index(allowable_features['possible_hybridization_list'], str(atom.GetHybridization())),
-            allowable_features['possible_is_aromatic_list'].index(atom.GetIsAromatic()),
-            safe_index(allowable_features['possible_numring_list'], ringinfo.NumAtomRings(idx)),
-            allowable_features['possible_is_in_ring3_list'].index(ringinfo.IsAtomInRingOfSize(idx, 3)),
-            allowable_features['possible_is_in_ring4_list'].index(ringinfo.IsAtomInRingOfSize(idx, 4)),
-            allowable_features['possible_is_in_ring5_list'].index(ringinfo.IsAtomInRingOfSize(idx, 5)),
-            allowable_features['possible_is_in_ring6_list'].index(ringinfo.IsAtomInRingOfSize(idx, 6)),
-            allowable_features['possible_is_in_ring7_list'].index(ringinfo.IsAtomInRingOfSize(idx, 7)),
-            allowable_features['possible_is_in_ring8_list'].index(ringinfo.IsAtomInRingOfSize(idx, 8)),
+            atomic_num.get(atom.GetAtomicNum(), atomic_num_misc),
+            get_lig_chirality_index(atom.GetChiralTag()),
+            degree.get(atom.GetTotalDegree(), degree_misc),
+            formal_charge.get(atom.GetFormalCharge(), formal_charge_misc),
+            implicit_valence.get(atom.GetImplicitValence(), implicit_valence_misc),
+            num_h.get(atom.GetTotalNumHs(), num_h_misc),
+            radical_e.get(atom.GetNumRadicalElectrons(), radical_e_misc),
+            get_lig_hybridization_index(atom.GetHybridization()),
+            int(atom.GetIsAromatic()),
+            numring.get(num_rings[idx], numring_misc),
+            *in_ring_of_size[idx],
             #g_charge if not np.isnan(g_charge) and not np.isinf(g_charge) else 0.
         ])
-    return torch.tensor(atom_features_list)
+    if len(atom_features_list) == 0:
+        return torch.tensor(atom_features_list)
+    return torch.from_numpy(np.array(atom_features_list, dtype=np.int64))
 
 
 def safe_index(l, e):
@@ -127,6 +162,54 @@ def safe_index(l, e):
         return len(l) - 1
 
 
+def get_radius_graph_edges(coords, cutoff, max_neighbors, node_name='atom', cutoff_name='cutoff', chunk_size=4096):
+    """ Connects every node to the other nodes within the cutoff. Nodes with more than max_neighbors neighbors are
+    connected to their max_neighbors closest nodes instead and nodes without neighbors to the closest node.
+    The source nodes are processed in chunks of chunk_size so that the memory stays linear in the number of nodes.
+    Returns the edge_index as [dst, src] with the edges ordered by source node. """
+    coords = np.asarray(coords, dtype=np.float64)
+    num_nodes = len(coords)
+    tree = cKDTree(coords)
+    src_list, dst_list = [], []
+
+    for start in range(0, num_nodes, chunk_size):
+        end = min(start + chunk_size, num_nodes)
+        # all pairs with a distance strictly smaller than the cutoff between the chunk and all nodes
+        pairs = cKDTree(coords[start:end]).sparse_distance_matrix(tree, np.nextafter(cutoff, 0), output_type='ndarray')
+        src, dst = pairs['i'].astype(np.int64) + start, pairs['j'].astype(np.int64)
+        not_self = src != dst
+        src, dst = src[not_self], dst[not_self]
+        order = np.lexsort((dst, src))
+        src, dst = src[order], dst[order]
+        num_neighbors = np.bincount(src - start, minlength=end - start)
+
+        too_many = np.where(num_neighbors > max_neighbors)[0] + start
+        isolated = np.where(num_neighbors == 0)[0] + start
+        keep = num_neighbors[src - start] <= max_neighbors
+        chunk_src, chunk_dst = [src[keep]], [dst[keep]]
+
+        for nodes, k in [(too_many, max_neighbors), (isolated, 1)]:
+            if len(nodes) == 0 or num_nodes < 2:
+                continue
+            # the closest node is the node itself
+            _, neighbors = tree.query(coords[nodes], k=min(k + 1, num_nodes))
+            neighbors = neighbors.reshape(len(nodes), -1)[:, 1:]
+            chunk_src.append(np.repeat(nodes, neighbors.shape[1]))
+            chunk_dst.append(neighbors.reshape(-1))
+        for _ in range(len(isolated) if num_nodes > 1 else 0):
+            print(f'The {cutoff_name} {cutoff} was too small for one {node_name} such that it had no neighbors. '
+                  f'So we connected it to the closest other {node_name}')
+
+        src, dst = np.concatenate(chunk_src), np.concatenate(chunk_dst)
+        order = np.argsort(src, kind='stable')
+        src_list.append(src[order])
+        dst_list.append(dst[order])
+
+    if num_nodes == 0:
+        return torch.zeros((2, 0), dtype=torch.long)
+    return torch.from_numpy(np.stack([np.concatenate(dst_list), np.concatenate(src_list)]).astype(np.int64))
+
+
 def moad_extract_receptor_structure(path, complex_graph, neighbor_cutoff=20, max_neighbors=None, sequences_to_embeddings=None,
                                     knn_only_graph=False, lm_embeddings=None, all_atoms=False, atom_cutoff=None, atom_max_neighbors=None):
     # load the entire pdb file
@@ -173,25 +256,7 @@ def new_extract_receptor_structure(seq, all_coords, complex_graph, neighbor_cuto
     if knn_only_graph:
         edge_index = knn_graph(coords, k=max_neighbors if max_neighbors else 32)
     else:
-        distances = cdist(coords, coords)
-        src_list = []
-        dst_list = []
-        for i in range(len(coords)):
-            dst = list(np.where(distances[i, :] < neighbor_cutoff)[0])
-            dst.remove(i)
-            max_neighbors = max_neighbors if max_neighbors else 1000
-            if max_neighbors != None and len(dst) > max_neighbors:
-                dst = list(np.argsort(distances[i, :]))[1: max_neighbors + 1]
-            if len(dst) == 0:
-                dst = list(np.argsort(distances[i, :]))[1:2]  # choose second because first is i itself
-                print(
-                    f'The cutoff {neighbor_cutoff} was too small for one atom such that it had no neighbors. '
-                    f'So we connected it to the closest other atom')
-            assert i not in dst
-            src = [i] * len(dst)
-            src_list.extend(src)
-            dst_list.extend(dst)
-        edge_index = torch.from_numpy(np.asarray([dst_list, src_list]))
+        edge_index = get_radius_graph_edges(coords.numpy(), neighbor_cutoff, max_neighbors if max_neighbors else 1000)
 
     res_names_list = [aa_short2long[seq[i]] if seq[i] in aa_short2long else 'misc' for i in range(len(seq))]
     feature_list = [[safe_index(allowable_features['possible_amino_acids'], res)] for res in res_names_list]
@@ -209,29 +274,12 @@ def new_extract_receptor_structure(seq, all_coords, complex_graph, neighbor_cuto
         if knn_only_graph:
             atoms_edge_index = knn_graph(atom_coords, k=atom_max_neighbors if atom_max_neighbors else 1000)
         else:
-            atoms_distances = cdist(atom_coords, atom_coords)
-            atom_src_list = []
-            atom_dst_list = []
-            for i in range(len(atom_coords)):
-                dst = list(np.where(atoms_distances[i, :] < atom_cutoff)[0])
-                dst.remove(i)
-                max_neighbors = atom_max_neighbors if atom_max_neighbors else 1000
-                if max_neighbors != None and len(dst) > max_neighbors:
-                    dst = list(np.argsort(atoms_distances[i, :]))[1: max_neighbors + 1]
-                if len(dst) == 0:
-                    dst = list(np.argsort(atoms_distances[i, :]))[1:2]  # choose second because first is i itself
-                    print(
-                        f'The atom_cutoff {atom_cutoff} was too small for one atom such that it had no neighbors. '
-                        f'So we connected it to the closest other atom')
-                assert i not in dst
-                src = [i] * len(dst)
-                atom_src_list.extend(src)
-                atom_dst_list.extend(dst)
-            atoms_edge_index = torch.from_numpy(np.asarray([atom_dst_list, atom_src_list]))
+            atoms_edge_index = get_radius_graph_edges(atom_coords.numpy(), atom_cutoff,
+                                                      atom_max_neighbors if atom_max_neighbors else 1000,
+                                                      node_name='atom', cutoff_name='atom_cutoff')
         
-        feats = [get_moad_atom_feats(res, all_coords[i]) for i, res in enumerate(seq)]
-        atom_feat = torch.from_numpy(np.concatenate(feats, axis=0)).float()
-        c_alpha_idx = np.concatenate([np.zeros(len(f)) + i for i, f in enumerate(feats)])
+        feats, c_alpha_idx = get_all_moad_atom_feats(seq, all_coords)
+        atom_feat = torch.from_numpy(feats).float()
         np_array = np.stack([np.arange(len(atom_feat)), c_alpha_idx])
         atom_res_edge_index = torch.from_numpy(np_array).long()
         complex_graph['atom'].x = atom_feat
@@ -278,6 +326,30 @@ def get_moad_atom_feats(res, coords):
     return feats
 
 
+def get_moad_atom_feats_table():
+    # (residue type, atom slot) -> atom features, the slots are the ones of the (N, 14, 3) coordinate arrays
+    residues = list(atom_order.keys()) + ['-']
+    table = np.zeros((len(residues), 14, 4), dtype=np.int64)
+    for i, res in enumerate(residues):
+        if res in aa_short2long:
+            table[i] = get_moad_atom_feats(res, np.zeros((14, 3)))
+        else:  # unknown residues get the misc features
+            table[i] = [safe_index(allowable_features[f], 'misc') for f in
+                        ['possible_amino_acids', 'possible_atomic_num_list', 'possible_atom_type_2', 'possible_atom_type_3']]
+    return {res: i for i, res in enumerate(residues)}, table
+
+
+moad_atom_feats_residues, moad_atom_feats_table = get_moad_atom_feats_table()
+
+
+def get_all_moad_atom_feats(seq, all_coords):
+    """ Features of all atoms of the receptor that have coordinates, in the order of all_coords.reshape(-1, 3),
+    together with the index of the residue every atom belongs to. """
+    res_types = np.array([moad_atom_feats_residues.get(res, moad_atom_feats_residues['X']) for res in seq], dtype=np.int64)
+    atom_res_idx, atom_slots = np.nonzero(~np.any(np.isnan(all_coords), axis=2))
+    return moad_atom_feats_table[res_types[atom_res_idx], atom_slots], atom_res_idx
+
+
 def get_lig_graph(mol, complex_graph):
     atom_feats = lig_atom_featurizer(mol)
 
@@ -468,3 +540,88 @@ def read_molecule(molecule_file, sanitize=False, calc_charges=False, remove_hs=F
         return None
 
     return mol
+
+
+def read_mol_block(mol_block, sanitize=False, remove_hs=False):
+    # a record of a multi-molecule sdf library, parsed like an .sdf file by read_molecule
+    mol = Chem.MolFromMolBlock(mol_block, sanitize=False, removeHs=False)
+    if mol is None:
+        return None
+    try:
+        if sanitize:
+            Chem.SanitizeMol(mol)
+        if remove_hs:
+            mol = Chem.RemoveHs(mol, sanitize=sanitize)
+    except Exception as e:
+        get_logger().warning(f"Failed to process molecule: {mol_block.splitlines()[0] if mol_block else ''}\n{e}")
+        return None
+    return mol
+
+
+def test_get_all_moad_atom_feats(pdb_files=('data/1a0q/1a0q_protein_processed.pdb', 'examples/*.pdb')):
+    # compares get_all_moad_atom_feats with calling get_moad_atom_feats per residue and reports the timings
+    import glob
+    import time
+    for pdb_file in [f for pattern in pdb_files for f in sorted(glob.glob(pattern))]:
+        pdb = pr.parsePDB(pdb_file)
+        seq, coords = pdb.ca.getSequence(), get_coords(pdb)
+        if any(res not in aa_short2long for res in seq):
+            continue  # get_moad_atom_feats does not support unknown residues
+        start = time.time()
+        reference = [get_moad_atom_feats(res, coords[i]) for i, res in enumerate(seq)]
+        reference_idx = np.concatenate([np.zeros(len(f)) + i for i, f in enumerate(reference)])
+        reference = np.concatenate(reference, axis=0)
+        reference_time = time.time() - start
+        start = time.time()
+        feats, atom_res_idx = get_all_moad_atom_feats(seq, coords)
+        feats_time = time.time() - start
+        assert np.array_equal(feats, reference) and np.array_equal(atom_res_idx, reference_idx), pdb_file
+        print(f'{pdb_file}: {len(feats)} atoms, per residue {reference_time:.3f}s, table {feats_time:.4f}s')
+    print('test_get_all_moad_atom_feats passed')
+    return True
+
+
+def test_lig_atom_featurizer(sdf_files=('examples/*.sdf', 'data/1a0q/*.sdf')):
+    # compares lig_atom_featurizer with looking up every feature in the allowable_features lists and reports the timings
+    import glob
+    import time
+
+    def reference_featurizer(mol):
+        ringinfo = mol.GetRingInfo()
+        atom_features_list = []
+        for idx, atom in enumerate(mol.GetAtoms()):
+            chiral_tag = str(atom.GetChiralTag())
+            if chiral_tag in ['CHI_SQUAREPLANAR', 'CHI_TRIGONALBIPYRAMIDAL', 'CHI_OCTAHEDRAL']:
+                chiral_tag = 'CHI_OTHER'
+            atom_features_list.append([
+                safe_index(allowable_features['possible_atomic_num_list'], atom.GetAtomicNum()),
+                allowable_features['possible_chirality_list'].index(str(chiral_tag)),
+                safe_index(allowable_features['possible_degree_list'], atom.GetTotalDegree()),
+                safe_index(allowable_features['possible_formal_charge_list'], atom.GetFormalCharge()),
+                safe_index(allowable_features['possible_implicit_valence_list'], atom.GetImplicitValence()),
+                safe_index(allowable_features['possible_numH_list'], atom.GetTotalNumHs()),
+                safe_index(allowable_features['possible_number_radical_e_list'], atom.GetNumRadicalElectrons()),
+                safe_index(allowable_features['possible_hybridization_list'], str(atom.GetHybridization())),
+                allowable_features['possible_is_aromatic_list'].index(atom.GetIsAromatic()),
+                safe_index(allowable_features['possible_numring_list'], ringinfo.NumAtomRings(idx)),
+            ] + [allowable_features[f'possible_is_in_ring{size}_list'].index(ringinfo.IsAtomInRingOfSize(idx, size)) for size in range(3, 9)])
+        return torch.tensor(atom_features_list)
+
+    mols = [mol for sdf_file in [f for pattern in sdf_files for f in sorted(glob.glob(pattern))]
+            for mol in Chem.SDMolSupplier(sdf_file, removeHs=False) if mol is not None]
+    start = time.time()
+    reference = [reference_featurizer(mol) for mol in mols]
+    reference_time = time.time() - start
+    start = time.time()
+    feats = [lig_atom_featurizer(mol) for mol in mols]
+    feats_time = time.time() - start
+    for mol, f, r in zip(mols, feats, reference):
+        assert f.dtype == r.dtype and torch.equal(f, r), Chem.MolToSmiles(mol)
+    print(f'{len(mols)} molecules, {sum(len(f) for f in feats)} atoms, lists {reference_time:.2f}s, tables {feats_time:.2f}s')
+    print('test_lig_atom_featurizer passed')
+    return True
+
+
+if __name__ == '__main__':
+    test_get_all_moad_atom_feats()
+    test_lig_atom_featurizer()
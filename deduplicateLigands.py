@@ -0,0 +1,64 @@
+## Removes the duplicate compounds of a library before docking. Compounds with the same canonical SMILES (for the same
+## protein) are docked once, the alias csv maps the other names to the docked one so inference.py writes their results too
+import os
+from argparse import ArgumentParser
+
+import pandas as pd
+from rdkit import Chem, RDLogger
+
+from datasets.ligand_cache import get_ligand_key
+from datasets.process_mols import read_molecule
+
+RDLogger.DisableLog('rdApp.*')
+
+parser = ArgumentParser()
+parser.add_argument('protein_ligand_csv', type=str, help='Path to a protein_ligand_csv file with the columns complex_name, protein_path and ligand_description')
+parser.add_argument('--output_csv', type=str, required=True, help='Path where the protein_ligand_csv with only the unique compounds is written to')
+parser.add_argument('--alias_csv', type=str, required=True, help='Path where the complex_name and alias of every removed duplicate are written to')
+parser.add_argument('--strip_salts', action='store_true', default=False, help='Only keep the largest fragment of every compound, so salts and solvates of the same compound are docked once')
+args = parser.parse_args()
+
+def read_ligand(ligand_description):
+	## The same parsing as in inference.py, a ligand is either a SMILES or a molecule file
+	mol = Chem.MolFromSmiles(ligand_description)
+	if mol is None and os.path.isfile(ligand_description):
+		mol = read_molecule(ligand_description, remove_hs=False, sanitize=True)
+	return mol
+
+def get_largest_fragment(mol):
+	fragments = Chem.GetMolFrags(mol, asMols=True, sanitizeFrags=True)
+	return max(fragments, key=lambda fragment: (fragment.GetNumHeavyAtoms(), fragment.GetNumAtoms()))
+
+df = pd.read_csv(args.protein_ligand_csv, sep=None, engine="python", dtype=str, keep_default_na=False)
+
+unique_rows, aliases, docked_names = [], [], {}
+stripped = 0
+for complex_name, protein_path, ligand_description in zip(df['complex_name'], df['protein_path'], df['ligand_description']):
+	try:
+		mol = read_ligand(ligand_description)
+	except Exception:
+		mol = None
+	## Compounds that can't be read are kept, inference.py will report them
+	if mol is None:
+		unique_rows.append((complex_name, protein_path, ligand_description))
+		continue
+
+	if args.strip_salts and len(Chem.GetMolFrags(mol)) > 1:
+		mol = get_largest_fragment(mol)
+		## The counterions are not docked, so the compound is docked from the SMILES of its largest fragment
+		ligand_description = Chem.MolToSmiles(Chem.RemoveHs(mol))
+		stripped += 1
+
+	key = (protein_path, get_ligand_key(mol))
+	if key in docked_names:
+		aliases.append((docked_names[key], complex_name))
+	else:
+		docked_names[key] = complex_name
+		unique_rows.append((complex_name, protein_path, ligand_description))
+
+pd.DataFrame(unique_rows, columns=['complex_name', 'protein_path', 'ligand_description']).to_csv(args.output_csv, sep=';', index=False)
+pd.DataFrame(aliases, columns=['complex_name', 'alias']).to_csv(args.alias_csv, sep=';', index=False)
+
+print(f"{len(df)} compounds, {len(unique_rows)} unique compounds will be docked and {len(aliases)} duplicates get their results through {args.alias_csv}")
+if args.strip_salts:
+	print(f"Removed the salts or solvents of {stripped} compounds")
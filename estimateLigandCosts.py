@@ -0,0 +1,60 @@
+## Estimates the relative docking cost of every compound from a cheap RDKit parse, so inferenceVS.py can give every job
+## about the same amount of work instead of the same number of compounds
+import os
+from argparse import ArgumentParser
+from multiprocessing import Pool
+
+import pandas as pd
+from rdkit import Chem, RDLogger
+from rdkit.Chem.rdMolDescriptors import CalcNumRotatableBonds
+
+from utils.ligand_library import LigandLibrary
+
+RDLogger.DisableLog('rdApp.*')
+
+parser = ArgumentParser()
+parser.add_argument('protein_ligand_csv', type=str, nargs='?', default=None, help='Path to a protein_ligand_csv file with the columns complex_name, protein_path and ligand_description')
+parser.add_argument('--ligand_library', type=str, default=None, help='Path to a multi-record .sdf, .sdf.gz, .smi or .smi.gz library, used instead of the protein_ligand_csv')
+parser.add_argument('--library_index', type=str, default=None, help='Path of the index of --ligand_library')
+parser.add_argument('--output_csv', type=str, required=True, help='Path where the complex_name and estimated cost of every compound are written to, in the input order')
+parser.add_argument('--cores', '-c', type=int, default=1, help='Number of processes that parse the compounds')
+args = parser.parse_args()
+
+## A compound that can't be read fails right away, it only costs the fixed part
+FIXED_COST = 20
+
+def estimate_cost(ligand_description):
+	## The fixed part per compound plus its heavy atoms and rotatable bonds, which set the size of the ligand graph and the
+	## work of the conformer generation and the torsion updates. Only the relative costs matter
+	try:
+		if '\n' in ligand_description:
+			mol = Chem.MolFromMolBlock(ligand_description, sanitize=False, removeHs=False)
+		else:
+			mol = Chem.MolFromSmiles(ligand_description, sanitize=False)
+			if mol is None and os.path.isfile(ligand_description):
+				if ligand_description.endswith('.mol2'):
+					mol = Chem.MolFromMol2File(ligand_description, sanitize=False, removeHs=False)
+				else:
+					mol = Chem.MolFromMolFile(ligand_description, sanitize=False, removeHs=False)
+		if mol is None:
+			return FIXED_COST
+		mol.UpdatePropertyCache(strict=False)
+		Chem.FastFindRings(mol)
+		return FIXED_COST + mol.GetNumHeavyAtoms() + 3 * CalcNumRotatableBonds(mol)
+	except Exception:
+		return FIXED_COST
+
+if args.ligand_library is not None:
+	library = LigandLibrary(args.ligand_library, args.library_index)
+	names = library.get_names()
+	descriptions = (library.get_record(idx) for idx in range(len(library)))
+else:
+	df = pd.read_csv(args.protein_ligand_csv, sep=None, engine="python", dtype=str, keep_default_na=False)
+	names = df['complex_name'].tolist()
+	descriptions = df['ligand_description'].tolist()
+
+with Pool(args.cores) as pool:
+	costs = list(pool.imap(estimate_cost, descriptions, chunksize=256))
+
+pd.DataFrame({'complex_name': names, 'cost': costs}).to_csv(args.output_csv, sep=';', index=False)
+print(f"Estimated the cost of {len(costs)} compounds")
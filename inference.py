@@ -4,7 +4,9 @@ import pprint
 import traceback
 from argparse import ArgumentParser, Namespace, FileType
 import copy
+import io
 import os
+import shlex
 from functools import partial
 import warnings
 from typing import Mapping, Optional
@@ -19,6 +21,7 @@ warnings.filterwarnings("ignore", message="invalid value encountered in cast")
 import numpy as np
 import pandas as pd
 import torch
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 
 from rdkit import RDLogger
@@ -29,11 +32,15 @@ from utils.logging_utils import configure_logger, get_logger
 import utils.utils
 from datasets.process_mols import write_mol_with_coords
 from utils.download import download_and_extract
-from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, get_t_schedule
-from utils.inference_utils import InferenceDataset, set_nones
+from utils.diffusion_utils import t_to_sigma as t_to_sigma_compl, get_t_schedule, DenoisingSchedule
+from utils.inference_utils import InferenceDataset, set_nones, get_file_hash, get_ligand_tasks, prepare_ligand_graphs
+from utils.ligand_library import LigandLibrary
+from utils.batching import copy_with_shared_receptor, has_shared_receptor
+from utils.prefetch import prefetch_map
 from utils.sampling import randomize_position, sampling
 from utils.utils import get_model
 from utils.visualise import PDBFile
+from utils.work_queue import WorkQueue
 from tqdm import tqdm
 
 if os.name != 'nt':  # The line does not work on Windows
@@ -64,12 +71,25 @@ def get_parser():
     parser.add_argument('--protein_path', type=str, default=None, help='Path to the protein file')
     parser.add_argument('--protein_sequence', type=str, default=None, help='Sequence of the protein for ESMFold, this is ignored if --protein_path is not None')
     parser.add_argument('--ligand_description', type=str, default='CCCCC(NC(=O)CCC(=O)O)P(=O)(O)OC1=CC=CC=C1', help='Either a SMILES string or the path to a molecule file that rdkit can read')
+    parser.add_argument('--ligand_library', type=str, default=None, help='Path to a multi-record .sdf, .sdf.gz, .smi or .smi.gz file whose records are docked against --protein_path. If this is not None, it will be used instead of --protein_ligand_csv and --ligand_description')
+    parser.add_argument('--library_index', type=str, default=None, help='Path of the byte-offset index of --ligand_library, it is built if it does not exist. Defaults to the library path with .idx appended')
+    parser.add_argument('--library_range', type=str, default=None, help='Only dock the records start:end (0-based, end excluded) of --ligand_library')
+    parser.add_argument('--work_queue', type=str, default=None, help='Directory of a work queue (see utils/work_queue.py) with batches of complexes. They are claimed and docked until the queue is empty, instead of --protein_ligand_csv or --library_range')
+    parser.add_argument('--queue_idle_timeout', type=float, default=0, help='Keep the models loaded and wait this many seconds for new batches when the --work_queue is empty, before the worker stops. Batches can be .args files with the inference.py arguments of a shard (its inputs and outputs), so one warm worker can dock the shards of many runs')
+    parser.add_argument('--queue_poll_interval', type=float, default=30, help='Seconds between the checks of the --work_queue for new or abandoned batches')
+    parser.add_argument('--queue_lease_time', type=float, default=1800, help='Seconds after which a batch that was claimed by a worker that stopped renewing its claim is put back in the work queue')
     parser.add_argument('--remove_output_hs', action='store_true', default=False, help='Remove the hydrogens in the final output structures')
     parser.add_argument('--seperate_dirs', action='store_true', default=False, help='Output the molecules per protein structure')
+    parser.add_argument('--ligand_aliases', type=str, default=None, help='Path to a .csv file with the columns complex_name and alias, as written by deduplicateLigands.py. Every alias gets the output structures of its complex_name')
     parser.add_argument('--cores', '-c', type=int, default=None, help='How many cores to use for each job. The default value is 1 when used with the GPU option enabled, otherwise it defaults to 4 cores')
 
     parser.add_argument('-l', '--log', '--loglevel', type=str, default='INFO', dest="loglevel", help='Log level. Default %(default)s')
     parser.add_argument('--esm_embeddings_path', type=str, default=None, help='If this is set then the LM embeddings at that path will be used for the receptor features')
+    parser.add_argument('--receptor_cache_dir', type=str, default=None, help='Directory with featurized receptor graphs and receptor embeddings that are shared between jobs. Missing receptors are added to it')
+    parser.add_argument('--ligand_cache_path', type=str, default=None, help='SQLite file with the prepared conformers and graphs of the ligands that is shared between runs and jobs. Missing ligands are added to it')
+    parser.add_argument('--prefetch_workers', type=int, default=0, help='Number of worker processes that prepare the upcoming ligands while the current ones are denoised. 0 prepares them in the main process')
+    parser.add_argument('--prefetch_depth', type=int, default=None, help='Maximum number of complexes that are prepared ahead, twice the number of workers by default')
+    parser.add_argument('--prefetch_unordered', action='store_true', default=False, help='Process the prepared complexes as soon as they are ready instead of in the input order')
 
     parser.add_argument('--out_dir', type=str, default='results/user_inference', help='Directory where the outputs will be written to')
     parser.add_argument('--save_visualisation', action='store_true', default=False, help='Save a pdb file with all of the steps of the reverse diffusion')
@@ -81,6 +101,8 @@ def get_parser():
     parser.add_argument('--confidence_ckpt', type=str, default='best_model.pt', help='Checkpoint to use for the confidence model')
 
     parser.add_argument('--batch_size', type=int, default=10, help='')
+    parser.add_argument('--pack_ligands', action='store_true', default=False, help='Denoise the poses of several ligands of the same receptor together, in batches of up to --batch_size poses')
+    parser.add_argument('--max_batch_atoms', type=int, default=None, help='Maximum number of ligand atoms in a batch of packed ligands')
     parser.add_argument('--no_final_step_noise', action='store_true', default=True, help='Use no noise in the final step of the reverse diffusion')
     parser.add_argument('--inference_steps', type=int, default=20, help='Number of denoising steps')
     parser.add_argument('--actual_steps', type=int, default=None, help='Number of denoising steps that are actually performed')
@@ -110,6 +132,106 @@ def get_parser():
     return parser
 
 
+def write_predictions(args, score_model_args, confidence_args, test_dataset, idx, orig_complex_graph, data_list, confidence,
+                      visualization_list, aliases=()):
+    lig = orig_complex_graph.mol[0]
+    ligand_pos = np.asarray([complex_graph['ligand'].pos.cpu().numpy() + orig_complex_graph.original_center.cpu().numpy() for complex_graph in data_list])
+
+    # reorder predictions based on confidence output
+    if confidence is not None and isinstance(confidence_args.rmsd_classification_cutoff, list):
+        confidence = confidence[:, 0]
+    if confidence is not None:
+        confidence = confidence.cpu().numpy()
+        re_order = np.argsort(confidence)[::-1]
+        confidence = confidence[re_order]
+        ligand_pos = ligand_pos[re_order]
+
+    # save predictions
+    ## The duplicates of this compound in the library (see deduplicateLigands.py) get the same poses under their own name
+    for molName in [test_dataset.complex_names[idx]] + list(aliases):
+        for rank, pos in enumerate(ligand_pos):
+            mol_pred = copy.deepcopy(lig)
+            if score_model_args.remove_hs: mol_pred = RemoveAllHs(mol_pred)
+
+            ## Add MolName and Confidence as properties
+            mol_pred.SetProp("DiffDock_Confidence", f"{confidence[rank]:.2f}")
+            mol_pred.SetProp("_Name", str(molName))
+
+            ## Write the outputfile
+            if args.seperate_dirs:
+                protein_name = os.path.basename(test_dataset.protein_files[idx]).split('.')[0]
+            else:
+                protein_name = ""
+            write_mol_with_coords(mol_pred, pos, os.path.join(args.out_dir, protein_name, f'VS_DD_{molName}_rank{rank+1}_confidence{confidence[rank]:.2f}.sdf'), args.remove_output_hs)
+
+
+    # save visualisation frames
+    if args.save_visualisation:
+        if confidence is not None:
+            for rank, batch_idx in enumerate(re_order):
+                visualization_list[batch_idx].write(os.path.join(write_dir, f'rank{rank+1}_reverseprocess.pdb'))
+        else:
+            for rank, batch_idx in enumerate(ligand_pos):
+                visualization_list[batch_idx].write(os.path.join(write_dir, f'rank{rank+1}_reverseprocess.pdb'))
+
+
+def get_inputs(args, protein_ligand_csv=None, library_range=None):
+    # the complex names, protein files, protein sequences and ligand descriptions of the complexes to dock, from a
+    # ligand library, a protein_ligand_csv (a path or a file object) or the single complex of the arguments
+    if args.ligand_library is not None:
+        start, end = library_range.split(':') if library_range else ('', '')
+        ligand_description_list = LigandLibrary(args.ligand_library, args.library_index, start=int(start or 0),
+                                                end=int(end) if end else None)
+        complex_name_list = ligand_description_list.get_names()
+        protein_path_list = [args.protein_path] * len(complex_name_list)
+        protein_sequence_list = [None] * len(complex_name_list)
+    elif protein_ligand_csv is not None:
+        df = pd.read_csv(protein_ligand_csv, sep=None, engine="python")
+    
+        complex_name_list = set_nones(df['complex_name'].tolist())
+        protein_path_list = set_nones(df['protein_path'].tolist())
+        ligand_description_list = set_nones(df['ligand_description'].tolist())
+    
+        ## We don't use protein sequences, but it is still a mandatory input variable
+        protein_sequence_list = [None]*len(complex_name_list)
+    else:
+        complex_name_list = [args.complex_name if args.complex_name else f"complex_0"]
+        protein_path_list = [args.protein_path]
+        protein_sequence_list = [args.protein_sequence]
+        ligand_description_list = [args.ligand_description]
+
+    complex_name_list = [name if name is not None else f"complex_{i}" for i, name in enumerate(complex_name_list)]
+    return complex_name_list, protein_path_list, protein_sequence_list, ligand_description_list
+
+
+def read_ligand_aliases(ligand_aliases_path):
+    ligand_aliases = {}
+    if ligand_aliases_path is not None:
+        alias_df = pd.read_csv(ligand_aliases_path, sep=None, engine="python")
+        for name, alias in zip(alias_df['complex_name'].tolist(), alias_df['alias'].tolist()):
+            ligand_aliases.setdefault(name, []).append(alias)
+    return ligand_aliases
+
+
+# the options that a shard of a --work_queue (an .args item) sets, the other options are the ones of the worker
+SHARD_OPTIONS = ('protein_ligand_csv', 'complex_name', 'protein_path', 'protein_sequence', 'ligand_description',
+                 'ligand_library', 'library_index', 'library_range', 'out_dir', 'ligand_aliases', 'remove_output_hs',
+                 'seperate_dirs', 'esm_embeddings_path', 'samples_per_complex', 'save_visualisation')
+
+
+def get_shard_args(args, shard_arguments):
+    # the arguments of the worker with the inputs and outputs of the shard, shard_arguments are inference.py arguments
+    parser = get_parser()
+    shard_args = copy.copy(args)
+    for option in SHARD_OPTIONS:
+        setattr(shard_args, option, parser.get_default(option))
+    parser.parse_args(shlex.split(shard_arguments), namespace=shard_args)
+    changed = [key for key, value in vars(shard_args).items() if key not in SHARD_OPTIONS and value != getattr(args, key)]
+    if changed:
+        raise ValueError(f"A shard can only set the options {', '.join(SHARD_OPTIONS)}, not {', '.join(changed)}")
+    return shard_args
+
+
 def main(args):
 
     beginTime = time.time()
@@ -165,51 +287,6 @@ def main(args):
         logger.warning("Something went wrong when specifying the requested number of threads, a different amount of resources might be used..")
         logger.info(f"DiffDock will run on {device}")
 
-    if args.protein_ligand_csv is not None:
-        df = pd.read_csv(args.protein_ligand_csv, sep=None, engine="python")
-    
-        complex_name_list = set_nones(df['complex_name'].tolist())
-        protein_path_list = set_nones(df['protein_path'].tolist())
-        ligand_description_list = set_nones(df['ligand_description'].tolist())
-    
-        ## We don't use protein sequences, but it is still a mandatory input variable
-        protein_sequence_list = [None]*len(complex_name_list)
-    else:
-        complex_name_list = [args.complex_name if args.complex_name else f"complex_0"]
-        protein_path_list = [args.protein_path]
-        protein_sequence_list = [args.protein_sequence]
-        ligand_description_list = [args.ligand_description]
-
-    complex_name_list = [name if name is not None else f"complex_{i}" for i, name in enumerate(complex_name_list)]
-
-    # preprocessing of complexes into geometric graphs
-    test_dataset = InferenceDataset(out_dir=args.out_dir, complex_names=complex_name_list, protein_files=protein_path_list,
-                                    ligand_descriptions=ligand_description_list, protein_sequences=protein_sequence_list,
-                                    lm_embeddings=True,
-                                    receptor_radius=score_model_args.receptor_radius, remove_hs=score_model_args.remove_hs,
-                                    c_alpha_max_neighbors=score_model_args.c_alpha_max_neighbors,
-                                    all_atoms=score_model_args.all_atoms, atom_radius=score_model_args.atom_radius,
-                                    atom_max_neighbors=score_model_args.atom_max_neighbors,
-                                    precomputed_lm_embeddings=args.esm_embeddings_path,
-                                    knn_only_graph=False if not hasattr(score_model_args, 'not_knn_only_graph') else not score_model_args.not_knn_only_graph)
-    test_loader = DataLoader(dataset=test_dataset, batch_size=1, shuffle=False)
-
-    if args.confidence_model_dir is not None and not confidence_args.use_original_model_cache:
-        logger.info('Confidence model uses different type of graphs than the score model. '
-                    'Loading (or creating if not existing) the data for the confidence model now.')
-        confidence_test_dataset = \
-            InferenceDataset(out_dir=args.out_dir, complex_names=complex_name_list, protein_files=protein_path_list,
-                             ligand_descriptions=ligand_description_list, protein_sequences=protein_sequence_list,
-                             lm_embeddings=True,
-                             receptor_radius=confidence_args.receptor_radius, remove_hs=confidence_args.remove_hs,
-                             c_alpha_max_neighbors=confidence_args.c_alpha_max_neighbors,
-                             all_atoms=confidence_args.all_atoms, atom_radius=confidence_args.atom_radius,
-                             atom_max_neighbors=confidence_args.atom_max_neighbors,
-                             precomputed_lm_embeddings=test_dataset.lm_embeddings,
-                             knn_only_graph=False if not hasattr(score_model_args, 'not_knn_only_graph') else not score_model_args.not_knn_only_graph)
-    else:
-        confidence_test_dataset = None
-
     t_to_sigma = partial(t_to_sigma_compl, args=score_model_args)
 
     model = get_model(score_model_args, device, t_to_sigma=t_to_sigma, no_parallel=True, old=args.old_score_model)
@@ -217,6 +294,10 @@ def main(args):
     model.load_state_dict(state_dict, strict=True)
     model = model.to(device)
     model.eval()
+    if hasattr(model, 'enable_receptor_cache'):
+        # the receptor embedding only has to be computed once per receptor, it is stored next to the receptor graphs
+        model.enable_receptor_cache(cache_dir=args.receptor_cache_dir,
+                                    model_key=get_file_hash(f'{args.model_dir}/{args.ckpt}') if args.receptor_cache_dir else None)
 
     if args.confidence_model_dir is not None:
         confidence_model = get_model(confidence_args, device, t_to_sigma=t_to_sigma, no_parallel=True,
@@ -230,104 +311,205 @@ def main(args):
         confidence_args = None
 
     tr_schedule = get_t_schedule(inference_steps=args.inference_steps, sigma_schedule='expbeta')
-
-    failures, skipped = 0, 0
-    N = args.samples_per_complex
-    test_ds_size = len(test_dataset)
-    logger.info(f'Size of test dataset: {test_ds_size}')
-    for idx, orig_complex_graph in tqdm(enumerate(test_loader), total=len(test_loader), ascii=True):
-        if not orig_complex_graph.success[0]:
-            skipped += 1
-            logger.warning(f"The test dataset did not contain {test_dataset.complex_names[idx]} for {test_dataset.ligand_descriptions[idx]} and {test_dataset.protein_files[idx]}. We are skipping this complex.")
-            continue
-        try:
-            if confidence_test_dataset is not None:
-                confidence_complex_graph = confidence_test_dataset[idx]
-                if not confidence_complex_graph.success:
-                    skipped += 1
-                    logger.warning(f"The confidence dataset did not contain {orig_complex_graph.name}. We are skipping this complex.")
+    # the scalars of every denoising step, the same for all complexes and shards of the run
+    denoising_schedule = DenoisingSchedule(args.actual_steps if args.actual_steps is not None else args.inference_steps,
+                                           tr_schedule, tr_schedule, tr_schedule, t_to_sigma, score_model_args,
+                                           no_final_step_noise=args.no_final_step_noise,
+                                           temp_sampling=[args.temp_sampling_tr, args.temp_sampling_rot, args.temp_sampling_tor],
+                                           temp_psi=[args.temp_psi_tr, args.temp_psi_rot, args.temp_psi_tor],
+                                           temp_sigma_data=[args.temp_sigma_data_tr, args.temp_sigma_data_rot,
+                                                            args.temp_sigma_data_tor])
+
+    # the datasets of the first batch, the datasets of the later batches reuse the receptors that they featurized
+    shared_datasets = {}
+
+    def dock(args, complex_name_list, protein_path_list, protein_sequence_list, ligand_description_list):
+        # docks the complexes with the inputs and outputs of args and writes their predictions, returns the number of
+        # complexes, failures and skipped ones
+        failures, skipped = 0, 0
+        N = args.samples_per_complex
+        ligand_aliases = read_ligand_aliases(args.ligand_aliases)
+
+        # preprocessing of complexes into geometric graphs
+        test_dataset = InferenceDataset(out_dir=args.out_dir, complex_names=complex_name_list, protein_files=protein_path_list,
+                                        ligand_descriptions=ligand_description_list, protein_sequences=protein_sequence_list,
+                                        lm_embeddings=True,
+                                        receptor_radius=score_model_args.receptor_radius, remove_hs=score_model_args.remove_hs,
+                                        c_alpha_max_neighbors=score_model_args.c_alpha_max_neighbors,
+                                        all_atoms=score_model_args.all_atoms, atom_radius=score_model_args.atom_radius,
+                                        atom_max_neighbors=score_model_args.atom_max_neighbors,
+                                        precomputed_lm_embeddings=args.esm_embeddings_path,
+                                        knn_only_graph=False if not hasattr(score_model_args, 'not_knn_only_graph') else not score_model_args.not_knn_only_graph,
+                                        receptor_cache_dir=args.receptor_cache_dir, ligand_cache_path=args.ligand_cache_path)
+        test_dataset.share_receptor_cache(shared_datasets.setdefault('score', test_dataset))
+        test_loader = DataLoader(dataset=test_dataset, batch_size=1, shuffle=False)
+
+        if args.confidence_model_dir is not None and not confidence_args.use_original_model_cache:
+            logger.info('Confidence model uses different type of graphs than the score model. '
+                        'Loading (or creating if not existing) the data for the confidence model now.')
+            confidence_test_dataset = \
+                InferenceDataset(out_dir=args.out_dir, complex_names=complex_name_list, protein_files=protein_path_list,
+                                 ligand_descriptions=ligand_description_list, protein_sequences=protein_sequence_list,
+                                 lm_embeddings=True,
+                                 receptor_radius=confidence_args.receptor_radius, remove_hs=confidence_args.remove_hs,
+                                 c_alpha_max_neighbors=confidence_args.c_alpha_max_neighbors,
+                                 all_atoms=confidence_args.all_atoms, atom_radius=confidence_args.atom_radius,
+                                 atom_max_neighbors=confidence_args.atom_max_neighbors,
+                                 precomputed_lm_embeddings=test_dataset.lm_embeddings,
+                                 knn_only_graph=False if not hasattr(score_model_args, 'not_knn_only_graph') else not score_model_args.not_knn_only_graph,
+                                 receptor_cache_dir=args.receptor_cache_dir, ligand_cache_path=args.ligand_cache_path)
+            confidence_test_dataset.share_receptor_cache(shared_datasets.setdefault('confidence', confidence_test_dataset))
+        else:
+            confidence_test_dataset = None
+
+        logger.info(f'Size of test dataset: {len(test_dataset)}')
+
+        def process_complexes(complexes):
+            # runs the reverse diffusion for the poses of all complexes together and writes the predictions of every complex
+            nonlocal failures
+            try:
+                data_list = [graph for complex in complexes for graph in complex['data_list']]
+                confidence_data_list = [graph for complex in complexes for graph in complex['confidence_data_list']] \
+                    if complexes[0]['confidence_data_list'] is not None else None
+                visualization_list = [pdb for complex in complexes for pdb in complex['visualization_list']] \
+                    if args.save_visualisation else None
+
+                data_list, confidence = sampling(data_list=data_list, model=model,
+                                                 inference_steps=len(denoising_schedule),
+                                                 tr_schedule=tr_schedule, rot_schedule=tr_schedule, tor_schedule=tr_schedule,
+                                                 device=device, t_to_sigma=t_to_sigma, model_args=score_model_args,
+                                                 visualization_list=visualization_list, confidence_model=confidence_model,
+                                                 confidence_data_list=confidence_data_list, confidence_model_args=confidence_args,
+                                                 batch_size=args.batch_size, denoising_schedule=denoising_schedule)
+            except Exception as e:
+                logger.warning(f"Failed on {[complex['graph']['name'] for complex in complexes]}: {e}")
+                failures += len(complexes)
+                return
+
+            # every complex gets back its own N poses
+            for i, complex in enumerate(complexes):
+                try:
+                    write_predictions(args, score_model_args, confidence_args, test_dataset, complex['idx'], complex['graph'],
+                                      data_list[i * N:(i + 1) * N], confidence[i * N:(i + 1) * N] if confidence is not None else None,
+                                      visualization_list[i * N:(i + 1) * N] if visualization_list is not None else None,
+                                      ligand_aliases.get(test_dataset.complex_names[complex['idx']], ()))
+                except Exception as e:
+                    logger.warning(f"Failed on {complex['graph']['name']}: {e}")
+                    failures += 1
+
+        def get_complexes():
+            # yields the index, the complex graph collated like by the test_loader and, if it was prefetched, the confidence
+            # complex graph of every complex. The ligands are prepared by the worker processes, the receptors are shared
+            # between complexes and added in the main process. A worker failure is yielded in place of the complex graph
+            if args.prefetch_workers <= 0:
+                for idx, orig_complex_graph in enumerate(test_loader):
+                    yield idx, orig_complex_graph, None
+                return
+            datasets = [test_dataset] + ([confidence_test_dataset] if confidence_test_dataset is not None else [])
+            for (idx, _), graphs in prefetch_map(prepare_ligand_graphs, get_ligand_tasks(datasets), args.prefetch_workers,
+                                                 depth=args.prefetch_depth, ordered=not args.prefetch_unordered):
+                if isinstance(graphs, Exception):
+                    yield idx, graphs, None
                     continue
-                confidence_data_list = [copy.deepcopy(confidence_complex_graph) for _ in range(N)]
-            else:
-                confidence_data_list = None
-            data_list = [copy.deepcopy(orig_complex_graph) for _ in range(N)]
-            randomize_position(data_list, score_model_args.no_torsion, False, score_model_args.tr_sigma_max,
-                               initial_noise_std_proportion=args.initial_noise_std_proportion,
-                               choose_residue=args.choose_residue)
-
-            lig = orig_complex_graph.mol[0]
-
-            # initialize visualisation
-            pdb = None
-            if args.save_visualisation:
-                visualization_list = []
-                for graph in data_list:
-                    pdb = PDBFile(lig)
-                    pdb.add(lig, 0, 0)
-                    pdb.add((orig_complex_graph['ligand'].pos + orig_complex_graph.original_center).detach().cpu(), 1, 0)
-                    pdb.add((graph['ligand'].pos + graph.original_center).detach().cpu(), part=1, order=1)
-                    visualization_list.append(pdb)
-            else:
-                visualization_list = None
-
-            # run reverse diffusion
-            data_list, confidence = sampling(data_list=data_list, model=model,
-                                             inference_steps=args.actual_steps if args.actual_steps is not None else args.inference_steps,
-                                             tr_schedule=tr_schedule, rot_schedule=tr_schedule, tor_schedule=tr_schedule,
-                                             device=device, t_to_sigma=t_to_sigma, model_args=score_model_args,
-                                             visualization_list=visualization_list, confidence_model=confidence_model,
-                                             confidence_data_list=confidence_data_list, confidence_model_args=confidence_args,
-                                             batch_size=args.batch_size, no_final_step_noise=args.no_final_step_noise,
-                                             temp_sampling=[args.temp_sampling_tr, args.temp_sampling_rot,
-                                                            args.temp_sampling_tor],
-                                             temp_psi=[args.temp_psi_tr, args.temp_psi_rot, args.temp_psi_tor],
-                                             temp_sigma_data=[args.temp_sigma_data_tr, args.temp_sigma_data_rot,
-                                                              args.temp_sigma_data_tor])
-
-            ligand_pos = np.asarray([complex_graph['ligand'].pos.cpu().numpy() + orig_complex_graph.original_center.cpu().numpy() for complex_graph in data_list])
-
-            # reorder predictions based on confidence output
-            if confidence is not None and isinstance(confidence_args.rmsd_classification_cutoff, list):
-                confidence = confidence[:, 0]
-            if confidence is not None:
-                confidence = confidence.cpu().numpy()
-                re_order = np.argsort(confidence)[::-1]
-                confidence = confidence[re_order]
-                ligand_pos = ligand_pos[re_order]
-
-            # save predictions
-            molName = test_dataset.complex_names[idx]
-            for rank, pos in enumerate(ligand_pos):
-                mol_pred = copy.deepcopy(lig)
-                if score_model_args.remove_hs: mol_pred = RemoveAllHs(mol_pred)
-
-                ## Add MolName and Confidence as properties
-                mol_pred.SetProp("DiffDock_Confidence", f"{confidence[rank]:.2f}")
-                mol_pred.SetProp("_Name", molName)
-
-                ## Write the outputfile
-                if args.seperate_dirs:
-                    protein_name = os.path.basename(test_dataset.protein_files[idx]).split('.')[0]
+                graphs = [dataset.add_receptor_graph(graph, idx) for dataset, graph in zip(datasets, graphs)]
+                yield idx, Batch.from_data_list(graphs[:1]), graphs[1] if len(graphs) > 1 else None
+
+        pending, pending_atoms = [], 0
+        for idx, orig_complex_graph, confidence_complex_graph in tqdm(get_complexes(), total=len(test_loader), ascii=True):
+            if isinstance(orig_complex_graph, Exception):
+                logger.warning(f"Failed on {test_dataset.complex_names[idx]}: {orig_complex_graph}")
+                failures += 1
+                continue
+            if not orig_complex_graph.success[0]:
+                skipped += 1
+                logger.warning(f"The test dataset did not contain {test_dataset.complex_names[idx]} for {test_dataset.ligand_descriptions[idx]} and {test_dataset.protein_files[idx]}. We are skipping this complex.")
+                continue
+            try:
+                if confidence_test_dataset is not None:
+                    if confidence_complex_graph is None:
+                        confidence_complex_graph = confidence_test_dataset[idx]
+                    if not confidence_complex_graph.success:
+                        skipped += 1
+                        logger.warning(f"The confidence dataset did not contain {orig_complex_graph.name}. We are skipping this complex.")
+                        continue
+                    confidence_data_list = [copy_with_shared_receptor(confidence_complex_graph) for _ in range(N)]
                 else:
-                    protein_name = ""
-                write_mol_with_coords(mol_pred, pos, os.path.join(args.out_dir, protein_name, f'VS_DD_{molName}_rank{rank+1}_confidence{confidence[rank]:.2f}.sdf'), args.remove_output_hs)
-
-
-            # save visualisation frames
-            if args.save_visualisation:
-                if confidence is not None:
-                    for rank, batch_idx in enumerate(re_order):
-                        visualization_list[batch_idx].write(os.path.join(write_dir, f'rank{rank+1}_reverseprocess.pdb'))
+                    confidence_data_list = None
+                data_list = [copy_with_shared_receptor(orig_complex_graph) for _ in range(N)]
+                randomize_position(data_list, score_model_args.no_torsion, False, score_model_args.tr_sigma_max,
+                                   initial_noise_std_proportion=args.initial_noise_std_proportion,
+                                   choose_residue=args.choose_residue)
+
+                lig = orig_complex_graph.mol[0]
+
+                # initialize visualisation
+                pdb = None
+                if args.save_visualisation:
+                    visualization_list = []
+                    for graph in data_list:
+                        pdb = PDBFile(lig)
+                        pdb.add(lig, 0, 0)
+                        pdb.add((orig_complex_graph['ligand'].pos + orig_complex_graph.original_center).detach().cpu(), 1, 0)
+                        pdb.add((graph['ligand'].pos + graph.original_center).detach().cpu(), part=1, order=1)
+                        visualization_list.append(pdb)
                 else:
-                    for rank, batch_idx in enumerate(ligand_pos):
-                        visualization_list[batch_idx].write(os.path.join(write_dir, f'rank{rank+1}_reverseprocess.pdb'))
-
-        except Exception as e:
-            logger.warning("Failed on", orig_complex_graph["name"], e)
-            failures += 1
+                    visualization_list = None
+            except Exception as e:
+                logger.warning(f"Failed on {orig_complex_graph['name']}: {e}")
+                failures += 1
+                continue
+
+            # with --pack_ligands the poses of consecutive ligands of the same receptor are denoised in the same batches,
+            # as long as they fit in --batch_size poses and --max_batch_atoms ligand atoms
+            num_atoms = N * orig_complex_graph['ligand'].num_nodes
+            if pending and (not args.pack_ligands or N * (len(pending) + 1) > args.batch_size
+                            or (args.max_batch_atoms is not None and pending_atoms + num_atoms > args.max_batch_atoms)
+                            or not has_shared_receptor([pending[0]['graph'], orig_complex_graph])):
+                process_complexes(pending)
+                pending, pending_atoms = [], 0
+            pending.append({'idx': idx, 'graph': orig_complex_graph, 'data_list': data_list,
+                            'confidence_data_list': confidence_data_list, 'visualization_list': visualization_list})
+            pending_atoms += num_atoms
+        if pending:
+            process_complexes(pending)
+
+        return len(test_dataset), failures, skipped
+
+    if args.work_queue is None:
+        test_ds_size, failures, skipped = dock(args, *get_inputs(args, args.protein_ligand_csv, args.library_range))
+    else:
+        # pull batches of complexes from the shared queue until it is empty (and no new batches came for
+        # --queue_idle_timeout seconds), the models are only loaded once
+        test_ds_size, failures, skipped = 0, 0, 0
+        queue = WorkQueue(args.work_queue, lease_time=args.queue_lease_time)
+        for item in queue.work(poll_interval=args.queue_poll_interval, idle_timeout=args.queue_idle_timeout):
+            logger.info(f'Docking the batch {item} of the work queue')
+            batch_args = args
+            try:
+                if item.endswith('.args'):
+                    # a shard with its own inputs and outputs, like the jobs of inferenceVS.py --warm_queue
+                    batch_args = get_shard_args(args, queue.read(item))
+                    os.makedirs(batch_args.out_dir, exist_ok=True)
+                    inputs = get_inputs(batch_args, batch_args.protein_ligand_csv, batch_args.library_range)
+                elif item.endswith('.range'):
+                    inputs = get_inputs(args, library_range=queue.read(item).strip())
+                else:
+                    inputs = get_inputs(args, protein_ligand_csv=io.StringIO(queue.read(item)))
+            except (Exception, SystemExit) as e:
+                # argparse exits on invalid arguments, that must not stop the worker
+                logger.error(f'Could not read the batch {item} of the work queue: {e}')
+                continue
+            try:
+                batch_size, batch_failures, batch_skipped = dock(batch_args, *inputs)
+            except (Exception, SystemExit) as e:
+                # e.g. a missing ligand_aliases or esm_embeddings_path of a shard, the item is still marked done, else
+                # it would stop every worker that takes it after its lease expired
+                logger.error(f'Failed to dock the batch {item} of the work queue: {e}')
+                batch_size, batch_failures, batch_skipped = len(inputs[0]), len(inputs[0]), 0
+            test_ds_size, failures, skipped = test_ds_size + batch_size, failures + batch_failures, skipped + batch_skipped
 
     result_msg = f"""
-    {test_ds_size-failures-skipped} out of {test_ds_size} ({100*(test_ds_size-skipped-failures)/test_ds_size:.2f}%) complexes were succesfully processed. (Failed for {failures} complexes, Skipped {skipped} complexes)"""
+    {test_ds_size-failures-skipped} out of {test_ds_size} ({100*(test_ds_size-skipped-failures)/max(test_ds_size, 1):.2f}%) complexes were succesfully processed. (Failed for {failures} complexes, Skipped {skipped} complexes)"""
     
     if failures or skipped:
         logger.warning(result_msg)
@@ -20,10 +20,14 @@ import glob
 import argparse
 from argparse import ArgumentParser, FileType
 
+from utils.ligand_library import LigandLibrary, get_library_index_path, is_ligand_library
+from utils.sharding import get_shard_costs, read_ligand_costs, split_by_cost, split_contiguous_by_cost
+from utils.work_queue import WorkQueue
+
 parser = ArgumentParser()
   
 parser.add_argument('--protein_path', '-r', '-p', type=str, default='', help='Path to the protein/receptor .pdb file')
-parser.add_argument('--ligand', '-l', type=str, default='', help='The path to the directory of (separate) mol2/sdf ligand files')
+parser.add_argument('--ligand', '-l', type=str, default='', help='The path to the directory of (separate) mol2/sdf ligand files, or to a multi-record .sdf, .sdf.gz, .smi or .smi.gz library file')
 parser.add_argument('--protein_ligand_csv', type=str, default='', help='The path to a protein_ligand_csv file. Format and header should be like the following: complex_name,protein_path,ligand_description')
 parser.add_argument('--out_dir', '-out', '-o', required=True,type=str, default='', help='Directory where the output structures will be saved to')
 parser.add_argument('--jobs', '-j', required=True, type=int, default=1, help='Number of jobs to use')
@@ -35,6 +39,22 @@ parser.add_argument('--cores', '-c', type=int, default=None, help='How many core
 parser.add_argument('--num_outputs', '-n', type=int, default=1, help='How many structures to output per compound. The default value is 1')
 parser.add_argument('--remove_hs', action='store_true', default=False, help='Remove the hydrogens in the final output structures')
 parser.add_argument('--no_slurm', '-ns', action='store_true', default=False, help='Don\'t use slurm to handle the resources. This will run all samples on 1 GPU. Other Slurm arguments such as the amount memory, time limit, ... will also be ignored')
+parser.add_argument('--receptor_cache_dir', type=str, default='data/receptor_graphs/', help='Directory where the featurized receptor graphs are stored and shared between jobs. Set it to an empty string to disable the cache')
+parser.add_argument('--ligand_cache_path', type=str, default='', help='SQLite file where the prepared conformers and graphs of the compounds are stored and reused by later runs. Disabled by default')
+parser.add_argument('--pack_ligands', action='store_true', default=False, help='Denoise the poses of several compounds together in one batch instead of one compound at a time')
+parser.add_argument('--batch_size', type=int, default=10, help='Maximum number of poses in one batch when --pack_ligands is used')
+parser.add_argument('--prefetch_workers', type=int, default=0, help='Number of extra processes per job that prepare the upcoming compounds while the current ones are denoised')
+parser.add_argument('--deduplicate', action='store_true', default=False, help='Dock every unique compound (by canonical SMILES) of the library once and write its results for all of its names')
+parser.add_argument('--strip_salts', action='store_true', default=False, help='With --deduplicate, only dock the largest fragment of every compound so that its salts and solvates count as duplicates')
+parser.add_argument('--balance_jobs', action='store_true', default=False, help='Estimate the cost of every compound from its heavy atoms and rotatable bonds and give every job about the same total cost instead of the same number of compounds')
+parser.add_argument('--work_queue', action='store_true', default=False, help='Put the compounds in small batches in a queue in the output directory that all jobs pull from until it is empty, instead of giving every job a fixed share. A batch of a job that dies is taken over by the other jobs. With --no_slurm, --jobs local workers are started')
+parser.add_argument('--queue_batch_size', type=int, default=50, help='Number of compounds in one batch of the --work_queue')
+parser.add_argument('--warm_queue', type=str, default='', help='Work queue directory of long-lived DiffDock workers that keep their models loaded. The jobs are added to it as shards instead of being launched, so the workers that run (or are started with --warm_workers) dock them without the startup cost of a new job')
+parser.add_argument('--warm_workers', type=int, default=0, help='With --warm_queue, the number of warm workers to launch (like the jobs) on the queue')
+parser.add_argument('--worker_idle_timeout', type=int, default=1800, help='Seconds that a warm worker waits for new shards when the --warm_queue is empty, before it stops')
+parser.add_argument('--array', action='store_true', default=False, help='Submit all jobs as one Slurm job array instead of one sbatch submission per job. Every task of the array docks the share of its SLURM_ARRAY_TASK_ID')
+parser.add_argument('--array_max_concurrent', type=int, default=0, help='With --array, the maximum number of tasks of the array that run at the same time. The default value 0 doesn\'t set a limit')
+parser.add_argument('--sbatch', type=str, default='sbatch', help='Command used to submit the jobs. To test the submission without a cluster, use "python utils/fake_sbatch.py", which runs the jobs on this machine')
 parser.add_argument('--config', default='default_inference_args.yaml')
 
 args = parser.parse_args()
@@ -62,10 +82,13 @@ else:
 	if not os.path.isfile(args.protein_path):
 		print(f"Error: --protein_path '{args.protein_path}' does not exist or is not a file")
 		sys.exit(1)
-	elif not os.path.isdir(args.ligand):
-		print(f"Error: --ligand '{args.ligand}' does not exist or is not a directory")
+	elif not os.path.isdir(args.ligand) and not (os.path.isfile(args.ligand) and is_ligand_library(args.ligand)):
+		print(f"Error: --ligand '{args.ligand}' does not exist or is not a directory or a .sdf, .sdf.gz, .smi or .smi.gz library")
 		sys.exit(1)
 		
+if args.work_queue and args.warm_queue:
+	sys.exit("--work_queue and --warm_queue can't be combined, use more --jobs to get smaller shards for the warm workers")
+
 ## Check if the config file exists and is a yml file
 if not os.path.isfile(args.config):
 	sys.exit(f"The input config file {args.config} doesn't seem to exist. Please make sure the path is right and try again.")
@@ -77,8 +100,8 @@ if args.cores is None:
 	else:
 		args.cores = 4
 		
-## If --no_slurm is set, always only use 1 job
-if args.no_slurm:
+## If --no_slurm is set, always only use 1 job (or --jobs local workers of the work queue, or --jobs shards for the warm workers)
+if args.no_slurm and not args.work_queue and not args.warm_queue:
 	args.jobs = 1
 	
 if args.time == "":
@@ -96,6 +119,22 @@ if args.remove_hs == True:
 
 seperate_dirs_arg = ""
 
+receptor_cache_arg = ""
+if not args.receptor_cache_dir == "":
+	receptor_cache_arg = f" --receptor_cache_dir {args.receptor_cache_dir}"
+
+ligand_cache_arg = ""
+if not args.ligand_cache_path == "":
+	ligand_cache_arg = f" --ligand_cache_path {args.ligand_cache_path}"
+
+pack_ligands_arg = ""
+if args.pack_ligands:
+	pack_ligands_arg = f" --pack_ligands --batch_size {args.batch_size}"
+
+prefetch_arg = ""
+if args.prefetch_workers > 0:
+	prefetch_arg = f" --prefetch_workers {args.prefetch_workers}"
+
 outputPath, outputDirName = os.path.split(args.out_dir)
 
 currentDateNow = datetime.datetime.now()
@@ -131,6 +170,17 @@ def split(a, n):
     k, m = divmod(len(a), n)
     return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
 
+## Estimates the relative cost of every compound in the container, and writes them to ligand_costs.csv
+def estimate_costs(inputArg):
+	costResult = subprocess.run(f"singularity run --bind $PWD singularity/DiffDockHPC.sif python -u estimateLigandCosts.py {inputArg} --output_csv {outputDir}/ligand_costs.csv -c {args.cores}", shell=True)
+	if costResult.returncode != 0:
+		sys.exit("Something went wrong while estimating the cost of the compounds, run again without --balance_jobs to split them by count")
+	return read_ligand_costs(f"{outputDir}/ligand_costs.csv")[1]
+
+def print_balance(costs, shards):
+	countShards = list(split(range(len(costs)), args.jobs))
+	print(f"Estimated cost of the most expensive job: {max(get_shard_costs(costs, shards)):.0f} instead of {max(get_shard_costs(costs, countShards)):.0f} when split by count (average {sum(costs) / len(shards):.0f})")
+
 ESM_Embedding_arg = ""
 
 if args.protein_ligand_csv == "":
@@ -153,22 +203,42 @@ if args.protein_ligand_csv == "":
 		if args.gpu == True:
 			nvArgument = "--nv"
 		subprocess.run(f"singularity run {nvArgument} --bind $PWD singularity/DiffDockHPC.sif python -u proteinEmbedding.py {args.protein_path}", shell=True)
-	
-	## Get the ligand files and write protein_ligand_csvs
-	ligandPaths = glob.glob(f"{args.ligand}/*.sdf") + glob.glob(f"{args.ligand}/*.mol2")
-	ligandPathsSplit = list(split(ligandPaths, args.jobs))
 
-	## Write the globbed ligands to protein_ligand_csvs in the jobs dir
-	for i, jobLigands in enumerate(ligandPathsSplit):
-		csvFilePath = f"{outputDir}/csvs/job_csv_{str(i+1)}.csv"
-		with open(csvFilePath, 'w') as jobCSV:
-			jobCSV.write("complex_name;protein_path;ligand_description\n")
-			for jobLigand in jobLigands:
-				complexName = os.path.basename(jobLigand).split('.')[0]
-				jobCSV.write(f"{complexName};{args.protein_path};{jobLigand}\n")
-			jobCSV.close()
+	## Featurize the receptor once, so the jobs can load it from the receptor cache instead of parsing the protein again
+	if not args.receptor_cache_dir == "":
+		subprocess.run(f"singularity run --bind $PWD singularity/DiffDockHPC.sif python -u receptorGraph.py {args.protein_path} --esm_embeddings_path {ESM_Embedding_Path} --receptor_cache_dir {args.receptor_cache_dir} --config {args.config}", shell=True)
+	
+	## A library file is indexed once (next to the library if possible, so other runs can reuse the index) and the jobs get ranges of its records
+	if os.path.isfile(args.ligand):
+		libraryIndexPath = get_library_index_path(args.ligand)
+		if not os.access(os.path.dirname(os.path.abspath(args.ligand)), os.W_OK):
+			libraryIndexPath = f"{outputDir}/library.idx"
+		print("Indexing the ligand library..")
+		numRecords = len(LigandLibrary(args.ligand, libraryIndexPath))
+		print(f"Found {numRecords} compounds in {args.ligand}")
+		libraryArg = f"--ligand_library {args.ligand} --library_index {libraryIndexPath} --protein_path {args.protein_path}"
+		numShards = max(-(-numRecords // args.queue_batch_size), 1) if args.work_queue else args.jobs
+		recordRanges = list(split(range(numRecords), numShards))
+
+		## The ranges stay contiguous so the jobs still stream the library
+		if args.balance_jobs:
+			costs = estimate_costs(f"--ligand_library {args.ligand} --library_index {libraryIndexPath}")
+			recordRanges = split_contiguous_by_cost(costs, numShards)
+			if not args.work_queue:
+				print_balance(costs, recordRanges)
+		if args.work_queue:
+			queueItems = [(f"batch_{i+1:06d}.range", f"{records.start}:{records.stop}\n") for i, records in enumerate(recordRanges)]
+		jobInputArgs = [f"{libraryArg} --library_range {records.start}:{records.stop}" for records in recordRanges]
+		if args.deduplicate:
+			print("--deduplicate is not supported for library files, all records will be docked")
+
+	## Get the ligand files and make the protein_ligand_csv lines
+	else:
+		ligandPaths = glob.glob(f"{args.ligand}/*.sdf") + glob.glob(f"{args.ligand}/*.mol2")
+		protein_ligand_header = "complex_name;protein_path;ligand_description\n"
+		protein_ligand_rows = [f"{os.path.basename(ligandPath).split('.')[0]};{args.protein_path};{ligandPath}\n" for ligandPath in ligandPaths]
 
-## Read in the input protein_ligand_csv, split them across files into the jobs dir
+## Read in the input protein_ligand_csv
 else:
 	## Read the lines	
 	with open(args.protein_ligand_csv) as protein_ligand_file:
@@ -189,11 +259,54 @@ else:
 		## Set the seperate_dirs arg
 		seperate_dirs_arg = " --seperate_dirs "
 			
-
 	protein_ligand_header = protein_ligand_lines[0]
-	split_lines = list(split(protein_ligand_lines[1:], args.jobs))
+	protein_ligand_rows = protein_ligand_lines[1:]
+
+## Dock every unique compound once, the duplicates get its results through the alias csv
+libraryInput = args.protein_ligand_csv == "" and os.path.isfile(args.ligand)
+ligand_aliases_arg = ""
+if args.deduplicate and not libraryInput:
+	with open(f"{outputDir}/library.csv", 'w') as libraryCSV:
+		libraryCSV.write(protein_ligand_header)
+		libraryCSV.write("".join(protein_ligand_rows))
+
+	strip_salts_arg = " --strip_salts" if args.strip_salts else ""
+	dedupResult = subprocess.run(f"singularity run --bind $PWD singularity/DiffDockHPC.sif python -u deduplicateLigands.py {outputDir}/library.csv --output_csv {outputDir}/library_unique.csv --alias_csv {outputDir}/ligand_aliases.csv{strip_salts_arg}", shell=True)
+	if dedupResult.returncode != 0:
+		sys.exit("Something went wrong while removing the duplicate compounds, run again without --deduplicate to dock the full library")
+
+	with open(f"{outputDir}/library_unique.csv") as libraryCSV:
+		protein_ligand_lines = libraryCSV.readlines()
+	protein_ligand_header = protein_ligand_lines[0]
+	protein_ligand_rows = protein_ligand_lines[1:]
+	ligand_aliases_arg = f" --ligand_aliases {outputDir}/ligand_aliases.csv"
+
+## Split the compounds across the jobs and write the protein_ligand_csvs in the jobs dir
+if not libraryInput:
+	csvChunks = list(split(protein_ligand_rows, args.jobs))
+
+	## Longest-processing-time-first packing of the compounds by their estimated cost
+	if args.balance_jobs:
+		if not args.deduplicate:
+			with open(f"{outputDir}/library.csv", 'w') as libraryCSV:
+				libraryCSV.write(protein_ligand_header)
+				libraryCSV.write("".join(protein_ligand_rows))
+		costs = estimate_costs(f"{outputDir}/library_unique.csv" if args.deduplicate else f"{outputDir}/library.csv")
+		if len(costs) != len(protein_ligand_rows):
+			print("The estimated costs don't match the compounds (are there empty lines in the csv?), the jobs get the same number of compounds instead")
+		elif args.work_queue:
+			## The most expensive compounds are queued first, so the jobs that finish first fill up with the cheap ones at the end
+			protein_ligand_rows = [protein_ligand_rows[idx] for idx in sorted(range(len(costs)), key=lambda idx: -costs[idx])]
+		else:
+			rowShards = split_by_cost(costs, args.jobs)
+			csvChunks = [[protein_ligand_rows[idx] for idx in rowShard] for rowShard in rowShards]
+			print_balance(costs, rowShards)
+
+	if args.work_queue:
+		queueItems = [(f"batch_{i+1:06d}.csv", protein_ligand_header + "".join(protein_ligand_rows[start:start + args.queue_batch_size])) for i, start in enumerate(range(0, len(protein_ligand_rows), args.queue_batch_size))]
+		csvChunks = []
 
-	for i, csvChunk in enumerate(split_lines):
+	for i, csvChunk in enumerate(csvChunks):
 		csvFilePath = f"{outputDir}/csvs/job_csv_{str(i+1)}.csv"
 		with open(csvFilePath, 'w') as jobCSV:
 			jobCSV.write(protein_ligand_header)
@@ -206,29 +319,96 @@ if not args.no_slurm:
 	print("Launching jobs now..")	
 
 ## Get the final job csvs and order them properly
-csvFilePaths = glob.glob(f"{outputDir}/csvs/job_csv_*.csv")
-csvFilePaths = sorted(csvFilePaths, key=lambda x: int(os.path.basename(x).split('_')[2].split('.')[0]))
+if not libraryInput and not args.work_queue:
+	csvFilePaths = glob.glob(f"{outputDir}/csvs/job_csv_*.csv")
+	csvFilePaths = sorted(csvFilePaths, key=lambda x: int(os.path.basename(x).split('_')[2].split('.')[0]))
+	jobInputArgs = [f"--protein_ligand_csv {csvFilePath}" for csvFilePath in csvFilePaths]
+
+## Fill the work queue, every job gets the same queue and docks batches of it until it is empty
+if args.work_queue:
+	queue = WorkQueue(f"{outputDir}/queue")
+	for itemName, itemContent in queueItems:
+		queue.add(itemName, itemContent)
+	print(f"Queued {len(queueItems)} batches of at most {args.queue_batch_size} compounds")
+	jobInputArgs = [(f"{libraryArg} " if libraryInput else "") + f"--work_queue {outputDir}/queue"] * min(args.jobs, len(queueItems))
+
+## Hand the jobs to the warm workers as shards with their own inputs and outputs, and launch --warm_workers workers instead
+if args.warm_queue:
+	warmQueue = WorkQueue(args.warm_queue)
+	shardPrefix = f"{currentDateNow.strftime('%Y%m%d%H%M%S')}_{os.path.basename(outputDir)}"
+	for i, jobInputArg in enumerate(jobInputArgs):
+		warmQueue.add(f"{shardPrefix}_{i+1:06d}.args", f"{jobInputArg} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ {ESM_Embedding_arg}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}\n")
+	print(f"Added {len(jobInputArgs)} shards to the warm queue {args.warm_queue}")
+	if args.warm_workers <= 0:
+		print("No warm workers are launched (--warm_workers), the shards are docked by the workers that already run on the queue")
+	jobInputArgs = [f"--queue_idle_timeout {args.worker_idle_timeout} --work_queue {args.warm_queue}"] * args.warm_workers
+
+localWorkers = []
+
+## Submit all jobs at once as a job array, its tasks read their input arguments from line SLURM_ARRAY_TASK_ID of job_inputs.txt
+if args.array and not args.no_slurm and jobInputArgs:
+	with open(f"{outputDir}/jobs/job_inputs.txt", "w") as jobInputsFile:
+		jobInputsFile.write("".join(f"{jobInputArg}\n" for jobInputArg in jobInputArgs))
+
+	arraySpec = f"1-{len(jobInputArgs)}"
+	if args.array_max_concurrent > 0:
+		arraySpec += f"%{args.array_max_concurrent}"
+	nvArgument = " --nv" if args.gpu else ""
+
+	## Write the DiffDockHPC array job script, and the command that submits it
+	with open(f"{outputDir}/jobs/array_job.sh", "w") as arrayJobFile:
+		arrayJobFile.write("#!/usr/bin/env bash\n")
+		arrayJobFile.write("#SBATCH --job-name=DiffDockHPC\n")
+		arrayJobFile.write(f"#SBATCH --array={arraySpec}\n")
+		arrayJobFile.write(f"#SBATCH --output={outputDir}/jobs_out/job_%a_%A.out\n")
+		arrayJobFile.write(f"#SBATCH --mem={args.mem}\n")
+		arrayJobFile.write(f"#SBATCH -c {str(args.cores + args.prefetch_workers)}\n")
+		if args.gpu == True:
+			arrayJobFile.write("#SBATCH --gres=gpu:1\n")
+		if not args.time == "":
+			arrayJobFile.write(f"#SBATCH --time={args.time}\n")
+		if not args.queue == "":
+			arrayJobFile.write(f"#SBATCH -p {args.queue}\n")
+		arrayJobFile.write(f'jobInputArg=$(sed -n "${{SLURM_ARRAY_TASK_ID}}p" {outputDir}/jobs/job_inputs.txt)\n')
+		arrayJobFile.write(f"singularity run{nvArgument} --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py $jobInputArg --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}{receptor_cache_arg}{ligand_cache_arg}{pack_ligands_arg}{prefetch_arg}\n")
+
+	jobCMD = f"{args.sbatch} {outputDir}/jobs/array_job.sh"
+	with open(f"{outputDir}/jobs/submit_array_job.sh", "w") as jobfile:
+		jobfile.write("#!/usr/bin/env bash\n")
+		jobfile.write(jobCMD)
 
-## Loop over the csvs and launch the jobs
-for i, csvFilePath in enumerate(csvFilePaths):
+	print(f"Submitting {len(jobInputArgs)} jobs as one job array..")
+	subprocess.run(jobCMD, shell=True)
+
+	## The array replaces the separate submissions below
+	jobInputArgs = []
+
+## Loop over the job inputs and launch the jobs
+for i, jobInputArg in enumerate(jobInputArgs):
 	
 	## Construct the DiffDock command
 	if not args.no_slurm:
 		## Execute command using singularity and sbatch wrap giving the csv as an input, and passing the input variables as well
 		if args.gpu == True:
-			jobCMD = f'sbatch --wrap="singularity run --nv --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --gres=gpu:1 --job-name=DiffDockHPC -c {str(args.cores)}{timeArg}{queueArgument}'
+			jobCMD = f'{args.sbatch} --wrap="singularity run --nv --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py {jobInputArg} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}{receptor_cache_arg}{ligand_cache_arg}{pack_ligands_arg}{prefetch_arg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --gres=gpu:1 --job-name=DiffDockHPC -c {str(args.cores + args.prefetch_workers)}{timeArg}{queueArgument}'
 		else:
-			jobCMD = f'sbatch --wrap="singularity run --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --job-name=DiffDockHPC -c {str(args.cores)}{timeArg}{queueArgument}'
+			jobCMD = f'{args.sbatch} --wrap="singularity run --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py {jobInputArg} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}{receptor_cache_arg}{ligand_cache_arg}{pack_ligands_arg}{prefetch_arg}" --mem {args.mem} --output={outputDir}/jobs_out/job_{str(i+1)}_%j.out --job-name=DiffDockHPC -c {str(args.cores + args.prefetch_workers)}{timeArg}{queueArgument}'
 	else:
 		if args.gpu == True:
-			jobCMD = f'singularity run --nv --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
+			jobCMD = f'singularity run --nv --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py {jobInputArg} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}{receptor_cache_arg}{ligand_cache_arg}{pack_ligands_arg}{prefetch_arg} 2>&1 | tee {outputDir}/jobs_out/job_{str(i+1)}.out'
 		else:
-			jobCMD = f'singularity run --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py --protein_ligand_csv {csvFilePath} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg} 2>&1 | tee {outputDir}/jobs_out/job_1.out'
+			jobCMD = f'singularity run --bind $PWD singularity/DiffDockHPC.sif python3 -u inference.py {jobInputArg} --samples_per_complex {args.num_outputs} --out_dir {outputDir}/molecules/ --config {args.config} {ESM_Embedding_arg} -c {str(args.cores)}{remove_hs_arg}{seperate_dirs_arg}{ligand_aliases_arg}{receptor_cache_arg}{ligand_cache_arg}{pack_ligands_arg}{prefetch_arg} 2>&1 | tee {outputDir}/jobs_out/job_{str(i+1)}.out'
 	
 	## Write the DiffDockHPC job file	
 	with open(f"{outputDir}/jobs/job_{str(i+1)}.sh", "w") as jobfile:
 		jobfile.write("#!/usr/bin/env bash\n")
 		jobfile.write(jobCMD)
 
-	## Run the DiffDockHPC job file
-	subprocess.run(jobCMD, shell=True)
+	## Run the DiffDockHPC job file, the local workers of a work queue run side by side
+	if args.no_slurm and (args.work_queue or args.warm_queue):
+		localWorkers.append(subprocess.Popen(jobCMD, shell=True))
+	else:
+		subprocess.run(jobCMD, shell=True)
+
+for localWorker in localWorkers:
+	localWorker.wait()
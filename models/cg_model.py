@@ -12,7 +12,10 @@ import numpy as np
 
 from models.layers import GaussianSmearing, AtomEncoder
 from models.tensor_layers import TensorProductConvLayer, get_irrep_seq
+from models.receptor_cache import ReceptorEmbeddingCache
 from utils import so3, torus
+from utils.batching import expand_shared_receptor
+from utils.diffusion_utils import register_score_norm_tables
 from datasets.process_mols import lig_feature_dims, rec_residue_feature_dims, rec_atom_feature_dims
 
 
@@ -47,6 +50,8 @@ class CGModel(torch.nn.Module):
         self.sh_irreps = o3.Irreps.spherical_harmonics(lmax=sh_lmax)
         self.ns, self.nv = ns, nv
         self.scale_by_sigma = scale_by_sigma
+        if scale_by_sigma:
+            register_score_norm_tables(self)
         self.norm_by_sigma = norm_by_sigma
         self.device = device
         self.no_torsion = no_torsion
@@ -66,6 +71,7 @@ class CGModel(torch.nn.Module):
         self.atom_confidence = atom_confidence
         self.atom_num_confidence_outputs = atom_num_confidence_outputs
         self.sidechain_pred = sidechain_pred
+        self.receptor_cache = None
 
         self.lm_embedding_type = lm_embedding_type
         if lm_embedding_type is None:
@@ -269,8 +275,16 @@ class CGModel(torch.nn.Module):
 
         return lig_node_attr, lig_edge_index, lig_edge_attr, lig_edge_sh, lig_edge_weight
 
-    def embedding(self, data):
-        if not hasattr(data['receptor'], "rec_node_attr"):
+    def enable_receptor_cache(self, cache_dir=None, model_key=None):
+        # the time independent receptor embeddings are reused for all batches with the same receptor_key
+        self.receptor_cache = ReceptorEmbeddingCache([('receptor', 'rec_node_attr'), (('receptor', 'receptor'), 'rec_edge_attr'),
+                                                     (('receptor', 'receptor'), 'edge_sh'), (('receptor', 'receptor'), 'edge_weight')],
+                                                     cache_dir=cache_dir, model_key=model_key)
+
+    def receptor_embedding(self, data):
+        # the time independent part of the receptor embedding, it is kept in data and reused by the following steps
+        use_receptor_cache = self.receptor_cache is not None and not self.training
+        if not hasattr(data['receptor'], "rec_node_attr") and not (use_receptor_cache and self.receptor_cache.load(data)):
             if self.lm_embedding_type not in [None, 'precomputed']:
                 sequences = [s for l in data['receptor'].sequence for s in l]
                 if isinstance(sequences[0], list):
@@ -294,6 +308,12 @@ class CGModel(torch.nn.Module):
             data['receptor', 'receptor'].edge_sh = rec_edge_sh
             data['receptor', 'receptor'].edge_weight = rec_edge_weight
 
+            if use_receptor_cache:
+                self.receptor_cache.store(data)
+
+    def embedding(self, data):
+        self.receptor_embedding(data)
+
         # receptor embedding
         rec_sigma_emb = self.rec_sigma_embedding(self.timestep_emb_func(data.complex_t['tr']))
         rec_node_attr = data['receptor'].rec_node_attr + 0
@@ -309,6 +329,11 @@ class CGModel(torch.nn.Module):
         if self.no_aminoacid_identities:
             data['receptor'].x = data['receptor'].x * 0
 
+        if getattr(data, 'shared_receptor', False):
+            # the receptor is embedded once and only then copied for every ligand of the batch
+            self.receptor_embedding(data)
+            data = expand_shared_receptor(data)
+
         if not self.confidence_mode:
             tr_sigma, rot_sigma, tor_sigma = self.t_to_sigma(*[data.complex_t[noise_type] for noise_type in ['tr', 'rot', 'tor']])
         else:
@@ -392,7 +417,7 @@ class CGModel(torch.nn.Module):
 
         if self.scale_by_sigma:
             tr_pred = tr_pred / tr_sigma.unsqueeze(1)
-            rot_pred = rot_pred * so3.score_norm(rot_sigma.cpu()).unsqueeze(1).to(data['ligand'].x.device)
+            rot_pred = rot_pred * so3.score_norm_tensor(rot_sigma, self.so3_score_norm_table).unsqueeze(1)
 
         # predict sidechain orientation
         sidechain_pred = None
@@ -419,8 +444,7 @@ class CGModel(torch.nn.Module):
         edge_sigma = tor_sigma[data['ligand'].batch][data['ligand', 'ligand'].edge_index[0]][data['ligand'].edge_mask]
 
         if self.scale_by_sigma:
-            tor_pred = tor_pred * torch.sqrt(torch.tensor(torus.score_norm(edge_sigma.cpu().numpy())).float()
-                                             .to(data['ligand'].x.device))
+            tor_pred = tor_pred * torch.sqrt(torus.score_norm_tensor(edge_sigma, self.torus_score_norm_table))
         return tr_pred, rot_pred, tor_pred, sidechain_pred
 
     def torsional_forward(self, data):
@@ -452,8 +476,7 @@ class CGModel(torch.nn.Module):
         edge_sigma = tor_sigma[data['ligand'].batch][data['ligand', 'ligand'].edge_index[0]][data['ligand'].edge_mask]
 
         if self.scale_by_sigma:
-            tor_pred = tor_pred * torch.sqrt(torch.tensor(torus.score_norm(edge_sigma.cpu().numpy())).float()
-                                             .to(data['ligand'].x.device))
+            tor_pred = tor_pred * torch.sqrt(torus.score_norm_tensor(edge_sigma, self.torus_score_norm_table))
         return 0, 0, tor_pred, 0
 
     def get_edge_weight(self, edge_vec, max_norm):
@@ -12,6 +12,8 @@ from e3nn.nn import BatchNorm
 from models.layers import OldAtomEncoder, AtomEncoder, GaussianSmearing
 from models.tensor_layers import OldTensorProductConvLayer
 from utils import so3, torus
+from utils.batching import expand_shared_receptor
+from utils.diffusion_utils import register_score_norm_tables
 from datasets.process_mols import lig_feature_dims, rec_residue_feature_dims, rec_atom_feature_dims
 
 
@@ -44,6 +46,8 @@ class CGOldModel(torch.nn.Module):
         self.sh_irreps = o3.Irreps.spherical_harmonics(lmax=sh_lmax)
         self.ns, self.nv = ns, nv
         self.scale_by_sigma = scale_by_sigma
+        if scale_by_sigma:
+            register_score_norm_tables(self)
         self.norm_by_sigma = norm_by_sigma
         self.device = device
         self.no_torsion = no_torsion
@@ -201,6 +205,9 @@ class CGOldModel(torch.nn.Module):
                 )
 
     def forward(self, data):
+        # every ligand needs its own receptor nodes
+        data = expand_shared_receptor(data)
+
         if self.no_aminoacid_identities:
             data['receptor'].x = data['receptor'].x * 0
 
@@ -326,7 +333,7 @@ class CGOldModel(torch.nn.Module):
 
         if self.scale_by_sigma:
             tr_pred = tr_pred / tr_sigma.unsqueeze(1)
-            rot_pred = rot_pred * so3.score_norm(rot_sigma.cpu()).unsqueeze(1).to(data['ligand'].x.device)
+            rot_pred = rot_pred * so3.score_norm_tensor(rot_sigma, self.so3_score_norm_table).unsqueeze(1)
 
         if self.no_torsion or data['ligand'].edge_mask.sum() == 0: return tr_pred, rot_pred, torch.empty(0, device=self.device)
 
@@ -346,8 +353,7 @@ class CGOldModel(torch.nn.Module):
         edge_sigma = tor_sigma[data['ligand'].batch][data['ligand', 'ligand'].edge_index[0]][data['ligand'].edge_mask]
 
         if self.scale_by_sigma:
-            tor_pred = tor_pred * torch.sqrt(torch.tensor(torus.score_norm(edge_sigma.cpu().numpy())).float()
-                                             .to(data['ligand'].x.device))
+            tor_pred = tor_pred * torch.sqrt(torus.score_norm_tensor(edge_sigma, self.torus_score_norm_table))
         return tr_pred, rot_pred, tor_pred
 
     def get_edge_weight(self, edge_vec, max_norm):
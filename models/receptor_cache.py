@@ -0,0 +1,89 @@
+import os
+from collections import OrderedDict
+
+import torch
+
+
+def get_receptor_keys(data):
+    # one receptor key per receptor in the batch, None if a graph has no key (e.g. because its receptor was cropped)
+    keys = getattr(data, 'receptor_key', None)
+    if keys is None:
+        return None
+
+    def flatten(k):
+        return [x for e in k for x in flatten(e)] if isinstance(k, (list, tuple)) else [k]
+    keys = flatten(keys)
+    if len(keys) != data.num_graphs or any(k is None for k in keys):
+        return None
+    # a batch with a shared receptor contains only the receptor of the first graph
+    return keys[:1] if getattr(data, 'shared_receptor', False) else keys
+
+
+class ReceptorEmbeddingCache:
+    """ Keeps the time independent receptor embeddings computed by a model, keyed by the receptor key of the graphs,
+    so that they are computed once per receptor instead of once per batch. If cache_dir is given the embeddings are
+    also stored on disk, model_key has to identify the model weights in that case. """
+
+    def __init__(self, attributes, cache_dir=None, model_key=None, max_receptors=8):
+        assert cache_dir is None or model_key is not None, "the disk cache needs a model_key"
+        self.attributes = attributes  # (node or edge type, attribute name) pairs that are cached
+        self.cache_dir = cache_dir
+        self.model_key = model_key
+        self.max_receptors = max_receptors
+        self.embeddings = OrderedDict()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}_embedding_{self.model_key}.pt')
+
+    def add(self, key, embedding):
+        self.embeddings[key] = embedding
+        self.embeddings.move_to_end(key)
+        while len(self.embeddings) > self.max_receptors:
+            self.embeddings.popitem(last=False)
+
+    def lookup(self, key, device):
+        if key not in self.embeddings and self.cache_dir is not None and os.path.exists(self.get_path(key)):
+            self.add(key, torch.load(self.get_path(key), map_location=device))
+        return self.embeddings.get(key)
+
+    def load(self, data):
+        # sets the cached embeddings of all receptors of the batch, returns False if one of them is not cached
+        keys = get_receptor_keys(data)
+        if keys is None:
+            return False
+        device = data['receptor'].pos.device
+        embeddings = {key: self.lookup(key, device) for key in dict.fromkeys(keys)}
+        if any(embedding is None for embedding in embeddings.values()):
+            return False
+
+        for store_name, attr in self.attributes:
+            values = [embeddings[key][(store_name, attr)] for key in keys]
+            data[store_name][attr] = torch.cat(values, dim=0) if torch.is_tensor(values[0]) else values[0]
+        return True
+
+    def store(self, data):
+        # stores the embeddings of the receptors of the batch that are not cached yet
+        keys = get_receptor_keys(data)
+        if keys is None:
+            return
+        for g, key in enumerate(keys):
+            if key in self.embeddings:
+                continue
+            embedding = {}
+            for store_name, attr in self.attributes:
+                store = data[store_name]
+                value = store[attr]
+                if torch.is_tensor(value):
+                    if isinstance(store_name, tuple):
+                        mask = data[store_name[0]].batch[store.edge_index[0]] == g
+                    else:
+                        mask = store.batch == g
+                    value = value[mask].detach()
+                embedding[(store_name, attr)] = value
+            self.add(key, embedding)
+
+            if self.cache_dir is not None and not os.path.exists(self.get_path(key)):
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_path = f'{self.get_path(key)}.tmp{os.getpid()}'
+                torch.save({k: v.cpu() if torch.is_tensor(v) else v for k, v in embedding.items()}, tmp_path)
+                os.replace(tmp_path, self.get_path(key))
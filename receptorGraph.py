@@ -0,0 +1,48 @@
+## Featurizes a receptor once and stores it in the receptor graph cache, so the docking jobs don't have to
+import os
+import sys
+from argparse import ArgumentParser, Namespace
+
+import yaml
+
+from utils.inference_utils import InferenceDataset
+
+parser = ArgumentParser()
+parser.add_argument('protein_path', type=str, help='Path to the protein/receptor .pdb file')
+parser.add_argument('--esm_embeddings_path', type=str, required=True, help='Path to the precomputed ESM embeddings of the protein')
+parser.add_argument('--receptor_cache_dir', type=str, default='data/receptor_graphs/', help='Directory where the receptor graphs are stored')
+parser.add_argument('--config', type=str, default='default_inference_args.yaml')
+args = parser.parse_args()
+
+with open(args.config) as f:
+	config_dict = yaml.load(f, Loader=yaml.FullLoader)
+
+## The graph parameters are taken from the models, if they are not downloaded yet the jobs will fill the cache themselves
+model_dirs = [config_dict['model_dir'], config_dict.get('confidence_model_dir')]
+if not os.path.isfile(f"{model_dirs[0]}/model_parameters.yml"):
+	print("The model parameters were not found, the receptor graph will be generated by the first job instead")
+	sys.exit(0)
+
+with open(f"{model_dirs[0]}/model_parameters.yml") as f:
+	score_model_args = Namespace(**yaml.full_load(f))
+model_args_list = [score_model_args]
+if model_dirs[1] is not None and os.path.isfile(f"{model_dirs[1]}/model_parameters.yml"):
+	with open(f"{model_dirs[1]}/model_parameters.yml") as f:
+		confidence_args = Namespace(**yaml.full_load(f))
+	if not confidence_args.use_original_model_cache:
+		model_args_list.append(confidence_args)
+
+print("Generating the receptor graph(s)..")
+for model_args in model_args_list:
+	## Same settings as the datasets in inference.py
+	dataset = InferenceDataset(out_dir=None, complex_names=[os.path.splitext(os.path.basename(args.protein_path))[0]],
+							   protein_files=[args.protein_path], ligand_descriptions=[None], protein_sequences=[None],
+							   lm_embeddings=True,
+							   receptor_radius=model_args.receptor_radius, remove_hs=model_args.remove_hs,
+							   c_alpha_max_neighbors=model_args.c_alpha_max_neighbors,
+							   all_atoms=model_args.all_atoms, atom_radius=model_args.atom_radius,
+							   atom_max_neighbors=model_args.atom_max_neighbors,
+							   precomputed_lm_embeddings=args.esm_embeddings_path,
+							   knn_only_graph=False if not hasattr(score_model_args, 'not_knn_only_graph') else not score_model_args.not_knn_only_graph,
+							   receptor_cache_dir=args.receptor_cache_dir)
+	dataset.get_receptor_graph(args.protein_path, dataset.lm_embeddings[0])
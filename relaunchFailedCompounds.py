@@ -19,6 +19,8 @@ import shutil
 import subprocess
 import sys
 
+from utils.sharding import read_ligand_costs, split_by_cost
+
 if len(sys.argv) < 2:
 	sys.exit("You have to put in a DiffDockHPC run as an argument")
 	
@@ -39,8 +41,8 @@ def split(a, n):
     k, m = divmod(len(a), n)
     return (a[i*k+min(i, m):(i+1)*k+min(i+1, m)] for i in range(n))
 
-## Check the csv files and store the information to a dict
-for path in glob.glob(f"{inputPath}/csvs/*.csv"):
+## Check the csv files (and the batches of a --work_queue run) and store the information to a dict
+for path in glob.glob(f"{inputPath}/csvs/*.csv") + glob.glob(f"{inputPath}/queue/*/batch_*.csv*"):
 	with open(path) as inputFile:
 		inputLines = inputFile.readlines()
 		for line in inputLines[1:]:
@@ -56,10 +58,11 @@ for finishedPath in finishedPaths:
 	finishedName = finishedPath.split("VS_DD_")[-1].split("_rank")[0]
 	finishedList.append(finishedName)
 
-## Loop through the finished compounds and remove the values from the pathDict
+## Loop through the finished compounds and remove the values from the pathDict (the aliases of deduplicated compounds and the other ranks aren't in it)
 for name in finishedList:
-	del(pathDict[name])
-	successCounter += 1
+	if name in pathDict:
+		del(pathDict[name])
+		successCounter += 1
 
 print(f"Failed to process {len(pathDict)} files, {successCounter} did process successfully")
 
@@ -71,7 +74,15 @@ else:
 	jobNumber = int(answer)
 	print(f"launching {jobNumber} jobs..")
 
-ligandPathsSplit = list(split(list(pathDict.values()), jobNumber))
+## If the run estimated the cost of the compounds (--balance_jobs), the failed compounds are balanced by their cost as well
+if os.path.isfile(f"{inputPath}/ligand_costs.csv"):
+	costNames, costs = read_ligand_costs(f"{inputPath}/ligand_costs.csv")
+	costDict = dict(zip(costNames, costs))
+	failedNames = list(pathDict.keys())
+	failedCosts = [costDict.get(name, sum(costs) / len(costs)) for name in failedNames]
+	ligandPathsSplit = [[pathDict[failedNames[idx]] for idx in shard] for shard in split_by_cost(failedCosts, jobNumber)]
+else:
+	ligandPathsSplit = list(split(list(pathDict.values()), jobNumber))
 
 ## Check if the output directory already exists, and asks the user what to do if it does
 redoDir = f"{inputPath}/redo/"
@@ -92,10 +103,18 @@ os.mkdir(f"{redoDir}/csvs/")
 os.mkdir(f"{redoDir}/jobs_out/")
 os.mkdir(f"{redoDir}/jobs/")
 
-## Get a job file to copy the settings automatically
-jobPaths = glob.glob(f"{inputPath}/jobs/job_*.sh")
-with open(jobPaths[0]) as jobFile:
-	jobLine = jobFile.readlines()[1]
+## Get a job file to copy the settings automatically (the array job script if the jobs were submitted as a job array)
+arrayJobPath = f"{inputPath}/jobs/array_job.sh"
+if os.path.isfile(arrayJobPath):
+	with open(arrayJobPath) as jobFile:
+		arrayJobScript = jobFile.read()
+	with open(f"{inputPath}/jobs/submit_array_job.sh") as jobFile:
+		arraySubmitLine = jobFile.readlines()[1]
+	redoJobInputArgs = []
+else:
+	jobPaths = glob.glob(f"{inputPath}/jobs/job_*.sh")
+	with open(jobPaths[0]) as jobFile:
+		jobLine = jobFile.readlines()[1]
 
 ## Get the protein path
 protein_path = glob.glob(f"{inputPath}/*.pdb")[0]
@@ -110,9 +129,14 @@ for i, jobLigands in enumerate(ligandPathsSplit):
 			jobCSV.write(f"{complexName};{protein_path};{jobLigand}\n")
 	jobCSV.close()
 
+	## The failed compounds of an array run are relaunched as one job array as well
+	if os.path.isfile(arrayJobPath):
+		redoJobInputArgs.append(f"--protein_ligand_csv {csvFilePath}")
+		continue
+
 	## Modify the command to use the correct csv and job output path
 	jobCMD = re.sub(r"/jobs_out/job_.*\.out", f"/redo/jobs_out/redo_job_{i}_%j.out", jobLine)
-	jobCMD = re.sub(r"(--protein_ligand_csv\s+)[^ ]+(\s+--samples_per_complex)", r"\1" + csvFilePath + r"\2", jobCMD)
+	jobCMD = re.sub(r"(--protein_ligand_csv|--work_queue)\s+[^ ]+(\s+--samples_per_complex)", r"--protein_ligand_csv " + csvFilePath + r"\2", jobCMD)
 
 	## Write the DiffDockHPC job file	
 	with open(f"{redoDir}/jobs/redo_job_{str(i+1)}.sh", "w") as jobfile:
@@ -121,3 +145,20 @@ for i, jobLigands in enumerate(ligandPathsSplit):
 
 	## Run the DiffDockHPC job file
 	subprocess.run(jobCMD, shell=True)
+
+## Write the array job script for the relaunched compounds and submit it
+if os.path.isfile(arrayJobPath) and redoJobInputArgs:
+	with open(f"{redoDir}/jobs/job_inputs.txt", "w") as jobInputsFile:
+		jobInputsFile.write("".join(f"{jobInputArg}\n" for jobInputArg in redoJobInputArgs))
+
+	arrayJobScript = re.sub(r"(--array=)\d+-\d+", r"\g<1>1-" + str(len(redoJobInputArgs)), arrayJobScript)
+	arrayJobScript = arrayJobScript.replace("/jobs_out/job_", "/redo/jobs_out/redo_job_").replace("/jobs/job_inputs.txt", "/redo/jobs/job_inputs.txt")
+	with open(f"{redoDir}/jobs/array_job.sh", "w") as jobfile:
+		jobfile.write(arrayJobScript)
+
+	jobCMD = arraySubmitLine.replace("/jobs/array_job.sh", "/redo/jobs/array_job.sh")
+	with open(f"{redoDir}/jobs/submit_array_job.sh", "w") as jobfile:
+		jobfile.write("#!/usr/bin/env bash\n")
+		jobfile.write(jobCMD)
+
+	subprocess.run(jobCMD, shell=True)
@@ -0,0 +1,105 @@
+import copy
+
+import torch
+from torch_geometric.data import Batch
+
+# node types that belong to the receptor, all edges between them are part of the receptor as well
+RECEPTOR_NODE_TYPES = ['receptor', 'atom', 'misc_atom']
+
+
+def get_receptor_stores(complex_graph):
+    node_types = [node_type for node_type in complex_graph.node_types if node_type in RECEPTOR_NODE_TYPES]
+    edge_types = [edge_type for edge_type in complex_graph.edge_types
+                  if edge_type[0] in node_types and edge_type[2] in node_types]
+    return node_types, edge_types
+
+
+def copy_with_shared_receptor(complex_graph):
+    # deep copy of the complex in which the receptor tensors are shared with the original instead of being copied
+    memo = {}
+    node_types, edge_types = get_receptor_stores(complex_graph)
+    for store_type in node_types + edge_types:
+        for value in complex_graph[store_type].values():
+            memo[id(value)] = value
+    return copy.deepcopy(complex_graph, memo)
+
+
+def has_shared_receptor(data_list):
+    # True if all complexes were built from the same receptor graph
+    keys = [getattr(complex_graph, 'receptor_key', None) for complex_graph in data_list]
+    keys = [key[0] if isinstance(key, list) and len(key) == 1 else key for key in keys]
+    return keys[0] is not None and all(key == keys[0] for key in keys)
+
+
+def collate_shared_receptor(data_list):
+    """ Collates complexes with the same receptor into a batch that contains only one copy of the receptor (the one
+    of the first complex) together with the ligands of all complexes. The models expand it with
+    expand_shared_receptor when every ligand needs its own receptor nodes. """
+    node_types, edge_types = get_receptor_stores(data_list[0])
+    ligand_graphs = []
+    for complex_graph in data_list:
+        ligand_graph = copy.copy(complex_graph)
+        for store_type in edge_types + node_types:
+            del ligand_graph[store_type]
+        ligand_graphs.append(ligand_graph)
+    batch = Batch.from_data_list(ligand_graphs)
+
+    receptor = data_list[0]
+    for store_type in node_types + edge_types:
+        for key, value in receptor[store_type].items():
+            if key not in ['batch', 'ptr']:
+                batch[store_type][key] = value
+    for node_type in node_types:
+        num_nodes = receptor[node_type].num_nodes
+        batch[node_type].batch = torch.zeros(num_nodes, dtype=torch.long)
+        batch[node_type].ptr = torch.tensor([0, num_nodes])
+    batch.shared_receptor = True
+    return batch
+
+
+def shared_receptor_loader(data_list, batch_size):
+    for i in range(0, len(data_list), batch_size):
+        yield collate_shared_receptor(data_list[i:i + batch_size])
+
+
+def repeat_attr(value, num_items, num_graphs):
+    if isinstance(value, dict):
+        return {k: repeat_attr(v, num_items, num_graphs) for k, v in value.items()}
+    if torch.is_tensor(value) and value.dim() > 0 and value.size(0) == num_items:
+        return value.repeat(num_graphs, *([1] * (value.dim() - 1)))
+    return value
+
+
+def expand_shared_receptor(data):
+    """ Returns a shallow copy of a batch from collate_shared_receptor in which every graph has its own copy of the
+    receptor, as if the complexes had been collated normally. Other batches are returned unchanged. """
+    if not getattr(data, 'shared_receptor', False):
+        return data
+
+    data = copy.copy(data)
+    num_graphs = data.num_graphs
+    node_types, edge_types = get_receptor_stores(data)
+    num_nodes = {node_type: data[node_type].num_nodes for node_type in node_types}
+
+    for edge_type in edge_types:
+        store = data[edge_type]
+        num_edges = store.num_edges
+        for key, value in list(store.items()):
+            if key == 'edge_index':
+                offset = torch.tensor([num_nodes[edge_type[0]], num_nodes[edge_type[2]]], device=value.device)
+                offset = torch.arange(num_graphs, device=value.device)[:, None, None] * offset[None, :, None]
+                store[key] = (value.unsqueeze(0) + offset).permute(1, 0, 2).reshape(2, -1)
+            else:
+                store[key] = repeat_attr(value, num_edges, num_graphs)
+
+    for node_type in node_types:
+        store, n = data[node_type], num_nodes[node_type]
+        device = store.batch.device
+        for key, value in list(store.items()):
+            if key not in ['batch', 'ptr']:
+                store[key] = repeat_attr(value, n, num_graphs)
+        store.batch = torch.arange(num_graphs, device=device).repeat_interleave(n)
+        store.ptr = torch.arange(num_graphs + 1, device=device) * n
+
+    data.shared_receptor = False
+    return data
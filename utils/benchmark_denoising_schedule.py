@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from functools import partial
+
+import numpy as np
+import torch
+from torch_geometric.data import Batch, HeteroData
+
+# run as python utils/benchmark_denoising_schedule.py, times the work of a denoising step of utils/sampling.py besides
+# the score model (the scalars of the step, the times of the nodes and the updates from the scores) when it is computed
+# at every step and with a DenoisingSchedule that is computed once, on a batch of poses of a small ligand
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.diffusion_utils import DenoisingSchedule, get_t_schedule, set_time, t_to_sigma
+
+parser = ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=10, help='Number of poses in the batch')
+parser.add_argument('--ligand_atoms', type=int, default=12)
+parser.add_argument('--torsions', type=int, default=3, help='Number of rotatable bonds of the ligand')
+parser.add_argument('--receptor_residues', type=int, default=300)
+parser.add_argument('--inference_steps', type=int, default=20)
+parser.add_argument('--temp_sampling', type=float, nargs=3, default=[1.170, 2.06, 7.04])
+parser.add_argument('--repeats', type=int, default=100)
+args = parser.parse_args()
+
+model_args = Namespace(tr_sigma_min=0.1, tr_sigma_max=19.0, rot_sigma_min=0.03, rot_sigma_max=1.55, tor_sigma_min=0.0314,
+                       tor_sigma_max=3.14, no_torsion=False, all_atoms=False)
+temp_psi, temp_sigma_data = [0.727, 0.902, 0.592], [0.930, 0.750, 0.114]
+
+
+def set_time_reference(complex_graphs, t_tr, t_rot, t_tor, batchsize, device):
+    # set_time before the buffers
+    for node_type in ['ligand', 'receptor']:
+        complex_graphs[node_type].node_t = {
+            'tr': t_tr * torch.ones(complex_graphs[node_type].num_nodes).to(device),
+            'rot': t_rot * torch.ones(complex_graphs[node_type].num_nodes).to(device),
+            'tor': t_tor * torch.ones(complex_graphs[node_type].num_nodes).to(device)}
+    complex_graphs.complex_t = {'tr': t_tr * torch.ones(batchsize).to(device),
+                                'rot': t_rot * torch.ones(batchsize).to(device),
+                                'tor': t_tor * torch.ones(batchsize).to(device)}
+
+
+def denoise_reference(batch, scores, schedule, device):
+    # the steps of sampling before the DenoisingSchedule, all scalars are computed at every step
+    b, perturbs = batch.num_graphs, []
+    temp_sampling, psi, sigma_data = list(args.temp_sampling), list(temp_psi), list(temp_sigma_data)
+    for t_idx in range(args.inference_steps):
+        t_tr = t_rot = t_tor = schedule[t_idx]
+        dt = schedule[t_idx] - schedule[t_idx + 1] if t_idx < args.inference_steps - 1 else schedule[t_idx]
+        tr_sigma, rot_sigma, tor_sigma = t_to_sigma(t_tr, t_rot, t_tor, model_args)
+        set_time_reference(batch, t_tr, t_rot, t_tor, b, device)
+        tr_score, rot_score, tor_score = scores[t_idx]
+
+        tr_g = tr_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.tr_sigma_max / model_args.tr_sigma_min)))
+        rot_g = rot_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.rot_sigma_max / model_args.rot_sigma_min)))
+        tor_g = tor_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.tor_sigma_max / model_args.tor_sigma_min)))
+        last_step = t_idx == args.inference_steps - 1
+        tr_z = torch.zeros((b, 3), device=device) if last_step else torch.normal(mean=0, std=1, size=(b, 3), device=device)
+        rot_z = torch.zeros((b, 3), device=device) if last_step else torch.normal(mean=0, std=1, size=(b, 3), device=device)
+        tor_z = torch.zeros(tor_score.shape, device=device) if last_step \
+            else torch.normal(mean=0, std=1, size=tor_score.shape, device=device)
+
+        assert len(temp_sampling) == 3 and len(psi) == 3 and len(sigma_data) == 3
+        tr_sigma_data = np.exp(sigma_data[0] * np.log(model_args.tr_sigma_max) + (1 - sigma_data[0]) * np.log(model_args.tr_sigma_min))
+        lambda_tr = (tr_sigma_data + tr_sigma) / (tr_sigma_data + tr_sigma / temp_sampling[0])
+        tr_perturb = (tr_g ** 2 * dt * (lambda_tr + temp_sampling[0] * psi[0] / 2) * tr_score + tr_g * np.sqrt(dt * (1 + psi[0])) * tr_z)
+        rot_sigma_data = np.exp(sigma_data[1] * np.log(model_args.rot_sigma_max) + (1 - sigma_data[1]) * np.log(model_args.rot_sigma_min))
+        lambda_rot = (rot_sigma_data + rot_sigma) / (rot_sigma_data + rot_sigma / temp_sampling[1])
+        rot_perturb = (rot_g ** 2 * dt * (lambda_rot + temp_sampling[1] * psi[1] / 2) * rot_score + rot_g * np.sqrt(dt * (1 + psi[1])) * rot_z)
+        tor_sigma_data = np.exp(sigma_data[2] * np.log(model_args.tor_sigma_max) + (1 - sigma_data[2]) * np.log(model_args.tor_sigma_min))
+        lambda_tor = (tor_sigma_data + tor_sigma) / (tor_sigma_data + tor_sigma / temp_sampling[2])
+        tor_perturb = (tor_g ** 2 * dt * (lambda_tor + temp_sampling[2] * psi[2] / 2) * tor_score + tor_g * np.sqrt(dt * (1 + psi[2])) * tor_z)
+        perturbs.append((tr_perturb, rot_perturb, tor_perturb))
+    return perturbs
+
+
+def denoise_schedule(batch, scores, denoising_schedule, device):
+    # the steps of sampling with the DenoisingSchedule of the run
+    b, perturbs, time_buffers = batch.num_graphs, [], {}
+    for t_idx, step in enumerate(denoising_schedule):
+        set_time(batch, step.t, step.t_tr, step.t_rot, step.t_tor, b, False, device, buffers=time_buffers)
+        tr_score, rot_score, tor_score = scores[t_idx]
+
+        tr_perturb = step.tr_score_scale * tr_score
+        rot_perturb = step.rot_score_scale * rot_score
+        tor_perturb = step.tor_score_scale * tor_score
+        if step.noise:
+            tr_perturb += step.tr_noise_scale * torch.normal(mean=0, std=1, size=(b, 3), device=device)
+            rot_perturb += step.rot_noise_scale * torch.normal(mean=0, std=1, size=(b, 3), device=device)
+            tor_perturb += step.tor_noise_scale * torch.normal(mean=0, std=1, size=tor_score.shape, device=device)
+        perturbs.append((tr_perturb, rot_perturb, tor_perturb))
+    return perturbs
+
+
+def benchmark(function, device, *inputs):
+    for _ in range(3):
+        function(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        function(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeats / args.inference_steps * 1e6
+
+
+def get_batch(device):
+    graphs = []
+    for _ in range(args.batch_size):
+        graph = HeteroData()
+        graph['ligand'].pos = torch.randn(args.ligand_atoms, 3)
+        graph['receptor'].pos = torch.randn(args.receptor_residues, 3) * 10
+        graphs.append(graph)
+    return Batch.from_data_list(graphs).to(device)
+
+
+schedule = get_t_schedule(inference_steps=args.inference_steps, sigma_schedule='expbeta')
+start = time.perf_counter()
+denoising_schedule = DenoisingSchedule(args.inference_steps, schedule, schedule, schedule,
+                                       partial(t_to_sigma, args=model_args), model_args, no_final_step_noise=True,
+                                       temp_sampling=args.temp_sampling, temp_psi=temp_psi, temp_sigma_data=temp_sigma_data)
+print(f"DenoisingSchedule of {args.inference_steps} steps computed in {(time.perf_counter() - start) * 1e6:.1f} us")
+
+devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+for device in devices:
+    batch = get_batch(device)
+    scores = [(torch.randn(args.batch_size, 3, device=device), torch.randn(args.batch_size, 3, device=device),
+               torch.randn(args.batch_size * args.torsions, device=device)) for _ in range(args.inference_steps)]
+
+    torch.manual_seed(0)
+    reference_perturbs = denoise_reference(batch, scores, schedule, device)
+    torch.manual_seed(0)
+    schedule_perturbs = denoise_schedule(batch, scores, denoising_schedule, device)
+    max_difference = max((reference - perturb).abs().max().item() / reference.abs().max().item()
+                         for references, perturbs in zip(reference_perturbs, schedule_perturbs)
+                         for reference, perturb in zip(references, perturbs))
+    assert max_difference < 1e-6, max_difference
+
+    reference_time = benchmark(denoise_reference, device, batch, scores, schedule, device)
+    schedule_time = benchmark(denoise_schedule, device, batch, scores, denoising_schedule, device)
+    print(f"{device.type}: {reference_time:.1f} us per step with the scalars computed at every step, {schedule_time:.1f} us "
+          f"with the DenoisingSchedule ({reference_time / schedule_time:.1f}x), largest relative difference of the "
+          f"updates {max_difference:.1e}")
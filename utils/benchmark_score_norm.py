@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+# run as python utils/benchmark_score_norm.py, times only the score norm scaling at the end of the forward pass of the
+# score models (not the whole forward pass) with the NumPy lookups (a copy to the host and back every step) and with
+# the tables on the device
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import so3, torus
+
+parser = ArgumentParser()
+parser.add_argument('--batch_size', type=int, default=10, help='Number of poses in the batch')
+parser.add_argument('--torsions', type=int, default=8, help='Number of rotatable bonds per pose')
+parser.add_argument('--repeats', type=int, default=1000)
+args = parser.parse_args()
+
+
+def scale_host(rot_pred, tor_pred, rot_sigma, edge_sigma):
+    rot_pred = rot_pred * so3.score_norm(rot_sigma.cpu()).unsqueeze(1).to(rot_pred.device)
+    tor_pred = tor_pred * torch.sqrt(torch.tensor(torus.score_norm(edge_sigma.cpu().numpy())).float()
+                                     .to(tor_pred.device))
+    return rot_pred, tor_pred
+
+
+def scale_device(rot_pred, tor_pred, rot_sigma, edge_sigma, so3_table, torus_table):
+    rot_pred = rot_pred * so3.score_norm_tensor(rot_sigma, so3_table).unsqueeze(1)
+    tor_pred = tor_pred * torch.sqrt(torus.score_norm_tensor(edge_sigma, torus_table))
+    return rot_pred, tor_pred
+
+
+def benchmark(function, device, *inputs):
+    for _ in range(10):
+        function(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        outputs = function(*inputs)
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.repeats * 1e6, outputs
+
+
+devices = [torch.device('cpu')] + ([torch.device('cuda')] if torch.cuda.is_available() else [])
+for device in devices:
+    rot_pred = torch.randn(args.batch_size, 3, device=device)
+    tor_pred = torch.randn(args.batch_size * args.torsions, device=device)
+    rot_sigma = torch.full((args.batch_size,), 0.5, device=device)
+    edge_sigma = torch.full((args.batch_size * args.torsions,), 0.7, device=device)
+    so3_table, torus_table = so3.get_score_norm_table().to(device), torus.get_score_norm_table().to(device)
+
+    host_time, host_outputs = benchmark(scale_host, device, rot_pred, tor_pred, rot_sigma, edge_sigma)
+    device_time, device_outputs = benchmark(scale_device, device, rot_pred, tor_pred, rot_sigma, edge_sigma,
+                                            so3_table, torus_table)
+    assert all(torch.equal(host, device) for host, device in zip(host_outputs, device_outputs))
+    print(f"{device.type}: {host_time:.1f} us per score norm scaling with the NumPy lookups, {device_time:.1f} us with "
+          f"the tables on the device ({host_time / device_time:.1f}x)")
@@ -1,12 +1,17 @@
+import functools
 import math
+from collections import namedtuple
 import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
 from scipy.stats import beta
 
-from utils.geometry import axis_angle_to_matrix, rigid_transform_Kabsch_3D_torch, rigid_transform_Kabsch_3D_torch_batch
-from utils.torsion import modify_conformer_torsion_angles, modify_conformer_torsion_angles_batch
+from utils import so3, torus
+from utils.geometry import axis_angle_to_matrix, rigid_transform_Kabsch_3D_torch, rigid_transform_Kabsch_3D_torch_batch, \
+    rigid_transform_Kabsch_3D_torch_ragged
+from utils.torsion import modify_conformer_torsion_angles, modify_conformer_torsion_angles_batch, \
+    modify_conformer_torsion_angles_levels, modify_conformer_torsion_angles_ragged
 
 
 def sigmoid(t):
@@ -63,13 +68,57 @@ def modify_conformer_batch(orig_pos, data, tr_update, rot_update, torsion_update
 
     pos, edge_index, edge_mask = orig_pos.reshape(B, N, 3) + 0, data['ligand', 'ligand'].edge_index[:, :M], data['ligand'].edge_mask[:M]
     torsion_updates = torsion_updates.reshape(B, -1) if torsion_updates is not None else None
+    return modify_conformer_coordinates_batch(pos, edge_index.T[edge_mask], tr_update, rot_update, torsion_updates, mask_rotate)
 
+
+def modify_conformer_batch_ragged(orig_pos, data, tr_update, rot_update, torsion_updates, torsion_index):
+    # same as modify_conformer_batch for batches of different ligands, torsion_index comes from get_ragged_torsion_index
+    B, batch = data.num_graphs, data['ligand'].batch
+    counts = torch.bincount(batch, minlength=B).unsqueeze(1).to(orig_pos.dtype)
+    lig_center = torch.zeros((B, 3), device=orig_pos.device, dtype=orig_pos.dtype).index_add_(0, batch, orig_pos) / counts
+    rot_mat = axis_angle_to_matrix(rot_update)
+    rigid_new_pos = torch.bmm(rot_mat[batch], (orig_pos - lig_center[batch]).unsqueeze(2)).squeeze(2) + tr_update[batch] + lig_center[batch]
+
+    if torsion_updates is not None:
+        flexible_new_pos = modify_conformer_torsion_angles_ragged(rigid_new_pos, torsion_index, torsion_updates)
+        R, t = rigid_transform_Kabsch_3D_torch_ragged(flexible_new_pos, rigid_new_pos, batch, B)
+        return torch.bmm(R[batch], flexible_new_pos.unsqueeze(2)).squeeze(2) + t.squeeze(2)[batch]
+    return rigid_new_pos
+
+
+def modify_conformer_batch_per_graph(orig_pos, data, tr_update, rot_update, torsion_updates, mask_rotate):
+    # reference for modify_conformer_batch_ragged that modifies the graphs one by one, mask_rotate is the list of the
+    # masks of the graphs
+    B = data.num_graphs
+    batch, edge_index, edge_mask = data['ligand'].batch, data['ligand', 'ligand'].edge_index, data['ligand'].edge_mask
+    edge_batch = batch[edge_index[0]]
+    node_ptr = [0] + torch.cumsum(torch.bincount(batch, minlength=B), dim=0).tolist()
+    edge_ptr = [0] + torch.cumsum(torch.bincount(edge_batch, minlength=B), dim=0).tolist()
+    tor_ptr = [0] + torch.cumsum(torch.bincount(edge_batch[edge_mask], minlength=B), dim=0).tolist()
+
+    new_pos = []
+    for i in range(B):
+        pos = orig_pos[node_ptr[i]:node_ptr[i + 1]].unsqueeze(0)
+        graph_edge_index = edge_index[:, edge_ptr[i]:edge_ptr[i + 1]] - node_ptr[i]
+        rotatable_bonds = graph_edge_index.T[edge_mask[edge_ptr[i]:edge_ptr[i + 1]]]
+        graph_torsion_updates = torsion_updates[tor_ptr[i]:tor_ptr[i + 1]].unsqueeze(0) if torsion_updates is not None else None
+        new_pos.append(modify_conformer_coordinates_batch(pos, rotatable_bonds, tr_update[i:i + 1], rot_update[i:i + 1],
+                                                          graph_torsion_updates, mask_rotate[i]))
+    return torch.cat(new_pos, dim=0)
+
+
+def modify_conformer_coordinates_batch(pos, rotatable_bonds, tr_update, rot_update, torsion_updates, mask_rotate):
+    # pos has the shape (B, N, 3), all graphs have the same rotatable bonds and mask_rotate. mask_rotate can also be the
+    # torsion index of the bonds from get_batch_torsion_index, which applies the torsion updates level by level
     lig_center = torch.mean(pos, dim=1, keepdim=True)
     rot_mat = axis_angle_to_matrix(rot_update)
     rigid_new_pos = torch.bmm(pos - lig_center, rot_mat.permute(0, 2, 1)) + tr_update.unsqueeze(1) + lig_center
 
     if torsion_updates is not None:
-        flexible_new_pos = modify_conformer_torsion_angles_batch(rigid_new_pos, edge_index.T[edge_mask], mask_rotate, torsion_updates)
+        if isinstance(mask_rotate, dict):
+            flexible_new_pos = modify_conformer_torsion_angles_levels(rigid_new_pos, mask_rotate, torsion_updates)
+        else:
+            flexible_new_pos = modify_conformer_torsion_angles_batch(rigid_new_pos, rotatable_bonds, mask_rotate, torsion_updates)
         R, t = rigid_transform_Kabsch_3D_torch_batch(flexible_new_pos, rigid_new_pos)
         aligned_flexible_pos = torch.bmm(flexible_new_pos, R.transpose(1, 2)) + t.transpose(1, 2)
         final_pos = aligned_flexible_pos.reshape(-1, 3)
@@ -96,13 +145,17 @@ def modify_conformer_coordinates(pos, tr_update, rot_update, torsion_updates, ed
         return rigid_new_pos
 
 
+@functools.lru_cache(maxsize=None)
+def _sinusoidal_frequencies(half_dim, max_positions, device):
+    # the same for every call of the embedding on a device, the models embed the times of every forward pass
+    emb = math.log(max_positions) / (half_dim - 1)
+    return torch.exp(torch.arange(half_dim, dtype=torch.float32, device=device) * -emb)
+
+
 def sinusoidal_embedding(timesteps, embedding_dim, max_positions=10000):
     """ from https://github.com/hojonathanho/diffusion/blob/master/diffusion_tf/nn.py   """
     assert len(timesteps.shape) == 1
-    half_dim = embedding_dim // 2
-    emb = math.log(max_positions) / (half_dim - 1)
-    emb = torch.exp(torch.arange(half_dim, dtype=torch.float32, device=timesteps.device) * -emb)
-    emb = timesteps.float()[:, None] * emb[None, :]
+    emb = timesteps.float()[:, None] * _sinusoidal_frequencies(embedding_dim // 2, max_positions, timesteps.device)[None, :]
     emb = torch.cat([torch.sin(emb), torch.cos(emb)], dim=1)
     if embedding_dim % 2 == 1:  # zero pad
         emb = F.pad(emb, (0, 1), mode='constant')
@@ -125,6 +178,13 @@ class GaussianFourierProjection(nn.Module):
         return emb
 
 
+def register_score_norm_tables(model):
+    # the score norm tables of the scale_by_sigma models, as buffers they stay on the device of the model and they are
+    # not part of the checkpoints
+    model.register_buffer('so3_score_norm_table', so3.get_score_norm_table(), persistent=False)
+    model.register_buffer('torus_score_norm_table', torus.get_score_norm_table(), persistent=False)
+
+
 def get_timestep_embedding(embedding_type, embedding_dim, embedding_scale=10000):
     if embedding_type == 'sinusoidal':
         emb_func = (lambda x : sinusoidal_embedding(embedding_scale * x, embedding_dim))
@@ -143,26 +203,123 @@ def get_t_schedule(sigma_schedule, inference_steps, inf_sched_alpha=1, inf_sched
     raise Exception()
 
 
-def set_time(complex_graphs, t, t_tr, t_rot, t_tor, batchsize, all_atoms, device, include_miscellaneous_atoms=False):
-    complex_graphs['ligand'].node_t = {
-        'tr': t_tr * torch.ones(complex_graphs['ligand'].num_nodes).to(device),
-        'rot': t_rot * torch.ones(complex_graphs['ligand'].num_nodes).to(device),
-        'tor': t_tor * torch.ones(complex_graphs['ligand'].num_nodes).to(device)}
-    complex_graphs['receptor'].node_t = {
-        'tr': t_tr * torch.ones(complex_graphs['receptor'].num_nodes).to(device),
-        'rot': t_rot * torch.ones(complex_graphs['receptor'].num_nodes).to(device),
-        'tor': t_tor * torch.ones(complex_graphs['receptor'].num_nodes).to(device)}
-    complex_graphs.complex_t = {'tr': t_tr * torch.ones(batchsize).to(device),
-                               'rot': t_rot * torch.ones(batchsize).to(device),
-                               'tor': t_tor * torch.ones(batchsize).to(device)}
-    if all_atoms:
-        complex_graphs['atom'].node_t = {
-            'tr': t_tr * torch.ones(complex_graphs['atom'].num_nodes).to(device),
-            'rot': t_rot * torch.ones(complex_graphs['atom'].num_nodes).to(device),
-            'tor': t_tor * torch.ones(complex_graphs['atom'].num_nodes).to(device)}
-
-    if include_miscellaneous_atoms and not all_atoms:
-        complex_graphs['misc_atom'].node_t = {
-            'tr': t_tr * torch.ones(complex_graphs['misc_atom'].num_nodes).to(device),
-            'rot': t_rot * torch.ones(complex_graphs['misc_atom'].num_nodes).to(device),
-            'tor': t_tor * torch.ones(complex_graphs['misc_atom'].num_nodes).to(device)}
+def _time_tensor(t, num, device, buffers, key):
+    if buffers is None:
+        return t * torch.ones(num).to(device)
+    # filled in place, the denoising steps of a batch don't allocate new tensors for the times
+    if (key, num) not in buffers:
+        buffers[(key, num)] = torch.empty(num, device=device)
+    return buffers[(key, num)].fill_(t)
+
+
+def _per_noise_type(value):
+    # a temperature for all three noise types or one for every noise type
+    try:
+        value = list(value)
+    except TypeError:
+        value = [value] * 3
+    assert len(value) == 3
+    return value
+
+
+DenoisingStep = namedtuple('DenoisingStep', ['t', 't_tr', 't_rot', 't_tor', 'tr_sigma', 'rot_sigma', 'tor_sigma', 'noise',
+                                             'tr_score_scale', 'rot_score_scale', 'tor_score_scale',
+                                             'tr_noise_scale', 'rot_noise_scale', 'tor_noise_scale'])
+
+
+class DenoisingSchedule:
+    """ The scalars of every step of the reverse diffusion in utils/sampling.py: the times, the sigmas and the factors
+    of the scores and of the noise in the updates, with the g of the SDEs and the temperatures already applied. They
+    only depend on the schedules and the model arguments, so they are computed once instead of at every step of every
+    batch. The update of a step is score_scale * score + noise_scale * z, with z only drawn when noise is set. """
+
+    def __init__(self, inference_steps, tr_schedule, rot_schedule, tor_schedule, t_to_sigma, model_args, t_schedule=None,
+                 ode=False, no_random=False, no_final_step_noise=False, temp_sampling=1.0, temp_psi=0.0,
+                 temp_sigma_data=0.5):
+        temp_sampling, temp_psi, temp_sigma_data = map(_per_noise_type, (temp_sampling, temp_psi, temp_sigma_data))
+        self.steps = []
+        for t_idx in range(inference_steps):
+            last_step = t_idx == inference_steps - 1
+            times = [schedule[t_idx] for schedule in (tr_schedule, rot_schedule, tor_schedule)]
+            dts = [schedule[t_idx] - schedule[t_idx + 1] if not last_step else schedule[t_idx]
+                   for schedule in (tr_schedule, rot_schedule, tor_schedule)]
+            sigmas = t_to_sigma(*times)
+
+            score_scales, noise_scales = [], []
+            for i, noise_type in enumerate(['tr', 'rot', 'tor']):
+                sigma_min, sigma_max = getattr(model_args, f'{noise_type}_sigma_min'), getattr(model_args, f'{noise_type}_sigma_max')
+                g = sigmas[i] * np.sqrt(2 * np.log(sigma_max / sigma_min))
+                if ode:
+                    score_scales.append(0.5 * g ** 2 * dts[i])
+                    noise_scales.append(0.0)
+                elif temp_sampling[i] != 1.0:
+                    sigma_data = np.exp(temp_sigma_data[i] * np.log(sigma_max) + (1 - temp_sigma_data[i]) * np.log(sigma_min))
+                    lambda_ = (sigma_data + sigmas[i]) / (sigma_data + sigmas[i] / temp_sampling[i])
+                    score_scales.append(g ** 2 * dts[i] * (lambda_ + temp_sampling[i] * temp_psi[i] / 2))
+                    noise_scales.append(g * np.sqrt(dts[i] * (1 + temp_psi[i])))
+                else:
+                    score_scales.append(g ** 2 * dts[i])
+                    noise_scales.append(g * np.sqrt(dts[i]))
+
+            noise = not (ode or no_random or (no_final_step_noise and last_step))
+            self.steps.append(DenoisingStep(t_schedule[t_idx] if t_schedule is not None else None, *times, *sigmas, noise,
+                                            *score_scales, *noise_scales))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, t_idx):
+        return self.steps[t_idx]
+
+
+def set_time(complex_graphs, t, t_tr, t_rot, t_tor, batchsize, all_atoms, device, include_miscellaneous_atoms=False,
+             buffers=None):
+    """ buffers is an optional dict that keeps the time tensors between the calls for the same batch, they are
+    overwritten by the next call """
+    node_types = ['ligand', 'receptor'] + (['atom'] if all_atoms else []) + \
+        (['misc_atom'] if include_miscellaneous_atoms and not all_atoms else [])
+    for node_type in node_types:
+        num_nodes = complex_graphs[node_type].num_nodes
+        complex_graphs[node_type].node_t = {
+            noise_type: _time_tensor(noise_t, num_nodes, device, buffers, (node_type, noise_type))
+            for noise_type, noise_t in [('tr', t_tr), ('rot', t_rot), ('tor', t_tor)]}
+    complex_graphs.complex_t = {noise_type: _time_tensor(noise_t, batchsize, device, buffers, ('complex', noise_type))
+                                for noise_type, noise_t in [('tr', t_tr), ('rot', t_rot), ('tor', t_tor)]}
+
+
+def test_modify_conformer_batch_ragged(num_graphs=16, seed=0):
+    # compares the ragged batch update with updating every ligand separately on random tree shaped ligands
+    from torch_geometric.data import HeteroData, Batch
+    from utils.torsion import get_transformation_mask
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    graphs = []
+    for _ in range(num_graphs):
+        num_atoms = int(rng.integers(2, 40))
+        tree = [(int(rng.integers(0, i)), i) for i in range(1, num_atoms)]
+        edges = torch.tensor([e for u, v in tree for e in [(u, v), (v, u)]]).T
+        graph = HeteroData()
+        graph['ligand'].pos = torch.randn(num_atoms, 3) * 3
+        graph['ligand', 'lig_bond', 'ligand'].edge_index = edges
+        edge_mask, mask_rotate = get_transformation_mask(graph)
+        graph['ligand'].edge_mask = torch.tensor(edge_mask)
+        graph['ligand'].mask_rotate = mask_rotate
+        graphs.append(graph)
+    data = Batch.from_data_list(graphs)
+    mask_rotate = [torch.from_numpy(graph['ligand'].mask_rotate) for graph in graphs]
+    tr_update, rot_update = torch.randn(num_graphs, 3), torch.randn(num_graphs, 3)
+    torsion_updates = torch.rand(int(data['ligand'].edge_mask.sum())) * 2 * np.pi - np.pi
+
+    from utils.torsion import get_ragged_torsion_index
+    ragged = modify_conformer_batch_ragged(data['ligand'].pos, data, tr_update, rot_update, torsion_updates,
+                                           get_ragged_torsion_index(data, mask_rotate))
+    per_graph = modify_conformer_batch_per_graph(data['ligand'].pos, data, tr_update, rot_update, torsion_updates, mask_rotate)
+    assert torch.allclose(ragged, per_graph, atol=1e-4), (ragged - per_graph).abs().max()
+    rigid = modify_conformer_batch_ragged(data['ligand'].pos, data, tr_update, rot_update, None, None)
+    assert torch.allclose(rigid, modify_conformer_batch_per_graph(data['ligand'].pos, data, tr_update, rot_update, None, mask_rotate), atol=1e-4)
+    print('test_modify_conformer_batch_ragged passed')
+    return True
+
+
+if __name__ == '__main__':
+    test_modify_conformer_batch_ragged()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for sbatch, to test the job submission of inferenceVS.py and relaunchFailedCompounds.py without a
+cluster. Only the standard library is used. Pass it with --sbatch "python utils/fake_sbatch.py".
+
+It reads the options of the command line and the #SBATCH lines of the script, runs the script (or --wrap) on this
+machine, once for every task of an --array with SLURM_ARRAY_TASK_ID set, and writes the output to --output. Unlike
+sbatch it only returns when all tasks finished. The tasks of an array run one at a time, or %N at a time. The resource
+options (--mem, -c, --gres, --time, -p, ...) are accepted and ignored.
+"""
+
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+# the options that don't take a value, all others do
+FLAG_OPTIONS = {'--parsable', '--wait', '-W', '--exclusive', '--requeue', '--no-requeue', '--hold', '-H', '--test-only'}
+OPTION_NAMES = {'-a': '--array', '-o': '--output', '-e': '--error', '-J': '--job-name', '-c': '--cpus-per-task'}
+
+
+def parse_options(tokens):
+    # returns the options by their long name and the remaining tokens (the script and its arguments)
+    options, i = {}, 0
+    while i < len(tokens) and tokens[i].startswith('-'):
+        option, value = tokens[i], True
+        if '=' in option:
+            option, value = option.split('=', 1)
+        elif option not in FLAG_OPTIONS and i + 1 < len(tokens):
+            value = tokens[i + 1]
+            i += 1
+        options[OPTION_NAMES.get(option, option)] = value
+        i += 1
+    return options, tokens[i:]
+
+
+def read_directives(script_path):
+    # the #SBATCH lines before the first command of the script
+    tokens = []
+    with open(script_path) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('#SBATCH'):
+                tokens += shlex.split(line[len('#SBATCH'):])
+            elif line and not line.startswith('#'):
+                break
+    return parse_options(tokens)[0]
+
+
+def parse_array(spec):
+    """ The task ids and the maximum number of concurrent tasks of an array specification like 1-100%10 or 1,3,5-9:2. """
+    spec, _, max_concurrent = spec.partition('%')
+    task_ids = []
+    for part in spec.split(','):
+        part, _, step = part.partition(':')
+        first, _, last = part.partition('-')
+        task_ids += range(int(first), int(last or first) + 1, int(step or 1))
+    return task_ids, int(max_concurrent) if max_concurrent else 1
+
+
+def get_output_path(pattern, job_id, task_id, job_name):
+    replacements = {'%A': str(job_id), '%a': str(task_id), '%j': str(job_id if task_id is None else f'{job_id}{task_id}'),
+                    '%x': job_name, '%%': '%'}
+    output_path, i = '', 0
+    while i < len(pattern):
+        if pattern[i:i + 2] in replacements:
+            output_path += replacements[pattern[i:i + 2]]
+            i += 2
+        else:
+            output_path += pattern[i]
+            i += 1
+    return output_path
+
+
+def main(argv):
+    options, command = parse_options(argv)
+    if '--wrap' in options:
+        command = ['sh', '-c', options['--wrap']]
+    elif command:
+        options = {**read_directives(command[0]), **options}
+        command = ['bash'] + command
+    else:
+        sys.exit('fake_sbatch: a script or --wrap is required')
+
+    job_id = os.getpid()
+    job_name = options.get('--job-name', 'fake_sbatch')
+    print(job_id if '--parsable' in options else f'Submitted batch job {job_id}', flush=True)
+
+    if '--array' in options:
+        task_ids, max_concurrent = parse_array(options['--array'])
+        default_output = 'slurm-%A_%a.out'
+    else:
+        task_ids, max_concurrent = [None], 1
+        default_output = 'slurm-%j.out'
+
+    running, failed = [], 0
+    for task_id in task_ids:
+        env = dict(os.environ, SLURM_JOB_ID=str(job_id), SLURM_JOB_NAME=job_name, SLURM_SUBMIT_DIR=os.getcwd())
+        if '--cpus-per-task' in options:
+            env['SLURM_CPUS_PER_TASK'] = str(options['--cpus-per-task'])
+        if task_id is not None:
+            env.update(SLURM_JOB_ID=f'{job_id}{task_id}', SLURM_ARRAY_JOB_ID=str(job_id),
+                       SLURM_ARRAY_TASK_ID=str(task_id), SLURM_ARRAY_TASK_COUNT=str(len(task_ids)),
+                       SLURM_ARRAY_TASK_MIN=str(min(task_ids)), SLURM_ARRAY_TASK_MAX=str(max(task_ids)))
+
+        # wait for a free slot
+        while len(running) >= max_concurrent:
+            for process in running:
+                if process.poll() is not None:
+                    failed += process.returncode != 0
+            running = [process for process in running if process.returncode is None]
+            if len(running) >= max_concurrent:
+                time.sleep(0.1)
+
+        output_path = get_output_path(options.get('--output', default_output), job_id, task_id, job_name)
+        with open(output_path, 'w') as output_file:
+            running.append(subprocess.Popen(command, stdout=output_file, stderr=subprocess.STDOUT, env=env))
+
+    for process in running:
+        failed += process.wait() != 0
+    if failed:
+        print(f'fake_sbatch: {failed} of {len(task_ids)} tasks of job {job_id} failed', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -276,6 +276,35 @@ def rigid_transform_Kabsch_3D_torch_batch(A, B):
     return R, t
 
 
+def rigid_transform_Kabsch_3D_torch_ragged(A, B, batch, num_graphs):
+    # same as rigid_transform_Kabsch_3D_torch_batch for the Nx3 points of graphs of different sizes, batch assigns
+    # every point to its graph. R = Gx3x3 rotation matrix, t = Gx3x1 column vector
+    assert A.shape == B.shape and A.shape[1] == 3
+
+    # find mean of every graph: G x 3
+    counts = torch.bincount(batch, minlength=num_graphs).unsqueeze(1).to(A.dtype)
+    centroid_A = torch.zeros((num_graphs, 3), device=A.device, dtype=A.dtype).index_add_(0, batch, A) / counts
+    centroid_B = torch.zeros((num_graphs, 3), device=A.device, dtype=A.dtype).index_add_(0, batch, B) / counts
+
+    # subtract mean and sum the outer products of every graph
+    Am = A - centroid_A[batch]
+    Bm = B - centroid_B[batch]
+    H = torch.zeros((num_graphs, 3, 3), device=A.device, dtype=A.dtype).index_add_(0, batch, Am.unsqueeze(2) * Bm.unsqueeze(1))
+
+    # find rotation
+    U, S, Vt = torch.linalg.svd(H)
+    R = torch.bmm(Vt.transpose(1, 2), U.transpose(1, 2))
+
+    # reflection case
+    SS = torch.diag(torch.tensor([1., 1., -1.], device=A.device))
+    Rm = torch.bmm(Vt.transpose(1,2) @ SS, U.transpose(1, 2))
+    R = torch.where(torch.linalg.det(R)[:, None, None] < 0, Rm, R)
+    assert torch.all(torch.abs(torch.linalg.det(R) - 1) < 3e-3)
+
+    t = torch.bmm(-R, centroid_A.unsqueeze(2)) + centroid_B.unsqueeze(2)
+    return R, t
+
+
 def rigid_transform_Kabsch_independent_torch(A, B):
     # R = 3x3 rotation matrix, t = 3x1 column vector
     # This already takes residue identity into account.
@@ -1,4 +1,7 @@
+import hashlib
+import json
 import os
+import shutil
 from esm import FastaBatchedDataset, pretrained
 from rdkit.Chem import AddHs, MolFromSmiles
 from torch_geometric.data import Dataset, HeteroData
@@ -7,8 +10,10 @@ import torch
 import prody as pr
 import esm
 
-from datasets.process_mols import generate_conformer, read_molecule, get_lig_graph_with_matching, moad_extract_receptor_structure
+from datasets.ligand_cache import get_ligand_cache, get_ligand_key, ligand_graph_to_entry, entry_to_ligand_graph
+from datasets.process_mols import generate_conformer, read_molecule, read_mol_block, get_lig_graph_with_matching, moad_extract_receptor_structure
 from datasets.parse_chi import aa_idx2aa_short, get_onehot_sequence
+from utils.ligand_library import LigandLibrary
 
 
 def get_sequences_from_pdbfile(file_path):
@@ -38,6 +43,82 @@ def get_sequences_from_pdbfile(file_path):
     return sequence
 
 
+def get_file_hash(file_path):
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def get_embedding_hash(lm_embedding):
+    # the precomputed ESM embeddings are a list with one tensor per chain
+    if lm_embedding is None:
+        return 'none'
+    sha = hashlib.sha256()
+    for chain_embedding in (lm_embedding if isinstance(lm_embedding, (list, tuple)) else [lm_embedding]):
+        chain_embedding = torch.as_tensor(chain_embedding).detach().cpu().contiguous()
+        sha.update(str(tuple(chain_embedding.shape)).encode())
+        sha.update(chain_embedding.numpy().tobytes())
+    return sha.hexdigest()
+
+
+def copy_receptor_graph(receptor_graph, complex_graph):
+    # attach the (shared) receptor tensors to the complex, the receptor is never modified in place afterwards
+    for node_type in receptor_graph.node_types:
+        for key, value in receptor_graph[node_type].items():
+            complex_graph[node_type][key] = value
+    for edge_type in receptor_graph.edge_types:
+        for key, value in receptor_graph[edge_type].items():
+            complex_graph[edge_type][key] = value
+    complex_graph.original_center = receptor_graph.original_center
+
+
+def save_receptor_graph(receptor_graph, cache_path):
+    # every tensor is written to its own .npy file so that the workers can memory-map them
+    tmp_path = f'{cache_path}.tmp-{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+    index = {'tensors': {}, 'attributes': {}}
+    stores = [(node_type, receptor_graph[node_type]) for node_type in receptor_graph.node_types] + \
+             [(edge_type, receptor_graph[edge_type]) for edge_type in receptor_graph.edge_types] + \
+             [(None, receptor_graph)]
+    for store_key, store in stores:
+        store_name = '__'.join(store_key) if isinstance(store_key, tuple) else (store_key or 'graph')
+        items = [('original_center', receptor_graph.original_center)] if store_key is None else store.items()
+        for key, value in items:
+            if torch.is_tensor(value):
+                file_name = f'{store_name}__{key}.npy'
+                np.save(os.path.join(tmp_path, file_name), value.cpu().numpy())
+                index['tensors'][file_name] = [store_key, key]
+            else:
+                index['attributes'][f'{store_name}__{key}'] = [store_key, key, value]
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+    # publish atomically, another job might have written the same receptor in the meantime
+    try:
+        os.rename(tmp_path, cache_path)
+    except OSError:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_receptor_graph(cache_path):
+    with open(os.path.join(cache_path, 'index.json')) as f:
+        index = json.load(f)
+    receptor_graph = HeteroData()
+    entries = [(store_key, key, torch.from_numpy(np.load(os.path.join(cache_path, file_name), mmap_mode='c')))
+               for file_name, (store_key, key) in index['tensors'].items()] + \
+              [tuple(entry) for entry in index['attributes'].values()]
+    for store_key, key, value in entries:
+        if store_key is None:
+            receptor_graph[key] = value
+        elif isinstance(store_key, list):
+            receptor_graph[tuple(store_key)][key] = value
+        else:
+            receptor_graph[store_key][key] = value
+    return receptor_graph
+
+
 def set_nones(l):
     return [s if str(s) != 'nan' else None for s in l]
 
@@ -118,7 +199,8 @@ def generate_ESM_structure(model, filename, sequence):
 class InferenceDataset(Dataset):
     def __init__(self, out_dir, complex_names, protein_files, ligand_descriptions, protein_sequences, lm_embeddings,
                  receptor_radius=30, c_alpha_max_neighbors=None, precomputed_lm_embeddings=None,
-                 remove_hs=False, all_atoms=False, atom_radius=5, atom_max_neighbors=None, knn_only_graph=False):
+                 remove_hs=False, all_atoms=False, atom_radius=5, atom_max_neighbors=None, knn_only_graph=False,
+                 receptor_cache_dir=None, ligand_cache_path=None):
 
         super(InferenceDataset, self).__init__()
         self.receptor_radius = receptor_radius
@@ -128,6 +210,13 @@ class InferenceDataset(Dataset):
         self.atom_radius, self.atom_max_neighbors = atom_radius, atom_max_neighbors
         self.knn_only_graph = knn_only_graph
 
+        # receptor graphs are featurized once per protein file content and graph parameters
+        self.receptor_cache = {}
+        self.protein_file_hashes = {}
+        self.embedding_hashes = {}
+        self.receptor_cache_dir = receptor_cache_dir
+        self.ligand_cache_path = ligand_cache_path
+
         self.complex_names = complex_names
         self.protein_files = protein_files
         self.ligand_descriptions = ligand_descriptions
@@ -182,65 +271,166 @@ class InferenceDataset(Dataset):
     def len(self):
         return len(self.complex_names)
 
-    def get(self, idx):
+    def share_receptor_cache(self, dataset):
+        # the receptors featurized for an earlier batch of complexes are reused. The embedding hashes are keyed by the
+        # id of the embedding objects of a dataset, sharing them would keep the embeddings of every batch alive
+        self.receptor_cache = dataset.receptor_cache
+        self.protein_file_hashes = dataset.protein_file_hashes
+
+    def get_receptor_key(self, protein_file, lm_embedding):
+        # the hash is renewed when the file was modified, a worker of a --work_queue can dock the runs of many days
+        mtime = os.path.getmtime(protein_file)
+        if self.protein_file_hashes.get(protein_file, (None, None))[0] != mtime:
+            self.protein_file_hashes[protein_file] = (mtime, get_file_hash(protein_file))
+        # the embedding objects are shared between all complexes of the same protein
+        if id(lm_embedding) not in self.embedding_hashes:
+            self.embedding_hashes[id(lm_embedding)] = (lm_embedding, get_embedding_hash(lm_embedding))
+        params = (self.receptor_radius, self.c_alpha_max_neighbors, self.all_atoms, self.atom_radius,
+                  self.atom_max_neighbors, self.knn_only_graph)
+        key = f'{self.protein_file_hashes[protein_file][1]}_{self.embedding_hashes[id(lm_embedding)][1]}_{params}'
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get_receptor_graph(self, protein_file, lm_embedding):
+        key = self.get_receptor_key(protein_file, lm_embedding)
+        cache_path = os.path.join(self.receptor_cache_dir, key) if self.receptor_cache_dir else None
+        if key not in self.receptor_cache and cache_path is not None and os.path.exists(os.path.join(cache_path, 'index.json')):
+            self.receptor_cache[key] = load_receptor_graph(cache_path)
+
+        if key not in self.receptor_cache:
+            receptor_graph = HeteroData()
+            try:
+                moad_extract_receptor_structure(
+                    path=os.path.join(protein_file),
+                    complex_graph=receptor_graph,
+                    neighbor_cutoff=self.receptor_radius,
+                    max_neighbors=self.c_alpha_max_neighbors,
+                    lm_embeddings=lm_embedding,
+                    knn_only_graph=self.knn_only_graph,
+                    all_atoms=self.all_atoms,
+                    atom_cutoff=self.atom_radius,
+                    atom_max_neighbors=self.atom_max_neighbors)
+            except Exception as e:
+                # remember the failure so that the receptor is not parsed again for every ligand
+                self.receptor_cache[key] = e
+                raise e
 
-        name, protein_file, ligand_description, lm_embedding = \
-            self.complex_names[idx], self.protein_files[idx], self.ligand_descriptions[idx], self.lm_embeddings[idx]
+            protein_center = torch.mean(receptor_graph['receptor'].pos, dim=0, keepdim=True)
+            receptor_graph['receptor'].pos -= protein_center
+            if self.all_atoms:
+                receptor_graph['atom'].pos -= protein_center
+            receptor_graph.original_center = protein_center
+            self.receptor_cache[key] = receptor_graph
 
-        # build the pytorch geometric heterogeneous graph
-        complex_graph = HeteroData()
-        complex_graph['name'] = name
+            if cache_path is not None:
+                os.makedirs(self.receptor_cache_dir, exist_ok=True)
+                save_receptor_graph(receptor_graph, cache_path)
 
-        # parse the ligand, either from file or smile
-        try:
-            mol = MolFromSmiles(ligand_description)  # check if it is a smiles or a path
+        if isinstance(self.receptor_cache[key], Exception):
+            raise self.receptor_cache[key]
+        return self.receptor_cache[key]
 
-            if mol is not None:
-                mol = AddHs(mol)
-                generate_conformer(mol)
-            else:
-                mol = read_molecule(ligand_description, remove_hs=False, sanitize=True)
-                if mol is None:
-                    raise Exception('RDKit could not read the molecule ', ligand_description)
-                mol.RemoveAllConformers()
-                mol = AddHs(mol)
-                generate_conformer(mol)
-        except Exception as e:
-            print('Failed to read molecule ', ligand_description, ' We are skipping it. The reason is the exception: ', e)
-            complex_graph['success'] = False
-            return complex_graph
+    def get(self, idx):
+        return self.add_receptor_graph(self.get_ligand_graph(idx), idx)
+
+    def get_ligand_description(self, idx):
+        # the records of a ligand library are only read when they are needed
+        if isinstance(self.ligand_descriptions, LigandLibrary):
+            return self.ligand_descriptions.get_record(idx)
+        return self.ligand_descriptions[idx]
 
+    def get_ligand_graph(self, idx):
+        return get_inference_ligand_graph(self.complex_names[idx], self.get_ligand_description(idx), self.remove_hs,
+                                          self.ligand_cache_path)
+
+    def add_receptor_graph(self, complex_graph, idx):
+        if not complex_graph['success']:
+            return complex_graph
+        name, protein_file, lm_embedding = self.complex_names[idx], self.protein_files[idx], self.lm_embeddings[idx]
         try:
-            # parse the receptor from the pdb file
-            get_lig_graph_with_matching(mol, complex_graph, popsize=None, maxiter=None, matching=False, keep_original=False,
-                                        num_conformers=1, remove_hs=self.remove_hs)
-
-            moad_extract_receptor_structure(
-                path=os.path.join(protein_file),
-                complex_graph=complex_graph,
-                neighbor_cutoff=self.receptor_radius,
-                max_neighbors=self.c_alpha_max_neighbors,
-                lm_embeddings=lm_embedding,
-                knn_only_graph=self.knn_only_graph,
-                all_atoms=self.all_atoms,
-                atom_cutoff=self.atom_radius,
-                atom_max_neighbors=self.atom_max_neighbors)
+            # parse the receptor from the pdb file (or reuse the already featurized receptor)
+            copy_receptor_graph(self.get_receptor_graph(protein_file, lm_embedding), complex_graph)
+            complex_graph.receptor_key = self.get_receptor_key(protein_file, lm_embedding)
 
         except Exception as e:
             print(f'Skipping {name} because of the error:')
             print(e)
             complex_graph['success'] = False
-            return complex_graph
+        return complex_graph
+
 
-        protein_center = torch.mean(complex_graph['receptor'].pos, dim=0, keepdim=True)
-        complex_graph['receptor'].pos -= protein_center
-        if self.all_atoms:
-            complex_graph['atom'].pos -= protein_center
+def get_inference_ligand_graph(name, ligand_description, remove_hs, ligand_cache_path=None):
+    # the ligand part of InferenceDataset.get, it does not depend on the receptor so it can run in a worker process
 
-        ligand_center = torch.mean(complex_graph['ligand'].pos, dim=0, keepdim=True)
-        complex_graph['ligand'].pos -= ligand_center
+    # build the pytorch geometric heterogeneous graph
+    complex_graph = HeteroData()
+    complex_graph['name'] = name
+
+    # parse the ligand, either from a record of a library, file or smile
+    try:
+        if not isinstance(ligand_description, str):
+            # an empty ligand_description of the csv is None after set_nones
+            raise Exception('No ligand description for ', name)
+        if '\n' in ligand_description:
+            mol = read_mol_block(ligand_description, remove_hs=False, sanitize=True)
+            if mol is None:
+                raise Exception('RDKit could not read the record of ', name)
+            mol.RemoveAllConformers()
+        else:
+            mol = MolFromSmiles(ligand_description)  # check if it is a smiles or a path
+        if mol is None:
+            mol = read_molecule(ligand_description, remove_hs=False, sanitize=True)
+            if mol is None:
+                raise Exception('RDKit could not read the molecule ', ligand_description)
+            mol.RemoveAllConformers()
+
+        # the conformer and the graph of a molecule that was prepared before are reused
+        ligand_cache = get_ligand_cache(ligand_cache_path) if ligand_cache_path else None
+        ligand_key = get_ligand_key(mol) if ligand_cache is not None else None
+        entry = ligand_cache.get(ligand_key, remove_hs) if ligand_cache is not None else None
+        if entry is not None:
+            entry_to_ligand_graph(entry, complex_graph)
+            complex_graph['success'] = True
+            return complex_graph
+
+        mol = AddHs(mol)
+        generate_conformer(mol)
+    except Exception as e:
+        print('Failed to read molecule ', name, ' We are skipping it. The reason is the exception: ', e)
+        complex_graph['success'] = False
+        return complex_graph
 
-        complex_graph.original_center = protein_center
-        complex_graph.mol = mol
-        complex_graph['success'] = True
+    try:
+        get_lig_graph_with_matching(mol, complex_graph, popsize=None, maxiter=None, matching=False, keep_original=False,
+                                    num_conformers=1, remove_hs=remove_hs)
+    except Exception as e:
+        print(f'Skipping {name} because of the error:')
+        print(e)
+        complex_graph['success'] = False
         return complex_graph
+
+    ligand_center = torch.mean(complex_graph['ligand'].pos, dim=0, keepdim=True)
+    complex_graph['ligand'].pos -= ligand_center
+
+    complex_graph.mol = mol
+    complex_graph['success'] = True
+    if ligand_cache is not None:
+        try:
+            ligand_cache.put(ligand_key, remove_hs, ligand_graph_to_entry(complex_graph))
+        except Exception as e:
+            print(f'Could not add {name} to the ligand cache because of the error:', e)
+    return complex_graph
+
+
+def get_ligand_tasks(datasets):
+    # the tasks of prepare_ligand_graphs for all complexes: the index of the complex and the arguments of
+    # get_inference_ligand_graph for every dataset. They are generated lazily so that a ligand library is streamed
+    return ((idx, [(dataset.complex_names[idx], dataset.get_ligand_description(idx), dataset.remove_hs,
+                    dataset.ligand_cache_path) for dataset in datasets])
+            for idx in range(len(datasets[0])))
+
+
+def prepare_ligand_graphs(task):
+    # prepares the ligand graphs of one complex in a worker process, the receptors are added by the datasets in the main
+    # process with add_receptor_graph since they are shared between the complexes
+    idx, ligands = task
+    return [get_inference_ligand_graph(*ligand) for ligand in ligands]
@@ -0,0 +1,152 @@
+import gzip
+import itertools
+import os
+import re
+from array import array
+
+# multi-record files that are docked as a library of ligands instead of one file per ligand. Only the standard library
+# is used so that inferenceVS.py can index a library outside of the container
+LIBRARY_EXTENSIONS = ('.sdf', '.sdf.gz', '.smi', '.smi.gz')
+
+
+def is_ligand_library(path):
+    return path.endswith(LIBRARY_EXTENSIONS)
+
+
+def open_library(library_path):
+    # gzipped libraries can only be read sequentially, seeking forward decompresses the skipped part
+    return gzip.open(library_path, 'rb') if library_path.endswith('.gz') else open(library_path, 'rb')
+
+
+def get_library_index_path(library_path):
+    return f'{library_path}.idx'
+
+
+def iter_library_records(file, is_sdf):
+    # yields the byte offset and the bytes of every record, an sdf record ends with its $$$$ line
+    offset, record_offset, record = 0, 0, []
+    for line_number, line in enumerate(file):
+        if is_sdf:
+            record.append(line)
+            if line.startswith(b'$$$$'):
+                yield record_offset, b''.join(record)
+                record_offset, record = offset + len(line), []
+        elif line.strip() and not line.startswith(b'#') and not (line_number == 0 and line.split()[0].lower() in (b'smiles', b'smi')):
+            yield offset, line
+        offset += len(line)
+    # the last sdf record might not be terminated
+    if is_sdf and b''.join(record).strip():
+        yield record_offset, b''.join(record)
+
+
+def get_record_name(record, is_sdf, index):
+    # the title line of an sdf record or the second column of a smiles line, made usable in file names
+    if is_sdf:
+        name = record.split(b'\n', 1)[0].strip()
+    else:
+        columns = record.split()
+        name = columns[1] if len(columns) > 1 else b''
+    name = re.sub(r'[^A-Za-z0-9._-]', '_', name.decode(errors='replace'))
+    return name if name else f'record_{index}'
+
+
+def build_library_index(library_path, index_path=None):
+    """ Writes the byte offsets of all records of the library (and the end of the last one) as int64 to index_path and
+    the record names, one per line, to index_path.names. The names are unique, a repeated name gets the suffix
+    _record_{index}. Returns the number of records. """
+    index_path = index_path or get_library_index_path(library_path)
+    is_sdf = library_path.endswith(('.sdf', '.sdf.gz'))
+    offsets, names, seen_names = array('q'), [], set()
+    end = 0
+    with open_library(library_path) as file:
+        for index, (offset, record) in enumerate(iter_library_records(file, is_sdf)):
+            offsets.append(offset)
+            # records with the same title (e.g. the protonation states of a compound) get their own outputs
+            name = get_record_name(record, is_sdf, index)
+            while name in seen_names:
+                name = f'{name}_record_{index}'
+            seen_names.add(name)
+            names.append(name)
+            end = offset + len(record)
+    offsets.append(end)
+
+    # written under a temporary name first, another job might be indexing the same library
+    tmp_path = f'{index_path}.tmp-{os.getpid()}'
+    with open(f'{tmp_path}.names', 'w') as f:
+        f.write(''.join(f'{name}\n' for name in names))
+    with open(tmp_path, 'wb') as f:
+        offsets.tofile(f)
+    os.replace(f'{tmp_path}.names', f'{index_path}.names')
+    os.replace(tmp_path, index_path)
+    return len(names)
+
+
+def get_library_index(library_path, index_path=None):
+    # the index is built once and reused as long as the library is not modified
+    index_path = index_path or get_library_index_path(library_path)
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(library_path):
+        build_library_index(library_path, index_path)
+    return index_path
+
+
+class LigandLibrary:
+    """ The records start to end of a library with an index. It is a sequence of short descriptions of the records
+    (used in the messages), get_names gives their names and get_record reads a record. Reading the records in order
+    streams the library. """
+
+    def __init__(self, library_path, index_path=None, start=0, end=None):
+        self.library_path = library_path
+        self.index_path = get_library_index(library_path, index_path)
+        self.is_sdf = library_path.endswith(('.sdf', '.sdf.gz'))
+        num_records = os.path.getsize(self.index_path) // 8 - 1
+        self.start, self.end = min(start, num_records), num_records if end is None else min(end, num_records)
+        self.file, self.pid = None, None
+
+    def __len__(self):
+        return max(self.end - self.start, 0)
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return f'{self.library_path}:{self.start + idx}'
+
+    def get_names(self):
+        with open(f'{self.index_path}.names') as f:
+            return [name.rstrip('\n') for name in itertools.islice(f, self.start, self.end)]
+
+    def get_offsets(self, idx):
+        offsets = array('q')
+        with open(self.index_path, 'rb') as f:
+            f.seek(8 * (self.start + idx))
+            offsets.fromfile(f, 2)
+        return offsets
+
+    def get_record(self, idx):
+        """ The mol block of an sdf record or the SMILES of a smiles record. """
+        if self.file is None or self.pid != os.getpid():
+            self.file, self.pid = open_library(self.library_path), os.getpid()
+        start, end = self.get_offsets(idx)
+        self.file.seek(start)
+        record = self.file.read(end - start).decode()
+        return record if self.is_sdf else record.split()[0]
+
+
+def test_duplicate_names():
+    # records with the same title get unique names, the first one keeps the title
+    import tempfile
+
+    records = ['CPD1', 'CPD1', 'CPD2', '', 'CPD1', 'CPD1_record_4']
+    with tempfile.TemporaryDirectory() as library_dir:
+        library_path = os.path.join(library_dir, 'library.sdf')
+        with open(library_path, 'w') as f:
+            f.write(''.join(f'{title}\n  RDKit\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n' for title in records))
+        library = LigandLibrary(library_path)
+        names = library.get_names()
+        assert names == ['CPD1', 'CPD1_record_1', 'CPD2', 'record_3', 'CPD1_record_4', 'CPD1_record_4_record_5'], names
+        assert LigandLibrary(library_path, start=1, end=3).get_names() == names[1:3]
+        assert library.get_record(1).startswith('CPD1\n')
+    print(f'The {len(records)} records of the library got the unique names {names}')
+
+
+if __name__ == '__main__':
+    test_duplicate_names()
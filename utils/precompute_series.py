@@ -1,3 +1,13 @@
+import os
+import sys
+
+# run as python utils/precompute_series.py, the tables are written to the series cache of the repository (or to
+# DIFFDOCK_SERIES_CACHE) so that no job has to compute them
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import so3, torus
+from utils.series_cache import get_series_cache_dir
+
 print(f"Computing series...")
-import so3
-import torus
\ No newline at end of file
+so3.get_tables()
+torus.get_tables()
+print(f"Saved the tables in {get_series_cache_dir()}")
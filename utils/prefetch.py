@@ -0,0 +1,77 @@
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+import torch
+
+
+def init_prefetch_worker(num_threads):
+    # every worker prepares one item at a time, more threads per worker would oversubscribe the cores
+    torch.set_num_threads(num_threads)
+
+
+def prefetch_map(function, items, num_workers, depth=None, ordered=True, num_threads=1):
+    """ Applies function to the items in a pool of num_workers processes and yields (item, result) pairs while the
+    caller works on the previous results. At most depth items are being prepared or waiting to be consumed, which
+    bounds the memory. With ordered=False the results are yielded as soon as they are ready. If function raises, the
+    exception is yielded as the result of that item instead of stopping the iteration. If a worker dies (e.g. in a
+    segfault of a native library) the pool is restarted and the items that were being prepared are retried one at a
+    time, so that only the item that killed the worker is reported as failed. The workers are spawned so that they do
+    not inherit the CUDA context and the thread pools of the main process. """
+    depth = depth or 2 * num_workers
+    items = iter(items)
+    context = multiprocessing.get_context('spawn')
+
+    def new_executor():
+        return ProcessPoolExecutor(num_workers, mp_context=context, initializer=init_prefetch_worker, initargs=(num_threads,))
+
+    executor, pending, suspects, isolated = new_executor(), deque(), deque(), False
+    try:
+        while True:
+            try:
+                if suspects:
+                    # items that were in the pool when a worker died are prepared alone
+                    if not pending:
+                        item = suspects.popleft()
+                        pending.append((item, executor.submit(function, item)))
+                        isolated = True
+                else:
+                    isolated = False
+                    while len(pending) < depth:
+                        item = next(items, pending)  # pending stands for no more items
+                        if item is pending:
+                            break
+                        pending.append((item, executor.submit(function, item)))
+            except BrokenProcessPool:
+                # a worker died after the last result was collected, item was not submitted
+                suspects.extendleft(reversed([pending_item for pending_item, _ in pending] + [item]))
+                pending.clear()
+                executor.shutdown(wait=False)
+                executor = new_executor()
+                continue
+            if not pending:
+                break
+
+            if ordered:
+                position = 0
+            else:
+                wait([future for _, future in pending], return_when=FIRST_COMPLETED)
+                position = next(i for i, (_, future) in enumerate(pending) if future.done())
+            item, future = pending[position]
+            try:
+                result = future.result()
+            except BrokenProcessPool as e:
+                executor.shutdown(wait=False)
+                executor = new_executor()
+                if not isolated:
+                    suspects.extend(item for item, _ in pending)
+                    pending.clear()
+                    continue
+                result = e
+            except Exception as e:
+                result = e
+            del pending[position]
+            yield item, result
+    finally:
+        executor.shutdown()
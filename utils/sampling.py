@@ -3,12 +3,15 @@ import random
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 
-from utils.diffusion_utils import modify_conformer, set_time, modify_conformer_batch
-from utils.torsion import modify_conformer_torsion_angles
-from scipy.spatial.transform import Rotation as R
+from utils.batching import has_shared_receptor, shared_receptor_loader
+from utils.diffusion_utils import DenoisingSchedule, modify_conformer, set_time, modify_conformer_batch, modify_conformer_batch_ragged
+from utils.geometry import quaternion_to_matrix
+from utils.torsion import get_batch_torsion_index, get_ragged_torsion_index, \
+    get_list_torsion_index, modify_conformer_torsion_angles_ragged
 from utils.utils import crop_beyond
 from utils.logging_utils import get_logger
 
@@ -28,90 +31,115 @@ def randomize_position(data_list, no_torsion, no_random, tr_sigma_max, pocket_kn
             print("No pocket residue below minimum distance ", pocket_cutoff, "taking closest at", torch.min(d))
             center_pocket = complex['receptor'].pos[torch.argmin(torch.min(d, dim=1)[0])]
 
+    # all poses are randomized at once on their concatenated positions
+    num_nodes = [complex_graph['ligand'].num_nodes for complex_graph in data_list]
+    pos = torch.cat([complex_graph['ligand'].pos for complex_graph in data_list], dim=0)
+    batch = torch.repeat_interleave(torch.arange(len(data_list), device=pos.device), torch.tensor(num_nodes, device=pos.device))
+
     if not no_torsion:
         # randomize torsion angles
-        for complex_graph in data_list:
-            torsion_updates = np.random.uniform(low=-np.pi, high=np.pi, size=complex_graph['ligand'].edge_mask.sum())
-            complex_graph['ligand'].pos = \
-                modify_conformer_torsion_angles(complex_graph['ligand'].pos,
-                                                complex_graph['ligand', 'ligand'].edge_index.T[
-                                                    complex_graph['ligand'].edge_mask],
-                                                complex_graph['ligand'].mask_rotate[0], torsion_updates)
-
-    for complex_graph in data_list:
-        # randomize position
-        molecule_center = torch.mean(complex_graph['ligand'].pos, dim=0, keepdim=True)
-        random_rotation = torch.from_numpy(R.random().as_matrix()).float()
-        complex_graph['ligand'].pos = (complex_graph['ligand'].pos - molecule_center) @ random_rotation.T + center_pocket
-        # base_rmsd = np.sqrt(np.sum((complex_graph['ligand'].pos.cpu().numpy() - orig_complex_graph['ligand'].pos.numpy()) ** 2, axis=1).mean())
-
-        if not no_random:  # note for now the torsion angles are still randomised
-            if choose_residue:
-                idx = random.randint(0, len(complex_graph['receptor'].pos)-1)
-                tr_update = torch.normal(mean=complex_graph['receptor'].pos[idx:idx+1], std=0.01)
-            elif initial_noise_std_proportion >= 0.0:
-                std_rec = torch.sqrt(torch.mean(torch.sum(complex_graph['receptor'].pos ** 2, dim=1)))
-                tr_update = torch.normal(mean=0, std=std_rec * initial_noise_std_proportion / 1.73, size=(1, 3))
-            else:
-                # if initial_noise_std_proportion < 0.0, we use the tr_sigma_max multiplied by -initial_noise_std_proportion
-                tr_update = torch.normal(mean=0, std=-initial_noise_std_proportion * tr_sigma_max, size=(1, 3))
-            complex_graph['ligand'].pos += tr_update
+        rotatable_bonds = [complex_graph['ligand', 'ligand'].edge_index.T[complex_graph['ligand'].edge_mask] for complex_graph in data_list]
+        torsion_index = get_list_torsion_index(rotatable_bonds, [get_mask_rotate(complex_graph) for complex_graph in data_list], pos.device)
+        torsion_updates = (torch.rand(len(torsion_index['bonds']), device=pos.device) * 2 - 1) * np.pi
+        pos = modify_conformer_torsion_angles_ragged(pos, torsion_index, torsion_updates)
+
+    # randomize position, normalized gaussian quaternions give uniformly random rotations
+    molecule_center = torch.zeros((len(data_list), 3), device=pos.device).index_add_(0, batch, pos) / \
+        torch.tensor(num_nodes, device=pos.device).unsqueeze(1)
+    random_rotation = quaternion_to_matrix(F.normalize(torch.randn(len(data_list), 4, device=pos.device), dim=1))
+    pos = torch.bmm(random_rotation[batch], (pos - molecule_center[batch]).unsqueeze(2)).squeeze(2) + center_pocket
+
+    if not no_random:  # note for now the torsion angles are still randomised
+        if choose_residue:
+            receptor_pos = [complex_graph['receptor'].pos for complex_graph in data_list]
+            tr_update = torch.stack([rec_pos[random.randint(0, len(rec_pos) - 1)] for rec_pos in receptor_pos])
+            tr_update = tr_update + torch.randn_like(tr_update) * 0.01
+        elif initial_noise_std_proportion >= 0.0:
+            std_rec = torch.stack([torch.sqrt(torch.mean(torch.sum(complex_graph['receptor'].pos ** 2, dim=1))) for complex_graph in data_list])
+            tr_update = torch.randn(len(data_list), 3, device=pos.device) * (std_rec * initial_noise_std_proportion / 1.73).unsqueeze(1)
+        else:
+            # if initial_noise_std_proportion < 0.0, we use the tr_sigma_max multiplied by -initial_noise_std_proportion
+            tr_update = torch.randn(len(data_list), 3, device=pos.device) * (-initial_noise_std_proportion * tr_sigma_max)
+        pos = pos + tr_update[batch]
+
+    for complex_graph, ligand_pos in zip(data_list, pos.split(num_nodes)):
+        complex_graph['ligand'].pos = ligand_pos
+
 
+def get_mask_rotate(complex_graph):
+    mask_rotate = complex_graph['ligand'].mask_rotate
+    return mask_rotate[0] if isinstance(mask_rotate, list) else mask_rotate
 
-def is_iterable(arr):
-    try:
-        some_object_iterator = iter(arr)
-        return True
-    except TypeError as te:
-        return False
+
+def has_same_ligand(data_list):
+    # modify_conformer_batch requires all graphs of a batch to have the same ligand graph
+    first = data_list[0]
+    return all(graph['ligand'].num_nodes == first['ligand'].num_nodes and
+               torch.equal(graph['ligand', 'ligand'].edge_index, first['ligand', 'ligand'].edge_index) and
+               np.array_equal(get_mask_rotate(graph), get_mask_rotate(first)) for graph in data_list[1:])
 
 
 def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_schedule, device, t_to_sigma, model_args,
              no_random=False, ode=False, visualization_list=None, confidence_model=None, confidence_data_list=None, confidence_model_args=None,
              t_schedule=None, batch_size=32, no_final_step_noise=False, pivot=None, return_full_trajectory=False,
-             temp_sampling=1.0, temp_psi=0.0, temp_sigma_data=0.5, return_features=False):
+             temp_sampling=1.0, temp_psi=0.0, temp_sigma_data=0.5, return_features=False, denoising_schedule=None):
+    # denoising_schedule is a DenoisingSchedule of the schedules and the sampling options, it replaces them when it is
+    # given, so that the callers that sample many times compute it only once
     N = len(data_list)
     trajectory = []
+    if denoising_schedule is None:
+        denoising_schedule = DenoisingSchedule(inference_steps, tr_schedule, rot_schedule, tor_schedule, t_to_sigma,
+                                               model_args, t_schedule=t_schedule, ode=ode, no_random=no_random,
+                                               no_final_step_noise=no_final_step_noise, temp_sampling=temp_sampling,
+                                               temp_psi=temp_psi, temp_sigma_data=temp_sigma_data)
     logger = get_logger()
     if return_features:
         lig_features, rec_features = [], []
         assert batch_size >= N, "Not implemented yet"
 
-    loader = DataLoader(data_list, batch_size=batch_size)
+    # complexes of the same receptor are batched with a single copy of it, unless the receptor is cropped per complex
+    if has_shared_receptor(data_list) and not (hasattr(model_args, 'crop_beyond') and model_args.crop_beyond is not None):
+        loader = shared_receptor_loader(data_list, batch_size)
+    else:
+        loader = DataLoader(data_list, batch_size=batch_size)
     assert not (return_full_trajectory or return_features or pivot), "Not implemented yet in new inference version"
 
-    mask_rotate = torch.from_numpy(data_list[0]['ligand'].mask_rotate[0]).to(device)
-
     confidence = None
     if confidence_model is not None:
-        confidence_loader = iter(DataLoader(confidence_data_list, batch_size=batch_size))
+        if confidence_data_list is not None and has_shared_receptor(confidence_data_list) and \
+                not (hasattr(confidence_model_args, 'crop_beyond') and confidence_model_args.crop_beyond is not None):
+            confidence_loader = shared_receptor_loader(confidence_data_list, batch_size)
+        else:
+            confidence_loader = iter(DataLoader(confidence_data_list, batch_size=batch_size))
         confidence = []
 
     with torch.no_grad():
         for batch_id, complex_graph_batch in enumerate(loader):
             b = complex_graph_batch.num_graphs
-            n = len(complex_graph_batch['ligand'].pos) // b
+            batch_graphs = data_list[batch_id * batch_size: batch_id * batch_size + b]
+            ligand_ptr = np.cumsum([0] + [graph['ligand'].num_nodes for graph in batch_graphs])
             complex_graph_batch = complex_graph_batch.to(device)
+            # batches of different ligands are packed together by inference.py, they need the ragged conformer updates
+            same_ligand = has_same_ligand(batch_graphs)
+            if same_ligand:
+                rotatable_bonds = batch_graphs[0]['ligand', 'ligand'].edge_index.T[batch_graphs[0]['ligand'].edge_mask]
+                mask_rotate = get_batch_torsion_index(rotatable_bonds, get_mask_rotate(batch_graphs[0]), device)
+            else:
+                mask_rotate = get_ragged_torsion_index(complex_graph_batch, [get_mask_rotate(graph) for graph in batch_graphs])
 
-            for t_idx in range(inference_steps):
-                t_tr, t_rot, t_tor = tr_schedule[t_idx], rot_schedule[t_idx], tor_schedule[t_idx]
-                dt_tr = tr_schedule[t_idx] - tr_schedule[t_idx + 1] if t_idx < inference_steps - 1 else tr_schedule[t_idx]
-                dt_rot = rot_schedule[t_idx] - rot_schedule[t_idx + 1] if t_idx < inference_steps - 1 else rot_schedule[t_idx]
-                dt_tor = tor_schedule[t_idx] - tor_schedule[t_idx + 1] if t_idx < inference_steps - 1 else tor_schedule[t_idx]
-
-                tr_sigma, rot_sigma, tor_sigma = t_to_sigma(t_tr, t_rot, t_tor)
-
+            time_buffers = {}
+            for t_idx, step in enumerate(denoising_schedule):
                 if hasattr(model_args, 'crop_beyond') and model_args.crop_beyond is not None:
-                    #print('Cropping beyond', tr_sigma * 3 + model_args.crop_beyond, 'for score model')
+                    #print('Cropping beyond', step.tr_sigma * 3 + model_args.crop_beyond, 'for score model')
                     mod_complex_graph_batch = copy.deepcopy(complex_graph_batch).to_data_list()
                     for batch in mod_complex_graph_batch:
-                        crop_beyond(batch, tr_sigma * 3 + model_args.crop_beyond, model_args.all_atoms)
+                        crop_beyond(batch, step.tr_sigma * 3 + model_args.crop_beyond, model_args.all_atoms)
                     mod_complex_graph_batch = Batch.from_data_list(mod_complex_graph_batch)
                 else:
                     mod_complex_graph_batch = complex_graph_batch
 
-                set_time(mod_complex_graph_batch, t_schedule[t_idx] if t_schedule is not None else None, t_tr, t_rot, t_tor, b,
-                         'all_atoms' in model_args and model_args.all_atoms, device)
+                set_time(mod_complex_graph_batch, step.t, step.t_tr, step.t_rot, step.t_tor, b,
+                         'all_atoms' in model_args and model_args.all_atoms, device, buffers=time_buffers)
 
                 tr_score, rot_score, tor_score = model(mod_complex_graph_batch)[:3]
                 mean_scores = torch.mean(tr_score, dim=-1)
@@ -130,75 +158,30 @@ def sampling(data_list, model, inference_steps, tr_schedule, rot_schedule, tor_s
                     tor_score.nan_to_num_(nan=(eps := 0.01*torch.nanmean(tor_score.abs())), posinf=eps, neginf=-eps)
                     del eps
 
-                tr_g = tr_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.tr_sigma_max / model_args.tr_sigma_min)))
-                rot_g = rot_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.rot_sigma_max / model_args.rot_sigma_min)))
-
-                if ode:
-                    tr_perturb = (0.5 * tr_g ** 2 * dt_tr * tr_score)
-                    rot_perturb = (0.5 * rot_score * dt_rot * rot_g ** 2)
-                else:
-                    tr_z = torch.zeros((min(batch_size, N), 3), device=device) if no_random or (no_final_step_noise and t_idx == inference_steps - 1) \
-                        else torch.normal(mean=0, std=1, size=(min(batch_size, N), 3), device=device)
-                    tr_perturb = (tr_g ** 2 * dt_tr * tr_score + tr_g * np.sqrt(dt_tr) * tr_z)
-
-                    rot_z = torch.zeros((min(batch_size, N), 3), device=device) if no_random or (no_final_step_noise and t_idx == inference_steps - 1) \
-                        else torch.normal(mean=0, std=1, size=(min(batch_size, N), 3), device=device)
-                    rot_perturb = (rot_score * dt_rot * rot_g ** 2 + rot_g * np.sqrt(dt_rot) * rot_z)
-
-                if not model_args.no_torsion:
-                    tor_g = tor_sigma * torch.sqrt(torch.tensor(2 * np.log(model_args.tor_sigma_max / model_args.tor_sigma_min)))
-                    if ode:
-                        tor_perturb = (0.5 * tor_g ** 2 * dt_tor * tor_score)
-                    else:
-                        tor_z = torch.zeros(tor_score.shape, device=device) if no_random or (no_final_step_noise and t_idx == inference_steps - 1) \
-                            else torch.normal(mean=0, std=1, size=tor_score.shape, device=device)
-                        tor_perturb = (tor_g ** 2 * dt_tor * tor_score + tor_g * np.sqrt(dt_tor) * tor_z)
-                    torsions_per_molecule = tor_perturb.shape[0] // b
-                else:
-                    tor_perturb = None
-
-                if not is_iterable(temp_sampling):
-                    temp_sampling = [temp_sampling] * 3
-                if not is_iterable(temp_psi):
-                    temp_psi = [temp_psi] * 3
-
-                if not is_iterable(temp_sampling): temp_sampling = [temp_sampling] * 3
-                if not is_iterable(temp_psi): temp_psi = [temp_psi] * 3
-                if not is_iterable(temp_sigma_data): temp_sigma_data = [temp_sigma_data] * 3
-
-                assert len(temp_sampling) == 3
-                assert len(temp_psi) == 3
-                assert len(temp_sigma_data) == 3
-
-                if temp_sampling[0] != 1.0:
-                    tr_sigma_data = np.exp(temp_sigma_data[0] * np.log(model_args.tr_sigma_max) + (1 - temp_sigma_data[0]) * np.log(model_args.tr_sigma_min))
-                    lambda_tr = (tr_sigma_data + tr_sigma) / (tr_sigma_data + tr_sigma / temp_sampling[0])
-                    tr_perturb = (tr_g ** 2 * dt_tr * (lambda_tr + temp_sampling[0] * temp_psi[0] / 2) * tr_score + tr_g * np.sqrt(dt_tr * (1 + temp_psi[0])) * tr_z)
-
-                if temp_sampling[1] != 1.0:
-                    rot_sigma_data = np.exp(temp_sigma_data[1] * np.log(model_args.rot_sigma_max) + (1 - temp_sigma_data[1]) * np.log(model_args.rot_sigma_min))
-                    lambda_rot = (rot_sigma_data + rot_sigma) / (rot_sigma_data + rot_sigma / temp_sampling[1])
-                    rot_perturb = (rot_g ** 2 * dt_rot * (lambda_rot + temp_sampling[1] * temp_psi[1] / 2) * rot_score + rot_g * np.sqrt(dt_rot * (1 + temp_psi[1])) * rot_z)
-
-                if temp_sampling[2] != 1.0:
-                    tor_sigma_data = np.exp(temp_sigma_data[2] * np.log(model_args.tor_sigma_max) + (1 - temp_sigma_data[2]) * np.log(model_args.tor_sigma_min))
-                    lambda_tor = (tor_sigma_data + tor_sigma) / (tor_sigma_data + tor_sigma / temp_sampling[2])
-                    tor_perturb = (tor_g ** 2 * dt_tor * (lambda_tor + temp_sampling[2] * temp_psi[2] / 2) * tor_score + tor_g * np.sqrt(dt_tor * (1 + temp_psi[2])) * tor_z)
+                tr_perturb = step.tr_score_scale * tr_score
+                rot_perturb = step.rot_score_scale * rot_score
+                tor_perturb = step.tor_score_scale * tor_score if not model_args.no_torsion else None
+                if step.noise:
+                    tr_perturb += step.tr_noise_scale * torch.normal(mean=0, std=1, size=(b, 3), device=device)
+                    rot_perturb += step.rot_noise_scale * torch.normal(mean=0, std=1, size=(b, 3), device=device)
+                    if tor_perturb is not None:
+                        tor_perturb += step.tor_noise_scale * torch.normal(mean=0, std=1, size=tor_score.shape, device=device)
 
                 # Apply noise
+                modify_positions = modify_conformer_batch if same_ligand else modify_conformer_batch_ragged
                 complex_graph_batch['ligand'].pos = \
-                    modify_conformer_batch(complex_graph_batch['ligand'].pos, complex_graph_batch, tr_perturb, rot_perturb,
-                                           tor_perturb if not model_args.no_torsion else None, mask_rotate)
+                    modify_positions(complex_graph_batch['ligand'].pos, complex_graph_batch, tr_perturb, rot_perturb,
+                                     tor_perturb if not model_args.no_torsion else None, mask_rotate)
 
                 if visualization_list is not None:
                     for idx_b in range(b):
                         visualization_list[batch_id * batch_size + idx_b].add((
-                                complex_graph_batch['ligand'].pos[idx_b*n:n*(idx_b+1)].detach().cpu() +
+                                complex_graph_batch['ligand'].pos[ligand_ptr[idx_b]:ligand_ptr[idx_b + 1]].detach().cpu() +
                                 data_list[batch_id * batch_size + idx_b].original_center.detach().cpu()),
                                 part=1, order=t_idx + 2)
 
             for i in range(b):
-               data_list[batch_id * batch_size + i]['ligand'].pos = complex_graph_batch['ligand'].pos[i*n:n*(i+1)]
+               data_list[batch_id * batch_size + i]['ligand'].pos = complex_graph_batch['ligand'].pos[ligand_ptr[i]:ligand_ptr[i + 1]]
 
             if visualization_list is not None:
                 for idx, visualization in enumerate(visualization_list):
@@ -0,0 +1,45 @@
+import os
+import warnings
+
+import numpy as np
+
+"""
+    Storage of the precomputed series tables of utils/so3.py and utils/torus.py. The tables are kept in one directory
+    (DIFFDOCK_SERIES_CACHE, by default data/series_cache/ in the repository, independent of the working directory),
+    their file names carry a version that is increased when the tables change, and they are memory-mapped so that
+    every process only reads the rows it uses. utils/precompute_series.py builds them ahead of time
+"""
+
+SERIES_CACHE_ENV = 'DIFFDOCK_SERIES_CACHE'
+
+
+def get_series_cache_dir():
+    default_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'series_cache')
+    return os.environ.get(SERIES_CACHE_ENV) or default_dir
+
+
+def get_table_path(prefix, version, name):
+    return os.path.join(get_series_cache_dir(), f'{prefix}_v{version}_{name}.npy')
+
+
+def load_tables(prefix, version, names, compute_tables, legacy_paths=None):
+    """ The tables {name: array} of prefix, memory-mapped from the cache directory. Missing tables are computed with
+    compute_tables(tables), which gets the tables that were found in the legacy files (legacy_paths {name: path}, the
+    unversioned files of older versions in the working directory) and returns all of them, and they are saved. """
+    paths = {name: get_table_path(prefix, version, name) for name in names}
+    if all(os.path.exists(path) for path in paths.values()):
+        return {name: np.load(path, mmap_mode='r') for name, path in paths.items()}
+
+    tables = {name: np.load(path, mmap_mode='r') for name, path in (legacy_paths or {}).items() if os.path.exists(path)}
+    tables = compute_tables(tables)
+    try:
+        os.makedirs(get_series_cache_dir(), exist_ok=True)
+        for name, path in paths.items():
+            # written under a temporary name first, other jobs might be loading or writing the same tables
+            tmp_path = f'{path[:-len(".npy")]}.tmp-{os.getpid()}.npy'
+            np.save(tmp_path, tables[name])
+            os.replace(tmp_path, path)
+    except OSError as e:
+        warnings.warn(f'Could not save the {prefix} tables in {get_series_cache_dir()}, they are recomputed by every '
+                      f'process. Set {SERIES_CACHE_ENV} to a writable directory: {e}')
+    return tables
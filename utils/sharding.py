@@ -0,0 +1,51 @@
+import heapq
+
+# only the standard library is used so that inferenceVS.py and relaunchFailedCompounds.py can shard outside of the
+# container
+
+
+def split_by_cost(costs, num_shards):
+    """ Longest-processing-time-first bin packing: the items are assigned from the most to the least expensive to the
+    shard with the lowest total cost so far. Returns the indices of the items of every shard in their original order,
+    there are never more shards than items. """
+    num_shards = min(num_shards, len(costs))
+    shards = [[] for _ in range(num_shards)]
+    totals = [(0, shard) for shard in range(num_shards)]
+    for idx in sorted(range(len(costs)), key=lambda idx: -costs[idx]):
+        total, shard = heapq.heappop(totals)
+        shards[shard].append(idx)
+        heapq.heappush(totals, (total + costs[idx], shard))
+    return [sorted(shard) for shard in shards]
+
+
+def split_contiguous_by_cost(costs, num_shards):
+    """ Splits the items into at most num_shards ranges of about the same total cost, for inputs that are streamed in
+    order like the records of a ligand library. A range starts at the item whose middle passes the next multiple of
+    the total cost divided by num_shards. """
+    num_shards = min(num_shards, len(costs))
+    if num_shards <= 0:
+        return []
+    total = sum(costs)
+    starts, cumulative = [0], 0
+    for idx, cost in enumerate(costs):
+        if len(starts) < num_shards and idx > starts[-1] and cumulative + cost / 2 > total * len(starts) / num_shards:
+            starts.append(idx)
+        cumulative += cost
+    return [range(start, end) for start, end in zip(starts, starts[1:] + [len(costs)])]
+
+
+def read_ligand_costs(path):
+    """ The complex names and costs of a ligand_costs.csv as written by estimateLigandCosts.py, in the order of the
+    input. """
+    names, costs = [], []
+    with open(path) as f:
+        next(f)
+        for line in f:
+            name, cost = line.rstrip('\n').rsplit(';', 1)
+            names.append(name)
+            costs.append(float(cost))
+    return names, costs
+
+
+def get_shard_costs(costs, shards):
+    return [sum(costs[idx] for idx in shard) for shard in shards]
@@ -1,14 +1,15 @@
-import os
 import numpy as np
 import torch
 from scipy.spatial.transform import Rotation
 
+from utils.series_cache import load_tables
+
 MIN_EPS, MAX_EPS, N_EPS = 0.0005, 4, 2000
 X_N = 2000
 
 """
     Preprocessing for the SO(3) sampling and score computations, truncated infinite series are computed and then
-    cached to memory, therefore the precomputation is only run the first time the repository is run on a machine
+    cached to disk (see utils/series_cache.py), therefore the precomputation is only run the first time they are used
 """
 
 omegas = np.linspace(0, np.pi, X_N + 1)[1:]
@@ -42,12 +43,14 @@ def _score(exp, omega, eps, L=2000):  # score of density over SO(3)
     return dSigma / exp
 
 
-if os.path.exists('.so3_omegas_array4.npy'):
-    _omegas_array = np.load('.so3_omegas_array4.npy')
-    _cdf_vals = np.load('.so3_cdf_vals4.npy')
-    _score_norms = np.load('.so3_score_norms4.npy')
-    _exp_score_norms = np.load('.so3_exp_score_norms4.npy')
-else:
+# increased when the tables change, so that outdated tables in the cache are not used
+SO3_TABLES_VERSION = 4
+_tables = None
+
+
+def _compute_tables(tables):
+    if len(tables) == 4:
+        return tables
     _eps_array = 10 ** np.linspace(np.log10(MIN_EPS), np.log10(MAX_EPS), N_EPS)
     _omegas_array = np.linspace(0, np.pi, X_N + 1)[1:]
 
@@ -57,11 +60,18 @@ else:
     _score_norms = np.asarray([_score(_exp_vals[i], _omegas_array, _eps_array[i]) for i in range(len(_eps_array))])
 
     _exp_score_norms = np.sqrt(np.sum(_score_norms**2 * _pdf_vals, axis=1) / np.sum(_pdf_vals, axis=1) / np.pi)
+    return {'omegas_array': _omegas_array, 'cdf_vals': _cdf_vals, 'score_norms': _score_norms,
+            'exp_score_norms': _exp_score_norms}
+
 
-    np.save('.so3_omegas_array4.npy', _omegas_array)
-    np.save('.so3_cdf_vals4.npy', _cdf_vals)
-    np.save('.so3_score_norms4.npy', _score_norms)
-    np.save('.so3_exp_score_norms4.npy', _exp_score_norms)
+def get_tables():
+    # the tables are only loaded (or computed the first time) when they are used, not when the module is imported
+    global _tables
+    if _tables is None:
+        names = ('omegas_array', 'cdf_vals', 'score_norms', 'exp_score_norms')
+        _tables = load_tables('so3', SO3_TABLES_VERSION, names, _compute_tables,
+                              legacy_paths={name: f'.so3_{name}4.npy' for name in names})
+    return _tables
 
 
 def sample(eps):
@@ -69,7 +79,7 @@ def sample(eps):
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS - 1)
 
     x = np.random.rand()
-    return np.interp(x, _cdf_vals[eps_idx], _omegas_array)
+    return np.interp(x, get_tables()['cdf_vals'][eps_idx], get_tables()['omegas_array'])
 
 
 def sample_vec(eps):
@@ -83,11 +93,23 @@ def score_vec(eps, vec):
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS - 1)
 
     om = np.linalg.norm(vec)
-    return np.interp(om, _omegas_array, _score_norms[eps_idx]) * vec / om
+    return np.interp(om, get_tables()['omegas_array'], get_tables()['score_norms'][eps_idx]) * vec / om
 
 
 def score_norm(eps):
     eps = eps.numpy()
     eps_idx = (np.log10(eps) - np.log10(MIN_EPS)) / (np.log10(MAX_EPS) - np.log10(MIN_EPS)) * N_EPS
     eps_idx = np.clip(np.around(eps_idx).astype(int), a_min=0, a_max=N_EPS-1)
-    return torch.from_numpy(_exp_score_norms[eps_idx]).float()
+    return torch.from_numpy(get_tables()['exp_score_norms'][eps_idx]).float()
+
+
+def get_score_norm_table():
+    # the expected score norms of score_norm as a tensor, the models keep it as a buffer on their device
+    return torch.from_numpy(np.array(get_tables()['exp_score_norms'])).float()
+
+
+def score_norm_tensor(eps, score_norm_table):
+    """ score_norm of eps on its device, without copies to the host. score_norm_table is get_score_norm_table() on the
+    device of eps. """
+    eps_idx = torch.log10(eps).sub_(np.log10(MIN_EPS)).div_(np.log10(MAX_EPS) - np.log10(MIN_EPS)).mul_(N_EPS)
+    return score_norm_table[eps_idx.round_().clamp_(0, N_EPS - 1).long()]
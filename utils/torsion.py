@@ -1,6 +1,7 @@
 import networkx as nx
 import numpy as np
 import torch, copy
+import torch.nn.functional as F
 from scipy.spatial.transform import Rotation as R
 from torch_geometric.utils import to_networkx
 from torch_geometric.data import Data
@@ -12,32 +13,105 @@ from utils.geometry import rigid_transform_Kabsch_independent_torch, axis_angle_
 """
 
 
+def get_smallest_components(num_nodes, edges):
+    """ For every undirected edge of a graph returns the nodes of the smallest connected component of the graph without
+    that edge, or None if the graph stays connected. Ties are broken by the smallest node index, as when sorting
+    nx.connected_components by size. The bridges are found in a single iterative depth first search (Tarjan) instead of
+    recomputing the components for every edge. """
+    edge_ids, adjacency = {}, [[] for _ in range(num_nodes)]
+    for u, v in edges:
+        key = (min(u, v), max(u, v))
+        if key not in edge_ids:  # like in nx.Graph, parallel edges are the same edge
+            edge_ids[key] = len(edge_ids)
+            adjacency[u].append((v, edge_ids[key]))
+            adjacency[v].append((u, edge_ids[key]))
+
+    # preorder index, low link, parent edge, subtree size and component of every node, and the child of every bridge
+    tin, low, parent_edge, size, component = [-1] * num_nodes, [0] * num_nodes, [-1] * num_nodes, [1] * num_nodes, [0] * num_nodes
+    order, roots, bridge_child = [], [], {}
+    for root in range(num_nodes):
+        if tin[root] >= 0:
+            continue
+        tin[root] = low[root] = len(order)
+        order.append(root)
+        component[root] = len(roots)
+        roots.append(root)
+        stack = [(root, iter(adjacency[root]))]
+        while stack:
+            node, neighbors = stack[-1]
+            for neighbor, edge_id in neighbors:
+                if edge_id == parent_edge[node]:
+                    continue
+                if tin[neighbor] < 0:
+                    parent_edge[neighbor] = edge_id
+                    tin[neighbor] = low[neighbor] = len(order)
+                    order.append(neighbor)
+                    component[neighbor] = component[root]
+                    stack.append((neighbor, iter(adjacency[neighbor])))
+                    break
+                low[node] = min(low[node], tin[neighbor])
+            else:
+                stack.pop()
+                size[node] = len(order) - tin[node]
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] > tin[parent]:
+                        bridge_child[parent_edge[node]] = node
+
+    # components in the order of their smallest node, which is the root of their search
+    order = np.asarray(order, dtype=int)
+    components = [(size[root], root) for root in roots]
+    ranked = sorted(range(len(roots)), key=lambda c: components[c])
+
+    result = []
+    for u, v in edges:
+        edge_id = edge_ids[(min(u, v), max(u, v))]
+        c = component[u]
+        others = [components[k] + (k,) for k in ranked[:2] if k != c][:1]  # smallest of the other components
+        if edge_id in bridge_child:
+            child = bridge_child[edge_id]
+            subtree = order[tin[child]:tin[child] + size[child]]
+            candidates = [(size[child], subtree.min(), 'subtree'), (components[c][0] - size[child], roots[c], 'rest')] + others
+        elif len(roots) > 1:
+            candidates = [components[c] + (c,)] + others
+        else:
+            result.append(None)
+            continue
+
+        _, _, smallest = min(candidates, key=lambda x: x[:2])
+        if smallest == 'subtree':
+            result.append(np.sort(subtree))
+        elif smallest == 'rest':
+            nodes = order[tin[roots[c]]:tin[roots[c]] + components[c][0]]
+            result.append(np.sort(np.setdiff1d(nodes, subtree)))
+        else:
+            result.append(np.sort(order[tin[roots[smallest]]:tin[roots[smallest]] + components[smallest][0]]))
+    return result
+
+
 def get_transformation_mask(pyg_data):
-    G = to_networkx(pyg_data.to_homogeneous(), to_undirected=False)
-    to_rotate = []
     edges = pyg_data['ligand', 'ligand'].edge_index.T.numpy()
     for i in range(0, edges.shape[0], 2):
         assert edges[i, 0] == edges[i+1, 1]
 
-        G2 = G.to_undirected()
-        G2.remove_edge(*edges[i])
-        if not nx.is_connected(G2):
-            l = list(sorted(nx.connected_components(G2), key=len)[0])
-            if len(l) > 1:
-                if edges[i, 0] in l:
-                    to_rotate.append([])
-                    to_rotate.append(l)
-                else:
-                    to_rotate.append(l)
-                    to_rotate.append([])
-                continue
+    to_rotate = []
+    for i, l in zip(range(0, edges.shape[0], 2), get_smallest_components(pyg_data.num_nodes, edges[::2].tolist())):
+        if l is not None and len(l) > 1:
+            if edges[i, 0] in l:
+                to_rotate.append([])
+                to_rotate.append(l)
+            else:
+                to_rotate.append(l)
+                to_rotate.append([])
+            continue
         to_rotate.append([])
         to_rotate.append([])
 
     mask_edges = np.asarray([0 if len(l) == 0 else 1 for l in to_rotate], dtype=bool)
-    mask_rotate = np.zeros((np.sum(mask_edges), len(G.nodes())), dtype=bool)
+    mask_rotate = np.zeros((np.sum(mask_edges), pyg_data.num_nodes), dtype=bool)
     idx = 0
-    for i in range(min(edges.shape[0], len(G.edges()))):
+    for i in range(edges.shape[0]):
         if mask_edges[i]:
             mask_rotate[idx][np.asarray(to_rotate[i], dtype=int)] = True
             idx += 1
@@ -90,6 +164,152 @@ def modify_conformer_torsion_angles_batch(pos, edge_index, mask_rotate, torsion_
     return pos
 
 
+def get_torsion_tree(rotatable_bonds, mask_rotate):
+    # groups the rotatable bonds of a ligand into levels of bonds that can be applied at the same time with the positions
+    # from before the level. Two bonds of a level either rotate disjoint parts of the ligand without moving an atom of
+    # the other bond, or one of them is nested in the other: all its atoms are rotated by the other bond, which does not
+    # have an atom in the part rotated by the nested bond. Both kinds of pairs commute, the order of all other pairs is
+    # kept, so applying the levels one after the other gives the same positions as applying the bonds one after the
+    # other. Returns the level of every bond and its parent, the smallest bond of the same level it is nested in or -1
+    rotatable_bonds, mask_rotate = np.asarray(rotatable_bonds, dtype=int).reshape(-1, 2), np.asarray(mask_rotate, dtype=bool)
+    K = len(rotatable_bonds)
+    axis = np.zeros_like(mask_rotate)
+    axis[np.arange(K)[:, None], rotatable_bonds] = True
+    mask, touched, axis = mask_rotate.astype(np.float32), (mask_rotate | axis).astype(np.float32), axis.astype(np.float32)
+
+    moves = mask @ touched.T > 0  # moves[j, k]: bond j rotates an atom of bond k or an atom rotated by bond k
+    disjoint = ~(moves | moves.T)
+    nested = (touched @ (1 - mask).T == 0) & ~(mask @ axis.T > 0)  # nested[j, k]: bond j is nested in bond k
+    conflict = ~(disjoint | nested | nested.T)
+
+    levels = np.zeros(K, dtype=int)
+    for k in range(1, K):
+        earlier = np.nonzero(conflict[k, :k])[0]
+        if len(earlier) > 0:
+            levels[k] = levels[earlier].max() + 1
+
+    size = mask_rotate.sum(axis=1)
+    parent = np.full(K, -1)
+    for k in range(K):
+        outer = np.nonzero(nested[k] & (levels == levels[k]))[0]
+        if len(outer) > 0:
+            parent[k] = outer[np.argmin(size[outer])]
+    return levels, parent
+
+
+def get_torsion_index(rotatable_bonds, mask_rotate, levels, parent, device=None):
+    # indices for modify_conformer_torsion_angles_levels. For every level the bonds of the level, the ancestors of the
+    # bonds for composing their rotations by pointer jumping, the atoms rotated in the level and for each of them the
+    # innermost bond of the level that rotates it
+    rotatable_bonds, mask_rotate = np.asarray(rotatable_bonds, dtype=int).reshape(-1, 2), np.asarray(mask_rotate, dtype=bool)
+    bond_range = np.arange(len(rotatable_bonds))
+    # check if need to reverse the edge, v should be connected to the part that gets rotated
+    assert not np.any(mask_rotate[bond_range, rotatable_bonds[:, 0]]) and np.all(mask_rotate[bond_range, rotatable_bonds[:, 1]])
+
+    size = mask_rotate.sum(axis=1)
+    torsion_index = {'bonds': torch.from_numpy(rotatable_bonds).to(device), 'levels': []}
+    for level in range(levels.max() + 1 if len(levels) > 0 else 0):
+        level_bonds = np.nonzero(levels == level)[0]
+        L = len(level_bonds)
+        local = np.full(len(rotatable_bonds) + 1, L)  # index in the level, L stands for no bond
+        local[level_bonds] = np.arange(L)
+        ancestors = [local[parent[level_bonds]]]
+        while np.any(ancestors[-1] < L):
+            ancestors.append(np.append(ancestors[-1], L)[ancestors[-1]])
+        ancestors = ancestors[:-1]
+
+        level_mask = mask_rotate[level_bonds]
+        atoms = np.nonzero(level_mask.any(axis=0))[0]
+        atom_bond = np.where(level_mask[:, atoms], size[level_bonds, None], np.inf).argmin(axis=0)
+        torsion_index['levels'].append(tuple(torch.from_numpy(x).to(device) for x in [level_bonds, atoms, atom_bond]) +
+                                       ([torch.from_numpy(x).to(device) for x in ancestors],))
+    return torsion_index
+
+
+def get_batch_torsion_index(rotatable_bonds, mask_rotate, device=None):
+    # torsion index of a batch of copies of one ligand for modify_conformer_batch
+    rotatable_bonds = rotatable_bonds.cpu().numpy() if torch.is_tensor(rotatable_bonds) else rotatable_bonds
+    mask_rotate = mask_rotate.cpu().numpy() if torch.is_tensor(mask_rotate) else mask_rotate
+    return get_torsion_index(rotatable_bonds, mask_rotate, *get_torsion_tree(rotatable_bonds, mask_rotate), device)
+
+
+def get_ragged_torsion_index(data, mask_rotate):
+    # torsion index of a batch of different ligands for modify_conformer_batch_ragged, mask_rotate is the list of the
+    # masks of the graphs
+    batch = data['ligand'].batch.cpu().numpy()
+    edge_index, edge_mask = data['ligand', 'ligand'].edge_index.cpu().numpy(), data['ligand'].edge_mask.cpu().numpy()
+    node_ptr = np.concatenate([[0], np.cumsum(np.bincount(batch, minlength=data.num_graphs))])
+    bonds = edge_index.T[edge_mask]
+    bond_batch = batch[bonds[:, 0]]
+    rotatable_bonds = [bonds[bond_batch == g] - node_ptr[g] for g in range(data.num_graphs)]
+    return get_list_torsion_index(rotatable_bonds, mask_rotate, data['ligand'].batch.device)
+
+
+def get_list_torsion_index(rotatable_bonds, mask_rotate, device=None):
+    # torsion index of a list of ligands with concatenated positions for modify_conformer_torsion_angles_ragged, given
+    # the rotatable bonds and masks of the ligands. The index is computed once per distinct ligand and the levels of all
+    # ligands are applied together since the ligands do not share atoms
+    to_numpy = lambda x: x.cpu().numpy() if torch.is_tensor(x) else np.asarray(x)
+    ligand_indices, indices = {}, []
+    for bonds, mask in zip(rotatable_bonds, mask_rotate):
+        bonds, mask = to_numpy(bonds).astype(int).reshape(-1, 2), to_numpy(mask).astype(bool)
+        key = (bonds.tobytes(), mask.shape, mask.tobytes())
+        if key not in ligand_indices:
+            ligand_indices[key] = get_torsion_index(bonds, mask, *get_torsion_tree(bonds, mask))
+        indices.append((ligand_indices[key], mask.shape[1]))
+
+    bonds, levels, node_offset, bond_offset = [], [], 0, 0
+    for index, num_nodes in indices:
+        bonds.append(index['bonds'] + node_offset)
+        for level, (level_bonds, atoms, atom_bond, ancestors) in enumerate(index['levels']):
+            if level == len(levels):
+                levels.append([])
+            levels[level].append((level_bonds + bond_offset, atoms + node_offset, atom_bond, ancestors))
+        node_offset, bond_offset = node_offset + num_nodes, bond_offset + len(index['bonds'])
+
+    torsion_index = {'bonds': torch.cat(bonds).to(device) if len(bonds) > 0 else torch.zeros((0, 2), dtype=torch.long, device=device), 'levels': []}
+    for level in levels:
+        # the ancestors point into the bonds of the level, their number is the index of no bond
+        sizes = [len(level_bonds) for level_bonds, _, _, _ in level]
+        L, offsets = sum(sizes), np.cumsum([0] + sizes)
+        num_rounds = max(len(ancestors) for _, _, _, ancestors in level)
+        ancestors = [torch.cat([torch.where(ancestors[r] < size, ancestors[r] + offset, L) if r < len(ancestors) else torch.full((size,), L)
+                                for (_, _, _, ancestors), size, offset in zip(level, sizes, offsets)]) for r in range(num_rounds)]
+        torsion_index['levels'].append((torch.cat([level_bonds for level_bonds, _, _, _ in level]).to(device),
+                                        torch.cat([atoms for _, atoms, _, _ in level]).to(device),
+                                        torch.cat([atom_bond + offset for (_, _, atom_bond, _), offset in zip(level, offsets)]).to(device),
+                                        [x.to(device) for x in ancestors]))
+    return torsion_index
+
+
+def modify_conformer_torsion_angles_levels(pos, torsion_index, torsion_updates):
+    # same as modify_conformer_torsion_angles_batch with the bonds grouped into levels by get_torsion_index, so that
+    # every level is a single update of the positions of shape (B, N, 3)
+    pos = pos + 0
+    bonds = torsion_index['bonds']
+    for level_bonds, atoms, atom_bond, ancestors in torsion_index['levels']:
+        u, v = bonds[level_bonds, 0], bonds[level_bonds, 1]
+        rot_vec = pos[:, u] - pos[:, v]  # convention: positive rotation if pointing inwards
+        rot_mat = axis_angle_to_matrix(
+            rot_vec / torch.linalg.norm(rot_vec, dim=-1, keepdims=True) * torsion_updates[:, level_bonds].unsqueeze(2))
+        # rotation around pos[v] as x -> rot_mat x + shift, followed by the rotations of the bonds it is nested in
+        shift = pos[:, v] - torch.einsum('blij,blj->bli', rot_mat, pos[:, v])
+        eye = torch.eye(3, device=pos.device, dtype=pos.dtype).expand(pos.shape[0], 1, 3, 3)
+        for ancestor in ancestors:
+            outer_mat, outer_shift = torch.cat([rot_mat, eye], dim=1)[:, ancestor], F.pad(shift, (0, 0, 0, 1))[:, ancestor]
+            rot_mat, shift = outer_mat @ rot_mat, torch.einsum('blij,blj->bli', outer_mat, shift) + outer_shift
+
+        pos[:, atoms] = torch.einsum('baij,baj->bai', rot_mat[:, atom_bond], pos[:, atoms]) + shift[:, atom_bond]
+
+    return pos
+
+
+def modify_conformer_torsion_angles_ragged(pos, torsion_index, torsion_updates):
+    # modify_conformer_torsion_angles_levels for the Nx3 positions of a batch of different ligands, the torsion_updates
+    # are given for the rotatable bonds of all graphs one after the other
+    return modify_conformer_torsion_angles_levels(pos.unsqueeze(0), torsion_index, torsion_updates.unsqueeze(0)).squeeze(0)
+
+
 def perturb_batch(data, torsion_updates, split=False, return_updates=False):
     if type(data) is Data:
         return modify_conformer_torsion_angles(data.pos,
@@ -136,3 +356,95 @@ def get_dihedrals(data_list):
     # print(dihedral_numpy.shape)
     dihedral = torch.tensor(dihedral)
     return dihedral
+
+
+def test_modify_conformer_torsion_angles_levels(num_ligands=40, batch_size=4, seed=0):
+    # compares the level by level torsion updates with applying the bonds one after the other on random tree shaped
+    # ligands, from chains to bushy trees. Uses double precision since the rotations are composed in a different order
+    from torch_geometric.data import HeteroData
+    rng = np.random.default_rng(seed)
+    torch.manual_seed(seed)
+    for i in range(num_ligands):
+        num_atoms = int(rng.integers(2, 60))
+        window = max(1, int(num_atoms * i / num_ligands))  # small windows give long chains
+        tree = [(int(rng.integers(max(0, j - window), j)), j) for j in range(1, num_atoms)]
+        graph = HeteroData()
+        graph['ligand'].pos = torch.randn(num_atoms, 3, dtype=torch.float64) * 3
+        graph['ligand', 'lig_bond', 'ligand'].edge_index = torch.tensor([e for u, v in tree for e in [(u, v), (v, u)]]).T
+        edge_mask, mask_rotate = get_transformation_mask(graph)
+        rotatable_bonds = graph['ligand', 'ligand'].edge_index.T[torch.tensor(edge_mask)]
+        # rotating the larger side of some bonds gives bonds that conflict and have to be put into different levels
+        flip = rng.random(len(rotatable_bonds)) < 0.5 * (i % 2)
+        rotatable_bonds[flip] = rotatable_bonds[flip].flip(1)
+        mask_rotate[flip] = ~mask_rotate[flip]
+
+        pos = graph['ligand'].pos.unsqueeze(0).repeat(batch_size, 1, 1)
+        torsion_updates = torch.rand(batch_size, len(rotatable_bonds), dtype=torch.float64) * 2 * np.pi - np.pi
+        sequential = modify_conformer_torsion_angles_batch(pos, rotatable_bonds, torch.from_numpy(mask_rotate), torsion_updates)
+        levels = modify_conformer_torsion_angles_levels(pos, get_batch_torsion_index(rotatable_bonds, mask_rotate), torsion_updates)
+        assert torch.allclose(sequential, levels, atol=1e-8), (sequential - levels).abs().max()
+    print('test_modify_conformer_torsion_angles_levels passed')
+    return True
+
+
+def test_get_transformation_mask():
+    # compares the masks and the torsion angles from the bridges with recomputing the connected components for every
+    # bond, on macrocycles, large flexible ligands, fused rings and salts with several fragments
+    from rdkit import Chem
+    from torch_geometric.data import HeteroData
+    from datasets.conformer_matching import get_torsion_angles
+
+    def reference_components(G, e):
+        G2 = G.to_undirected()
+        G2.remove_edge(*e)
+        if nx.is_connected(G2):
+            return None
+        return list(sorted(nx.connected_components(G2), key=len)[0])
+
+    smiles = [
+        'CC[C@H]1OC(=O)[C@H](C)[C@@H](O[C@H]2C[C@@](C)(OC)[C@@H](O)[C@H](C)O2)[C@H](C)[C@@H](O[C@@H]2O[C@H](C)C[C@H](N(C)C)[C@H]2O)[C@](C)(O)C[C@@H](C)C(=O)[C@H](C)[C@@H](O)[C@]1(C)O',  # erythromycin
+        'CC[C@H]1C(=O)N(CC(=O)N([C@H](C(=O)N[C@H](C(=O)N([C@H](C(=O)N[C@H](C(=O)N[C@@H](C(=O)N([C@H](C(=O)N([C@H](C(=O)N([C@H](C(=O)N([C@H](C(=O)N1)[C@@H]([C@H](C)C/C=C/C)O)C)C(C)C)C)CC(C)C)C)CC(C)C)C)C)C)CC(C)C)C)C(C)C)CC(C)C)C)C',  # cyclosporin
+        'C1CCCCCCCCCCCCCCCCCCCCCCC1CCOCCOCCOCCOCCOCCOCCOCCOC',
+        'CCCCCCCCCCCCCCCC(=O)OC[C@H](COP(=O)([O-])OCC[N+](C)(C)C)OC(=O)CCCCCCC/C=C\\CCCCCCCC',
+        'COCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOCCOC',
+        'c1ccc2cc3ccccc3cc2c1', 'C1CC2CCC1CC2', 'CC(C)(C)c1ccc(O)cc1', 'CC',
+        'CC(=O)[O-].[Na+]', 'OC(=O)CCC(=O)O.CCN(CC)CC', 'c1ccccc1.C1CC1.CCOC',
+    ]
+    for smi in smiles:
+        mol = Chem.MolFromSmiles(smi)
+        edges = [e for b in mol.GetBonds() for e in [(b.GetBeginAtomIdx(), b.GetEndAtomIdx()), (b.GetEndAtomIdx(), b.GetBeginAtomIdx())]]
+        graph = HeteroData()
+        graph['ligand'].x = torch.zeros(mol.GetNumAtoms(), 1)
+        graph['ligand', 'lig_bond', 'ligand'].edge_index = torch.tensor(edges, dtype=torch.long).reshape(-1, 2).T
+        edge_mask, mask_rotate = get_transformation_mask(graph)
+
+        G = to_networkx(graph.to_homogeneous(), to_undirected=False)
+        reference_mask, reference_rotate = [], []
+        for i in range(0, len(edges), 2):
+            l = reference_components(G, edges[i])
+            if l is not None and len(l) > 1:
+                reference_mask += [False, True] if edges[i][0] in l else [True, False]
+                reference_rotate.append(np.isin(np.arange(mol.GetNumAtoms()), l))
+            else:
+                reference_mask += [False, False]
+        assert np.array_equal(edge_mask, np.asarray(reference_mask, dtype=bool)), smi
+        assert np.array_equal(mask_rotate, np.asarray(reference_rotate, dtype=bool).reshape(-1, mol.GetNumAtoms())), smi
+
+        G = nx.Graph()
+        G.add_nodes_from(range(mol.GetNumAtoms()))
+        G.add_edges_from(edges[::2])
+        reference_torsions = []
+        for e in G.edges():
+            l = reference_components(G, e)
+            if l is not None and len(l) > 1:
+                G2 = copy.deepcopy(G)
+                G2.remove_edge(*e)
+                reference_torsions.append((list(G2.neighbors(e[0]))[0], e[0], e[1], list(G2.neighbors(e[1]))[0]))
+        assert get_torsion_angles(mol) == reference_torsions, smi
+    print('test_get_transformation_mask passed')
+    return True
+
+
+if __name__ == '__main__':
+    test_get_transformation_mask()
+    test_modify_conformer_torsion_angles_levels()
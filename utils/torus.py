@@ -1,21 +1,23 @@
 import numpy as np
+import torch
 import tqdm
-import os
+
+from utils.series_cache import load_tables
 
 """
     Preprocessing for the SO(2)/torus sampling and score computations, truncated infinite series are computed and then
-    cached to memory, therefore the precomputation is only run the first time the repository is run on a machine
+    cached to disk (see utils/series_cache.py), therefore the precomputation is only run the first time they are used
 """
 
 
-def p(x, sigma, N=10):
+def p_series(x, sigma, N=10):
     p_ = 0
     for i in tqdm.trange(-N, N + 1):
         p_ += np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
     return p_
 
 
-def grad(x, sigma, N=10):
+def grad_series(x, sigma, N=10):
     p_ = 0
     for i in tqdm.trange(-N, N + 1):
         p_ += (x + 2 * np.pi * i) / sigma ** 2 * np.exp(-(x + 2 * np.pi * i) ** 2 / 2 / sigma ** 2)
@@ -28,19 +30,41 @@ SIGMA_MIN, SIGMA_MAX, SIGMA_N = 3e-3, 2, 5000  # relative to pi
 x = 10 ** np.linspace(np.log10(X_MIN), 0, X_N + 1) * np.pi
 sigma = 10 ** np.linspace(np.log10(SIGMA_MIN), np.log10(SIGMA_MAX), SIGMA_N + 1) * np.pi
 
-if os.path.exists('.p.npy'):
-    p_ = np.load('.p.npy')
-    score_ = np.load('.score.npy')
-else:
-    p_ = p(x, sigma[:, None], N=100)
-    np.save('.p.npy', p_)
+# increased when the tables change, so that outdated tables in the cache are not used
+TORUS_TABLES_VERSION = 1
+_tables = None
+
+
+def _compute_tables(tables):
+    if 'p' not in tables or 'score' not in tables:
+        p_ = p_series(x, sigma[:, None], N=100)
+        eps = np.finfo(p_.dtype).eps
+        score_ = grad_series(x, sigma[:, None], N=100) / (p_ + eps)
+        tables = {'p': p_, 'score': score_}
+
+    # the expected squared score of every sigma, from samples of the wrapped normal distribution
+    score_norm_ = _lookup_score(
+        tables['score'],
+        sample(sigma[None].repeat(10000, 0).flatten()),
+        sigma[None].repeat(10000, 0).flatten()
+    ).reshape(10000, -1)
+    return {**tables, 'score_norm': (score_norm_ ** 2).mean(0)}
 
-    eps = np.finfo(p_.dtype).eps
-    score_ = grad(x, sigma[:, None], N=100) / (p_ + eps)
-    np.save('.score.npy', score_)
+
+def get_tables():
+    # the tables are only loaded (or computed the first time) when they are used, not when the module is imported
+    global _tables
+    if _tables is None:
+        _tables = load_tables('torus', TORUS_TABLES_VERSION, ('p', 'score', 'score_norm'), _compute_tables,
+                              legacy_paths={'p': '.p.npy', 'score': '.score.npy'})
+    return _tables
 
 
 def score(x, sigma):
+    return _lookup_score(get_tables()['score'], x, sigma)
+
+
+def _lookup_score(score_, x, sigma):
     x = (x + np.pi) % (2 * np.pi) - np.pi
     sign = np.sign(x)
     x = np.log(np.abs(x) / np.pi)
@@ -60,7 +84,7 @@ def p(x, sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return p_[sigma, x]
+    return get_tables()['p'][sigma, x]
 
 
 def sample(sigma):
@@ -69,15 +93,20 @@ def sample(sigma):
     return out
 
 
-score_norm_ = score(
-    sample(sigma[None].repeat(10000, 0).flatten()),
-    sigma[None].repeat(10000, 0).flatten()
-).reshape(10000, -1)
-score_norm_ = (score_norm_ ** 2).mean(0)
-
-
 def score_norm(sigma):
     sigma = np.log(sigma / np.pi)
     sigma = (sigma - np.log(SIGMA_MIN)) / (np.log(SIGMA_MAX) - np.log(SIGMA_MIN)) * SIGMA_N
     sigma = np.round(np.clip(sigma, 0, SIGMA_N)).astype(int)
-    return score_norm_[sigma]
+    return get_tables()['score_norm'][sigma]
+
+
+def get_score_norm_table():
+    # the expected squared score norms of score_norm as a tensor, the models keep it as a buffer on their device
+    return torch.from_numpy(np.array(get_tables()['score_norm'])).float()
+
+
+def score_norm_tensor(sigma, score_norm_table):
+    """ score_norm of sigma on its device, without copies to the host. score_norm_table is get_score_norm_table() on
+    the device of sigma. """
+    sigma = torch.log(sigma / np.pi).sub_(np.log(SIGMA_MIN)).div_(np.log(SIGMA_MAX) - np.log(SIGMA_MIN)).mul_(SIGMA_N)
+    return score_norm_table[sigma.round_().clamp_(0, SIGMA_N).long()]
@@ -404,6 +404,9 @@ def crop_beyond(complex_graph, cutoff, all_atoms):
     complex_graph['receptor', 'rec_contact', 'receptor'].edge_index = \
         subgraph(residues_to_keep, complex_graph['receptor', 'rec_contact', 'receptor'].edge_index, relabel_nodes=True)[0]
 
+    # the cropped receptor differs from the one the cached receptor embeddings belong to
+    complex_graph.receptor_key = None
+
     if all_atoms:
         complex_graph['atom'].x = complex_graph['atom'].x[atoms_to_keep]
         complex_graph['atom'].pos = complex_graph['atom'].pos[atoms_to_keep]
@@ -0,0 +1,199 @@
+import os
+import socket
+import threading
+import time
+
+# only the standard library and the shared filesystem are used, so the queue works on any cluster without a service.
+# A work item is a small file that moves from pending/ to claimed/ to done/ with atomic renames, the worker that
+# renames it first owns it. The mtime of a claimed file is its lease, it is renewed while the worker is alive
+
+
+def get_worker_id():
+    job_id = os.environ.get('SLURM_JOB_ID')
+    return f"{socket.gethostname()}-{os.getpid()}" + (f"-{job_id}" if job_id else "")
+
+
+class WorkQueue:
+    """ Work queue in a directory. Workers claim the pending items in the order of their names until none are left,
+    claims that were not renewed for lease_time seconds (the worker died or was preempted) are put back. """
+
+    def __init__(self, queue_dir, lease_time=1800, worker_id=None):
+        self.queue_dir = queue_dir
+        self.lease_time = lease_time
+        self.worker_id = worker_id or get_worker_id()
+        for state in ('pending', 'claimed', 'done'):
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+
+    def get_path(self, state, name):
+        return os.path.join(self.queue_dir, state, name)
+
+    def add(self, name, content):
+        # written under a temporary name first so that no worker claims a partial item
+        tmp_path = self.get_path('pending', f'.{name}.tmp-{os.getpid()}')
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.rename(tmp_path, self.get_path('pending', name))
+
+    def list(self, state):
+        return sorted(name for name in os.listdir(os.path.join(self.queue_dir, state)) if not name.startswith('.'))
+
+    def claim(self):
+        """ Returns the name of the claimed item, the claimed file is named after the worker so that a worker can tell
+        whether it still owns the item. None if nothing is pending. """
+        for name in self.list('pending'):
+            claimed_path = self.get_path('claimed', f'{name}@{self.worker_id}')
+            try:
+                os.rename(self.get_path('pending', name), claimed_path)
+            except FileNotFoundError:
+                continue  # another worker was faster
+            os.utime(claimed_path)
+            return name
+        return None
+
+    def renew(self, name):
+        try:
+            os.utime(self.get_path('claimed', f'{name}@{self.worker_id}'))
+            return True
+        except FileNotFoundError:
+            return False  # the lease expired and the item was put back
+
+    def complete(self, name):
+        try:
+            os.rename(self.get_path('claimed', f'{name}@{self.worker_id}'), self.get_path('done', name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def read(self, name):
+        with open(self.get_path('claimed', f'{name}@{self.worker_id}')) as f:
+            return f.read()
+
+    def requeue_expired(self):
+        requeued = 0
+        for claimed_name in self.list('claimed'):
+            claimed_path = self.get_path('claimed', claimed_name)
+            try:
+                if time.time() - os.path.getmtime(claimed_path) > self.lease_time:
+                    os.rename(claimed_path, self.get_path('pending', claimed_name.rsplit('@', 1)[0]))
+                    requeued += 1
+            except FileNotFoundError:
+                pass
+        return requeued
+
+    def work(self, poll_interval=60, idle_timeout=0):
+        """ Yields the claimed items until the queue is empty. The lease of the current item is renewed in the
+        background and it is marked done when the caller asks for the next one, so an item of a caller that raises is
+        put back when its lease expires. While other workers hold the last items, this worker waits so that it can take
+        over the items of workers that die. A warm worker with an idle_timeout keeps waiting for new items until the
+        queue was empty for idle_timeout seconds. """
+        idle_since = None
+        while True:
+            name = self.claim()
+            if name is None and self.requeue_expired():
+                name = self.claim()
+            if name is None:
+                if not self.list('pending') and not self.list('claimed'):
+                    idle_since = idle_since or time.time()
+                    if time.time() - idle_since >= idle_timeout:
+                        return
+                else:
+                    idle_since = None
+                time.sleep(poll_interval)
+                continue
+            idle_since = None
+
+            stop = threading.Event()
+            renewer = threading.Thread(target=self.keep_lease, args=(name, stop), daemon=True)
+            renewer.start()
+            try:
+                yield name
+            finally:
+                stop.set()
+                renewer.join()
+            self.complete(name)
+
+    def keep_lease(self, name, stop):
+        while not stop.wait(self.lease_time / 4):
+            if not self.renew(name):
+                return
+
+
+def test_work_queue(num_workers=4, num_items=40):
+    # local stand-in for the cluster: workers in separate processes of which one dies after claiming an item, every
+    # item must still be done exactly when the queue finishes
+    import multiprocessing
+    import tempfile
+
+    def worker(queue_dir, worker_idx, results):
+        queue = WorkQueue(queue_dir, lease_time=2, worker_id=f'worker{worker_idx}')
+        time.sleep(0.2 * (worker_idx > 0))  # the first worker claims an item before it dies
+        for name in queue.work(poll_interval=0.2):
+            if worker_idx == 0:
+                os._exit(1)  # dies without completing or renewing its claim
+            results.put((name, queue.read(name)))
+            time.sleep(0.01)
+
+    with tempfile.TemporaryDirectory() as queue_dir:
+        queue = WorkQueue(queue_dir)
+        for i in range(num_items):
+            queue.add(f'item_{i:04d}', str(i))
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        workers = [context.Process(target=worker, args=(queue_dir, i, results)) for i in range(num_workers)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+        done = []
+        while not results.empty():
+            done.append(results.get())
+        assert sorted(name for name, _ in done) == [f'item_{i:04d}' for i in range(num_items)], done
+        assert all(content == str(int(name[5:])) for name, content in done)
+        assert queue.list('done') == [f'item_{i:04d}' for i in range(num_items)] and not queue.list('claimed')
+    print(f'{num_items} items were done once by {num_workers - 1} workers after a worker died')
+
+
+def test_idle_timeout():
+    # a warm worker takes the items that are added while it waits, and stops when none came for the idle timeout
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as queue_dir:
+        queue = WorkQueue(queue_dir)
+        queue.add('item_0', '0')
+        adder = threading.Timer(0.5, queue.add, args=('item_1', '1'))
+        adder.start()
+        start, done = time.time(), []
+        for name in queue.work(poll_interval=0.1, idle_timeout=1):
+            done.append((name, time.time() - start))
+        assert [name for name, _ in done] == ['item_0', 'item_1'] and done[1][1] >= 0.5, done
+        assert 1.5 <= time.time() - start < 3, time.time() - start
+    print('The warm worker took the item that was added later and stopped when the queue stayed empty')
+
+
+def test_failing_item(num_items=5):
+    # a worker that catches the errors of an item (like the shards of inference.py) keeps taking the following items,
+    # and the failed item is done instead of being put back for the next worker
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as queue_dir:
+        queue = WorkQueue(queue_dir, lease_time=0.5)
+        for i in range(num_items):
+            queue.add(f'item_{i}', str(i))
+        done, failed = [], []
+        for name in queue.work(poll_interval=0.1):
+            try:
+                if name == 'item_1':
+                    raise ValueError(f'bad shard {name}')
+                done.append(name)
+            except (Exception, SystemExit):
+                failed.append(name)
+        assert failed == ['item_1'] and done == [f'item_{i}' for i in range(num_items) if i != 1], (failed, done)
+        time.sleep(0.6)
+        assert not queue.requeue_expired() and queue.list('done') == [f'item_{i}' for i in range(num_items)]
+    print('The worker kept taking items after an item failed, and the failed item was not put back')
+
+
+if __name__ == '__main__':
+    test_work_queue()
+    test_idle_timeout()
+    test_failing_item()